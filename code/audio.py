@@ -96,7 +96,13 @@ class Audio(ProcessInput):
             cv5 = state['buffer'][5] if state['cv_active'][5] else 1.0
             print('Interpolate gate')
             self._model.interp_final(cv2, cv3, cv4, cv5)
-        if cur_event in [config.events.cv2, config.events.cv3, config.events.cv4, config.events.cv5]:
+        if config.audio.cv_mode == 'vary' and cur_event in [config.events.cv3, config.events.cv4, config.events.cv5]:
+            cv3 = state['cv'][3] if state['cv_active'][3] else 0.0
+            cv4 = state['cv'][4] if state['cv_active'][4] else 0.0
+            cv5 = state['cv'][5] if state['cv_active'][5] else -4.0
+            print('CV LIST DETECTED - Vary')
+            self._model.vary_cv(cv3, cv4, cv5)
+        elif cur_event in [config.events.cv2, config.events.cv3, config.events.cv4, config.events.cv5]:
             cv2 = state['cv'][2] if state['cv_active'][2] else 0.0
             cv3 = state['cv'][3] if state['cv_active'][3] else 1.0
             cv4 = state['cv'][4] if state['cv_active'][4] else 1.0
@@ -158,27 +164,19 @@ class Audio(ProcessInput):
 
     def play_model_block(self, state, wait: bool = True):
         '''
-            Play a sinus signal 
+            Trigger a new voice of the model, layered over the voices
+            already playing. All voices are mixed by the model in a single
+            output stream, opened at the first call and kept running.
             Parameters:
-                amplitude:  [float], optional
-                            Amplitude of the sinusoid
-                length:     [int], optional
-                            Length of signal to generate (in seconds)
+                state:      [dict]
+                            Shared state of the Neurorack
         '''
 
         def callback_block(outdata, frames, time, status):
-            # print('Start of call block')
-            # print(outdata.shape)
-            # cur_data = self._model.request_block(self.cur_idx)[:, np.newaxis]
-            cur_data = self._model.request_block_threaded(self.cur_idx)
-            if cur_data is None:
-                # print('Stream stopping (end of features)')
-                raise sd.CallbackStop()
-            outdata[:] = cur_data[:, np.newaxis]
-            self.cur_idx += 1
-
-        self.cur_idx = 0
+            outdata[:, 0] = self._model.request_mix_block()
+
         self._model.signal_start_stream()
+        self._model.trigger_voice()
         if self._cur_stream == None:
             self._cur_stream = sd.OutputStream(callback=callback_block, blocksize=512, channels=1, samplerate=self._sr)
             self._cur_stream.start()
@@ -33,6 +33,9 @@ class config:
         # General screen properties
         volume      = 1.0
         stereo      = 0.0
+        # CV mapping: 'morph' (cv2 to cv5 interpolate the sounds) or 'vary'
+        # (cv3 to cv5 stretch, transpose and freeze the current morph)
+        cv_mode     = 'morph'
     
     class events:
         none        = -1
@@ -0,0 +1,312 @@
+import os
+import sys
+import argparse
+import json
+import hashlib
+import traceback
+import librosa
+import numpy as np
+import torch
+import tqdm
+from collections import OrderedDict
+from multiprocessing import Pool
+
+# Parameters of the descriptors: any change must bump the version, so that
+# features computed with older parameters are never loaded from the store
+FEATURES_VERSION = 1
+FEATURES_PARAMS = {'n_fft': 2048, 'hop_length': 512, 'f0_min': 50, 'f0_max': 5000}
+FEATURES_NAMES = ['rms', 'zcr', 'rolloff', 'flatness', 'bandwidth', 'centroid', 'f0']
+
+
+def spectral_features(y, sr):
+    """
+        Frame-level descriptors of a waveform (frames, 7), in the order of
+        FEATURES_NAMES. The STFT magnitude is computed once and shared by all
+        the spectral descriptors.
+    """
+    n_fft, hop_length = FEATURES_PARAMS['n_fft'], FEATURES_PARAMS['hop_length']
+    features = [None] * 7
+    features[0] = librosa.feature.rms(y=y, frame_length=n_fft, hop_length=hop_length)
+    features[1] = librosa.feature.zero_crossing_rate(y, frame_length=n_fft, hop_length=hop_length)
+    # Spectral features
+    S, phase = librosa.magphase(librosa.stft(y=y, n_fft=n_fft, hop_length=hop_length))
+    # Compute all descriptors
+    features[2] = librosa.feature.spectral_rolloff(S=S, sr=sr)
+    features[3] = librosa.feature.spectral_flatness(S=S)
+    features[4] = librosa.feature.spectral_bandwidth(S=S, sr=sr)
+    features[5] = librosa.feature.spectral_centroid(S=S, sr=sr)
+    features[6] = librosa.yin(y, fmin=FEATURES_PARAMS['f0_min'], fmax=FEATURES_PARAMS['f0_max'], sr=sr,
+                              frame_length=n_fft, hop_length=hop_length)[np.newaxis, :]
+    features = np.concatenate(features).transpose()
+    features[np.isnan(features)] = 1
+    features = features[:-1, :]
+    return features.astype(np.float32)
+
+
+class FeatureStore:
+    """
+        On-disk store of the spectral features, one memory-mappable .npy file
+        per sound. Files are named by a hash of the sound content, the sample
+        rate and the descriptor parameters (FEATURES_VERSION, FEATURES_PARAMS):
+        renamed files still hit the store, edited files or new parameters miss it.
+    """
+
+    def __init__(self, root='models/features', sr=22050):
+        self.root = root
+        self.sr = sr
+
+    def _params_hash(self):
+        params = repr((FEATURES_VERSION, sorted(FEATURES_PARAMS.items()), self.sr))
+        return hashlib.sha1(params.encode())
+
+    def file_key(self, wav_path):
+        """
+            Key of a sound file: hash of the encoded file, no decoding needed
+        """
+        h = self._params_hash()
+        with open(wav_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        return h.hexdigest()
+
+    def audio_key(self, y):
+        """
+            Key of a decoded waveform (sounds that do not come from a file)
+        """
+        h = self._params_hash()
+        h.update(np.ascontiguousarray(y, dtype=np.float32).tobytes())
+        return 'a' + h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.root, key + '.npy')
+
+    def contains(self, key):
+        return os.path.exists(self.path(key))
+
+    def save(self, key, features):
+        os.makedirs(self.root, exist_ok=True)
+        # Write then rename, so that readers never see a partial file
+        tmp_path = self.path(key) + '.' + str(os.getpid()) + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, np.asarray(features, dtype=np.float32))
+        os.replace(tmp_path, self.path(key))
+
+    def load(self, key, mmap=True):
+        """
+            Features (frames, 7) as a numpy array, memory-mapped by default
+        """
+        return np.load(self.path(key), mmap_mode='r' if mmap else None)
+
+    def compute(self, wav_path, key=None):
+        """
+            Decode a sound file, compute its features and save them in the store
+        """
+        key = self.file_key(wav_path) if key is None else key
+        y, sr = librosa.load(wav_path, sr=self.sr)
+        features = spectral_features(y, sr)
+        self.save(key, features)
+        return key, features
+
+    def features(self, wav_path, device='cpu'):
+        """
+            Features of a sound file as a (1, frames, 7) float tensor on device,
+            computed only if the store does not contain them yet
+        """
+        key = self.file_key(wav_path)
+        if not self.contains(key):
+            self.compute(wav_path, key)
+        return to_tensor(self.load(key), device)
+
+
+def to_tensor(features, device='cpu'):
+    """
+        (frames, 7) numpy features (possibly memory-mapped) to a (1, frames, 7)
+        float tensor on any device
+    """
+    return torch.tensor(np.asarray(features, dtype=np.float32)).unsqueeze(0).to(device)
+
+
+def stretch(features, factor):
+    """
+        Time-stretch (batch, frames, 7) features by factor, resampling the frame
+        axis linearly (factor > 1: longer)
+    """
+    n_frames = max(1, int(round(features.shape[1] * factor)))
+    if n_frames == features.shape[1]:
+        return features
+    return torch.nn.functional.interpolate(features.transpose(1, 2), size=n_frames, mode='linear',
+                                           align_corners=True).transpose(1, 2)
+
+
+def transpose(features, semitones):
+    """
+        Transpose (batch, frames, 7) features by scaling the f0 channel
+    """
+    features = features.clone()
+    features[:, :, FEATURES_NAMES.index('f0')] *= 2 ** (semitones / 12)
+    return features
+
+
+def freeze(features, frame):
+    """
+        Hold the frame of (batch, frames, 7) features until the end
+    """
+    frame = min(max(int(frame), 0), features.shape[1] - 1)
+    features = features.clone()
+    features[:, frame:, :] = features[:, frame:(frame + 1), :]
+    return features
+
+
+def _extract_file(args):
+    """
+        Worker of extract_library: (path, key, status, error), never raises so
+        that one broken file does not stop the batch
+    """
+    root, sr, wav_path, force = args
+    store = FeatureStore(root, sr)
+    try:
+        key = store.file_key(wav_path)
+        if store.contains(key) and not force:
+            return wav_path, key, 'skipped', None
+        store.compute(wav_path, key)
+        return wav_path, key, 'extracted', None
+    except Exception:
+        return wav_path, None, 'failed', traceback.format_exc(limit=1)
+
+
+def extract_library(wav_paths, store=None, n_workers=None, force=False, progress=True):
+    """
+        Compute the features of a list of sound files over a process pool, in
+        the format the runtime loads (FeatureStore). Files already in the store
+        are skipped unless force. Returns {path: (key, status, error)} with
+        status 'extracted', 'skipped' or 'failed'.
+    """
+    store = FeatureStore() if store is None else store
+    os.makedirs(store.root, exist_ok=True)
+    jobs = [(store.root, store.sr, wav_path, force) for wav_path in wav_paths]
+    results = {}
+    with Pool(n_workers) as pool:
+        for wav_path, key, status, error in tqdm.tqdm(pool.imap_unordered(_extract_file, jobs), total=len(jobs),
+                                                      disable=not progress):
+            results[wav_path] = (key, status, error)
+            if error is not None:
+                print('Failed ' + wav_path + ': ' + error.strip().splitlines()[-1])
+    return results
+
+
+def list_sounds(root, extensions=('.wav', '.mp3', '.flac', '.aif', '.aiff')):
+    return sorted(os.path.join(dirpath, name) for dirpath, _, names in os.walk(root)
+                  for name in names if name.lower().endswith(extensions))
+
+
+class SampleLibrary:
+    """
+        Index of the sounds of a folder and of their features in the store. The
+        manifest (library.json in the store) holds, per sound name (path relative
+        to the folder): feature key, number of frames, sample rate and the mean /
+        std of each descriptor. Feature matrices are only read (mmap) when a sound
+        is selected, and the last cache_size ones are kept in an LRU.
+    """
+
+    def __init__(self, root='data', store=None, cache_size=16):
+        self.root = root
+        self.store = FeatureStore() if store is None else store
+        self.manifest_path = os.path.join(self.store.root, 'library.json')
+        self.cache_size = cache_size
+        self._entries = OrderedDict()
+        self._cache = OrderedDict()
+
+    def open(self, n_workers=None):
+        """
+            Load the manifest, or build it if there is none yet. The folder is
+            rescanned if sounds were added or removed since the manifest was written.
+        """
+        if not os.path.exists(self.manifest_path):
+            return self.scan(n_workers)
+        with open(self.manifest_path) as f:
+            manifest = json.load(f)
+        if manifest.get('version') != FEATURES_VERSION or manifest.get('sr') != self.store.sr:
+            return self.scan(n_workers)
+        names = set(os.path.relpath(wav_path, self.root) for wav_path in list_sounds(self.root))
+        if names != set(manifest.get('sounds', {})):
+            return self.scan(n_workers)
+        self._entries = OrderedDict(manifest['sounds'])
+        self._cache.clear()
+
+    def scan(self, n_workers=None, progress=True):
+        """
+            Extract the features of the new or modified sounds of the folder and
+            rewrite the manifest (sounds whose key did not change keep their entry)
+        """
+        old_entries = self._entries
+        if len(old_entries) == 0 and os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                old_entries = json.load(f).get('sounds', {})
+        results = extract_library(list_sounds(self.root), self.store, n_workers, progress=progress)
+        entries = OrderedDict()
+        for wav_path in sorted(results):
+            key, status, error = results[wav_path]
+            if error is not None:
+                continue
+            name = os.path.relpath(wav_path, self.root)
+            if name in old_entries and old_entries[name]['key'] == key:
+                entries[name] = old_entries[name]
+                continue
+            features = self.store.load(key)
+            entries[name] = {'key': key, 'frames': int(features.shape[0]), 'sr': self.store.sr,
+                             'mean': features.mean(axis=0).tolist(), 'std': features.std(axis=0).tolist()}
+        self._entries = entries
+        self._cache.clear()
+        manifest = {'version': FEATURES_VERSION, 'params': FEATURES_PARAMS, 'sr': self.store.sr, 'sounds': entries}
+        tmp_path = self.manifest_path + '.' + str(os.getpid()) + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(tmp_path, self.manifest_path)
+
+    def names(self):
+        return list(self._entries)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, name):
+        return name in self._entries
+
+    def entry(self, name):
+        return self._entries[name]
+
+    def features(self, name, device='cpu'):
+        """
+            (1, frames, 7) features of a sound on device, from the LRU or mmap
+        """
+        cache_key = (name, str(device))
+        if cache_key in self._cache:
+            self._cache.move_to_end(cache_key)
+            return self._cache[cache_key]
+        features = to_tensor(self.store.load(self._entries[name]['key']), device)
+        self._cache[cache_key] = features
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return features
+
+
+if __name__ == '__main__':
+    # Offline extraction of a sample pack: python -m models.features data/ (from the code/ directory)
+    parser = argparse.ArgumentParser(description='Batch extraction of the impact features')
+    parser.add_argument('inputs', nargs='+', help='sound files or folders')
+    parser.add_argument('--store', default='models/features', help='feature store folder')
+    parser.add_argument('--sr', type=int, default=22050)
+    parser.add_argument('--workers', type=int, default=None, help='processes (default: all cores)')
+    parser.add_argument('--library', default=None, help='sound folder whose manifest to rebuild')
+    parser.add_argument('--force', action='store_true', help='recompute files already in the store')
+    args = parser.parse_args()
+    wav_paths = []
+    for path in args.inputs:
+        wav_paths += list_sounds(path) if os.path.isdir(path) else [path]
+    results = extract_library(wav_paths, FeatureStore(args.store, args.sr), args.workers, args.force)
+    if args.library is not None:
+        SampleLibrary(args.library, FeatureStore(args.store, args.sr)).scan(args.workers, progress=False)
+    status = [r[1] for r in results.values()]
+    print('{:d} extracted, {:d} skipped, {:d} failed'.format(
+        status.count('extracted'), status.count('skipped'), status.count('failed')))
+    sys.exit(1 if 'failed' in status else 0)
@@ -0,0 +1,491 @@
+#!/usr/bin/env python
+"""
+benchmark.py for the hn-sinc-NSF model in sinc_nsf.py
+
+Accuracy and throughput reports of the inference engines, compared
+against the reference implementation of each layer.
+
+Usage: $: python -m models.nsf.benchmark  (from the code/ directory)
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+
+import sys
+import time
+import torch
+
+from models.nsf import export
+from models.nsf import longform
+from models.nsf import quantize
+from models.nsf import receptive
+from models.nsf import sinc_nsf
+from models.nsf import tiers
+
+
+class _Args():
+    """ minimal arguments of sinc_nsf.Model
+    """
+    sr = 22050
+
+
+def load_model(m_path=None):
+    """ model = load_model(m_path=None)
+    Load a pickled sinc_nsf.Model on CPU (or create an untrained one
+    with the default configuration if m_path is None)
+    """
+    if m_path is None:
+        model = sinc_nsf.Model(7, 1, _Args())
+    else:
+        model = torch.load(m_path, map_location="cpu")
+    model.eval()
+    return model
+
+
+def random_features(length=40, batch=1):
+    """ random frame-level features in the range of the impact features
+        (rms, zcr, rolloff, flatness, bandwidth, centroid, f0)
+    """
+    scale = torch.tensor([0.1, 0.05, 1700, 0.1, 1000, 900, 300])
+    return torch.rand(batch, length, 7) * scale
+
+
+def _timeit(func, n_runs=10):
+    """ average duration (in seconds) of func() over n_runs calls
+    """
+    with torch.no_grad():
+        func()
+        st = time.perf_counter()
+        for _ in range(n_runs):
+            func()
+    return (time.perf_counter() - st) / n_runs
+
+
+def max_rel_err(output, ref):
+    """ max |output - ref| relative to max |ref|
+    """
+    return ((output - ref).abs().max()
+            / ref.abs().max().clamp(min=1e-12)).item()
+
+
+def compare_fir_engines(length=7680, order=31, batch=1, n_runs=10):
+    """ report = compare_fir_engines(length, order, batch, n_runs)
+    Compare the 'unfold' engine of TimeVarFIRFilter with the 'roll' loop
+
+    Both engines only differ by the order of the floating-point sums,
+    the outputs should match up to float32 rounding.
+    """
+    signal = torch.randn(batch, length, 1)
+    f_coef = torch.randn(batch, length, order) / order
+    report = {}
+    outputs = {}
+    for engine in ['roll', 'unfold']:
+        l_fir = sinc_nsf.TimeVarFIRFilter(engine)
+        with torch.no_grad():
+            outputs[engine] = l_fir(signal, f_coef)
+        report[engine] = _timeit(lambda: l_fir(signal, f_coef), n_runs)
+    report['max_rel_err'] = max_rel_err(outputs['unfold'], outputs['roll'])
+    report['match'] = report['max_rel_err'] < 1e-5
+    return report
+
+
+def report_sinc_table(table_sizes=(64, 256, 1024, 4096), order=31,
+                      length=7680, n_runs=10):
+    """ report = report_sinc_table(table_sizes, order, length, n_runs)
+    Accuracy and throughput of SincFilterBank against SincFilter
+
+    For each table size, with and without interpolation, give the
+    maximum absolute error on the filter coefficients and the duration
+    of one call on random cut-off frequencies in (0.1, 0.9).
+    """
+    cut_f = torch.rand(1, length, 1) * 0.8 + 0.1
+    l_sinc = sinc_nsf.SincFilter(order)
+    with torch.no_grad():
+        lp_ref, hp_ref = l_sinc(cut_f)
+    report = {'exact': _timeit(lambda: l_sinc(cut_f), n_runs)}
+    for table_size in table_sizes:
+        for interpolate in [False, True]:
+            l_table = sinc_nsf.SincFilterBank(order, table_size,
+                                              interpolate=interpolate)
+            with torch.no_grad():
+                lp_coef, hp_coef = l_table(cut_f)
+            err = max((lp_coef - lp_ref).abs().max().item(),
+                      (hp_coef - hp_ref).abs().max().item())
+            duration = _timeit(lambda: l_table(cut_f), n_runs)
+            name = "{:d}{:s}".format(table_size,
+                                     " interp" if interpolate else "")
+            report[name] = "max_abs_err {:.2e}, time {:.2e}s".format(
+                err, duration)
+    return report
+
+
+def check_streaming(model, length=40, steps=(1, 3, 15), rtol=1e-4,
+                    quality=None):
+    """ report = check_streaming(model, length, steps, rtol, quality)
+    Compare Model.forward_step, fed with steps of a few frames, with
+    Model.forward on the whole sequence (source noise disabled), both
+    with the given quality (sinc_nsf.Quality)
+    """
+    x = random_features(length)
+    flag_noise = model.get_source_noise()
+    model.set_source_noise(False)
+    report = {}
+    match = True
+    try:
+        with torch.no_grad():
+            ref = model(x, quality)
+            for step in steps:
+                state = model.init_state()
+                output = [model.forward_step(x[:, st:st + step], state,
+                                             flush=st + step >= length,
+                                             quality=quality)
+                          for st in range(0, length, step)]
+                output = torch.cat(output, dim=1)
+                err = max_rel_err(output, ref)
+                report[step] = "max_rel_err {:.2e}".format(err)
+                match = match and output.shape == ref.shape and err < rtol
+    finally:
+        model.set_source_noise(flag_noise)
+    report['match'] = match
+    return report
+
+
+def check_sine_continuity(n_chunks=64, chunk=7680, harmonic_num=16,
+                          rtol=1e-4):
+    """ report = check_sine_continuity(n_chunks, chunk, harmonic_num, rtol)
+    Generate n_chunks chunks with the continuous mode of SineGen and
+    compare them with a single call on the whole F0 sequence (noise
+    disabled). The time per chunk should not grow with the position
+    of the chunk in the sequence.
+    """
+    l_sin_gen = sinc_nsf.SineGen(22050, harmonic_num)
+    l_sin_gen.flag_noise = False
+    f0 = torch.repeat_interleave(
+        torch.rand(1, n_chunks * chunk // 512, 1) * 400 + 50, 512, dim=1)
+    with torch.no_grad():
+        ref, _, _ = l_sin_gen(f0)
+        l_sin_gen.flag_continuous = True
+        l_sin_gen.reset_phase()
+        output = []
+        durations = []
+        for st in range(0, f0.shape[1], chunk):
+            tic = time.perf_counter()
+            output.append(l_sin_gen(f0[:, st:st + chunk])[0])
+            durations.append(time.perf_counter() - tic)
+    output = torch.cat(output, dim=1)
+    err = max_rel_err(output, ref)
+    quarter = max(1, n_chunks // 4)
+    return {'max_rel_err': err,
+            'first chunks (s)': sum(durations[:quarter]) / quarter,
+            'last chunks (s)': sum(durations[-quarter:]) / quarter,
+            'match': err < rtol}
+
+
+def report_filter_block_cost(model, block_sizes=(128, 512, 2048, 7680),
+                             n_blocks=8):
+    """ report = report_filter_block_cost(model, block_sizes, n_blocks)
+    Steady-state time of FilterModuleHnSincNSF.forward_step per block
+    of samples: with the dilation caches, the time per sample should
+    not depend on the receptive field of the dilated convolutions
+    """
+    m_filter = model.m_filter
+    hidden_dim = m_filter.hidden_size
+    report = {}
+    for block in block_sizes:
+        har = torch.randn(1, block, 1)
+        noi = torch.randn(1, block, 1)
+        cond = torch.randn(1, block, hidden_dim)
+        cut_f = torch.rand(1, block, 1) * 0.8 + 0.1
+        state = m_filter.init_state()
+        with torch.no_grad():
+            # warm-up: fill the caches
+            m_filter.forward_step(har, noi, cond, cut_f, state)
+        duration = _timeit(
+            lambda: m_filter.forward_step(har, noi, cond, cut_f, state),
+            n_blocks)
+        report[block] = "{:.2e}s per block, {:.2e}s per sample".format(
+            duration, duration / block)
+    return report
+
+
+def report_concurrent_branches(model, block_sizes=(512, 2048, 7680),
+                               n_blocks=8, length=15):
+    """ report = report_concurrent_branches(model, block_sizes, n_blocks,
+                                           length)
+    Serial vs concurrent harmonic / noise branches: steady-state time of
+    FilterModuleHnSincNSF.forward_step per block of samples (worker
+    thread) and of the TorchScript graph on length frames (jit.fork).
+    The concurrent mode only helps when spare cores are available
+    beyond the intra-op threads of the small matrix products
+    """
+    m_filter = model.m_filter
+    hidden_dim = m_filter.hidden_size
+    report = {'threads (intra-op, inter-op)': (torch.get_num_threads(),
+                                               torch.get_num_interop_threads())}
+    for block in block_sizes:
+        har = torch.randn(1, block, 1)
+        noi = torch.randn(1, block, 1)
+        cond = torch.randn(1, block, hidden_dim)
+        cut_f = torch.rand(1, block, 1) * 0.8 + 0.1
+        durations = []
+        for flag in (False, True):
+            m_filter.set_concurrent_branches(flag)
+            state = m_filter.init_state()
+            with torch.no_grad():
+                m_filter.forward_step(har, noi, cond, cut_f, state)
+            durations.append(_timeit(
+                lambda: m_filter.forward_step(har, noi, cond, cut_f, state),
+                n_blocks))
+        m_filter.set_concurrent_branches(False)
+        report[block] = "serial {:.2e}s, concurrent {:.2e}s, x{:.2f}".format(
+            durations[0], durations[1], durations[0] / durations[1])
+    x = random_features(length)
+    durations = []
+    for flag in (False, True):
+        script_model = torch.jit.freeze(torch.jit.script(
+            export.ScriptNSF(model, concurrent_branches=flag).eval()))
+        durations.append(_timeit(lambda: script_model(x), n_blocks))
+    report['torchscript {:d} frames'.format(length)] = \
+        "serial {:.2e}s, concurrent {:.2e}s, x{:.2f}".format(
+            durations[0], durations[1], durations[0] / durations[1])
+    report['max_rel_err'] = export.check_export(model,
+                                                concurrent_branches=True)
+    return report
+
+
+def report_fused_upsampling(model, lengths=(15, 300), n_runs=5,
+                            rtol=1e-4):
+    """ report = report_fused_upsampling(model, lengths, n_runs, rtol)
+    Condition module with the up-sampling layers and moving averages
+    vs the closed-form FusedUpSampling: time per call and max difference
+    of the outputs (context, F0, cut-off frequency), relative to the
+    largest value of each output (the context reaches a few hundreds)
+    """
+    m_cond = model.m_cond
+    fused = 'l_fused_upsamp' in m_cond._modules
+    report = {}
+    match = True
+    for length in lengths:
+        features = random_features(length)
+        x = model.normalize_input(features)
+        f0 = features[:, :, -1:]
+        m_cond.remove_fused_upsampling()
+        with torch.no_grad():
+            ref = m_cond(x, f0)
+        layers = _timeit(lambda: m_cond(x, f0), n_runs)
+        m_cond.build_fused_upsampling()
+        with torch.no_grad():
+            output = m_cond(x, f0)
+        closed_form = _timeit(lambda: m_cond(x, f0), n_runs)
+        err = max([max_rel_err(o, r) for o, r in zip(output, ref)])
+        report[length] = "layers {:.2e}s, fused {:.2e}s, x{:.1f}, " \
+                         "max_rel_err {:.2e}".format(
+                             layers, closed_form, layers / closed_form, err)
+        match = match and err < rtol
+    if not fused:
+        m_cond.remove_fused_upsampling()
+    report['match'] = match
+    return report
+
+
+def report_seeded_noise(model, length=40, step=7, n_runs=10, seed=0,
+                        rtol=1e-4, chunk_rtol=1e-3):
+    """ report = report_seeded_noise(model, length, step, n_runs, seed,
+                                     rtol, chunk_rtol)
+    Source noise read from a seeded NoiseTable: two renders of the same
+    features (bit-identical), streaming (step frames per call), chunked
+    generation with exact context and the exported graph against
+    model(x), all with the noise on, and time of the source module with
+    random noise vs the table. The chunks are compared with chunk_rtol
+    (see receptive.check_chunked)
+    """
+    x = random_features(length)
+    sin_gen = model.m_source.l_sin_gen
+    seeded = 'l_noise_table' in sin_gen._modules
+    model.set_noise_table(None)
+    with torch.no_grad():
+        f0 = model.m_cond(model.normalize_input(x), x[:, :, -1:])[1]
+        random_noise = _timeit(lambda: model.m_source(f0), n_runs)
+    model.set_noise_table(seed)
+    with torch.no_grad():
+        table_noise = _timeit(lambda: model.m_source(f0), n_runs)
+        ref = model(x)
+        identical = torch.equal(ref, model(x))
+        state = model.init_state()
+        output = torch.cat([model.forward_step(
+            x[:, st:st + step], state, flush=st + step >= length)
+            for st in range(0, length, step)], dim=1)
+        stream_err = max_rel_err(output, ref)
+        chunk_err = max_rel_err(receptive.generate_chunked(model, x), ref)
+        script_model = torch.jit.freeze(torch.jit.script(
+            export.ScriptNSF(model).eval()))
+        script_err = max_rel_err(script_model(x), ref)
+    if not seeded:
+        model.set_noise_table(None)
+    return {'bit-identical renders': identical,
+            'streaming max_rel_err': stream_err,
+            'chunked max_rel_err': chunk_err,
+            'torchscript max_rel_err': script_err,
+            'source (s)': "random {:.2e}, table {:.2e}".format(
+                random_noise, table_noise),
+            'match': identical and max(stream_err, script_err) < rtol
+                     and chunk_err < chunk_rtol}
+
+
+def report_voice_batching(model, voices=(1, 2, 4), step=15, n_steps=3):
+    """ report = report_voice_batching(model, voices, step, n_steps)
+    Steady-state time of Model.forward_step for a batch of N voices
+    (step frames per call), against N times the time of one voice
+    """
+    report = {}
+    single = None
+    for n_voices in voices:
+        x = random_features(step * (n_steps + 2), n_voices)
+        state = model.init_state()
+        with torch.no_grad():
+            # warm-up: first steps have a different state structure
+            model.forward_step(x[:, :step], state)
+            model.forward_step(x[:, step:2 * step], state)
+        pos = [2 * step]
+
+        def _step():
+            model.forward_step(x[:, pos[0]:pos[0] + step], state)
+            pos[0] += step
+        duration = _timeit(_step, n_steps - 1)
+        if single is None:
+            single = duration
+        report[n_voices] = "{:.2e}s per step, {:.2f}x one voice".format(
+            duration, duration / single)
+    return report
+
+
+def report_quality_tiers(model):
+    """ report = report_quality_tiers(model)
+    Cost and quality of the tiers of tiers.TIERS (tiers.report_tiers),
+    and streaming against model(x) on the fastest tier
+    """
+    tier_set = tiers.TierSet(model)
+    report = tiers.report_tiers(tier_set)
+    tier_model, quality = tier_set.get(tier_set.names[-1])
+    stream_report = check_streaming(tier_model, quality=quality)
+    report['match'] = stream_report['match']
+    return report
+
+
+def report_export(model, length=40, n_runs=5, rtol=1e-4):
+    """ report = report_export(model, length, n_runs, rtol)
+    Accuracy of the exported TorchScript graph (source noise disabled)
+    and CPU time of one forward pass, against the pickled model
+    """
+    x = random_features(length)
+    err = export.check_export(model, length=length)
+    script_model = torch.jit.freeze(torch.jit.script(
+        export.ScriptNSF(model).eval()))
+    script_model = torch.jit.optimize_for_inference(script_model)
+    return {'max_rel_err': err,
+            'model (s)': _timeit(lambda: model(x), n_runs),
+            'torchscript (s)': _timeit(lambda: script_model(x), n_runs),
+            'match': err < rtol}
+
+
+def report_quantization(model, length=80, n_calib=3):
+    """ report = report_quantization(model, length, n_calib)
+    Quality (SNR, spectral distance) and speedup of the int8 profile,
+    calibrated on the cached impact features if any, else random ones
+    """
+    features_list = quantize.load_calibration_features()
+    if len(features_list) == 0:
+        features_list = [random_features(length) for _ in range(n_calib)]
+    q_model = quantize.quantize_model(model, features_list)
+    return quantize.quality_report(model, q_model, features_list)
+
+
+def report_long_render(model, length=300, targets_mb=(192, 256, 384),
+                       rtol=1e-4):
+    """ report = report_long_render(model, length, targets_mb, rtol)
+    Memory-bounded rendering against model(x) (source noise disabled):
+    calibrated memory model, frames per step, estimated / measured peak
+    memory (MB) and real-time factor for each memory target, peak
+    memory of the full forward pass. Matches when the outputs are equal
+    and the measured peaks are within the targets
+    """
+    x = random_features(length)
+    mb = 1024.0 * 1024.0
+    flag_noise = model.get_source_noise()
+    model.set_source_noise(False)
+    try:
+        with torch.no_grad():
+            ref = model(x)
+        costs = longform.memory_model(model, x)
+        report = {'memory model': "{:.1f} MB + {:.1f} MB per frame".format(
+            costs[0] / mb, costs[1] / mb)}
+        match = True
+        for target in targets_mb:
+            output, long_report = longform.render_long(model, x,
+                                                       int(target * mb),
+                                                       costs=costs)
+            err = max_rel_err(torch.from_numpy(output), ref)
+            measured = long_report['measured peak (bytes)']
+            report["{:d} MB".format(target)] = \
+                "{:d} frames/step, estimated {:.1f} MB, measured {}, " \
+                "rtf {:.3f}, max_rel_err {:.2e}".format(
+                    long_report['frames per step'],
+                    long_report['estimated peak (bytes)'] / mb,
+                    "n/a" if measured is None else "{:.1f} MB".format(
+                        measured / mb),
+                    long_report['real-time factor'], err)
+            match = match and err < rtol and \
+                    (measured is None or measured <= target * mb)
+    finally:
+        model.set_source_noise(flag_noise)
+    full_peak = longform.full_forward_peak(model, x)
+    report['full forward'] = "n/a" if full_peak is None \
+                             else "{:.1f} MB".format(full_peak / mb)
+    report['match'] = match
+    return report
+
+
+def _print_report(title, report):
+    print(title)
+    for k, v in report.items():
+        print("  {:s}: {}".format(str(k), v))
+
+
+def _check(title, report, failures):
+    """ print a report with a 'match' entry, its title is added to
+        failures if it does not match
+    """
+    _print_report(title, report)
+    if not report['match']:
+        failures.append(title)
+
+
+if __name__ == "__main__":
+    # every check runs, the failures are listed at the end
+    failures = []
+    _check("TimeVarFIRFilter engines", compare_fir_engines(), failures)
+    _print_report("SincFilterBank (cut-off table)", report_sinc_table())
+    _check("SineGen continuous phase", check_sine_continuity(), failures)
+    model = load_model(sys.argv[1] if len(sys.argv) > 1 else None)
+    _check("Streaming inference (frames per step)", check_streaming(model),
+           failures)
+    _print_report("Receptive field", receptive.receptive_field(model))
+    _check("Chunked generation with exact context (frames per chunk)",
+           receptive.check_chunked(model), failures)
+    _check("Closed-form up-sampling of the condition (frames)",
+           report_fused_upsampling(model), failures)
+    _check("Seeded source noise", report_seeded_noise(model), failures)
+    _print_report("Filter module streaming cost (samples per block)",
+                  report_filter_block_cost(model))
+    _print_report("Concurrent filter branches (samples per block)",
+                  report_concurrent_branches(model))
+    _print_report("Batched voices (steady state)",
+                  report_voice_batching(model))
+    _check("Quality tiers (streaming step of 15 frames)",
+           report_quality_tiers(model), failures)
+    _check("TorchScript export", report_export(model), failures)
+    _print_report("Int8 quantized profile", report_quantization(model))
+    _check("Memory-bounded long-form rendering (peak target)",
+           report_long_render(model), failures)
+    if len(failures) > 0:
+        print("Failed: " + "; ".join(failures))
+        sys.exit(1)
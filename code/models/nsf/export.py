@@ -0,0 +1,401 @@
+#!/usr/bin/env python
+"""
+export.py for the hn-sinc-NSF model in sinc_nsf.py
+
+Export a trained sinc_nsf.Model to a TorchScript (and optionally ONNX)
+inference artifact:
+ - the input normalization (input_mean, input_std) is folded into the
+   weights of the first convolution of the condition module
+ - the sinc filters are read from a SincFilterBank table
+ - the up-sampling and smoothing of the condition module are computed
+   in closed form from the frames (sinc_nsf.FusedUpSampling)
+ - the dilated convolutions run in channel-first layout, the graph is
+   frozen and optimized for inference (fusing conv + activation where
+   the backend supports it)
+
+Usage: $: python -m models.nsf.export model.th model.ts [--onnx model.onnx]
+       (from the code/ directory)
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+
+import argparse
+import numpy as np
+import torch
+import torch.nn as torch_nn
+import torch.nn.functional as torch_nn_func
+from typing import Optional
+
+from models.nsf import receptive
+from models.nsf import sinc_nsf
+
+
+def _plain_conv(l_conv, weight=None, bias=None):
+    """ copy of a Conv1dKeepLength as a torch.nn.Conv1d without padding
+    """
+    conv = torch_nn.Conv1d(int(l_conv.in_channels),
+                           int(l_conv.out_channels),
+                           int(l_conv.kernel_size[0]), padding=0,
+                           dilation=int(l_conv.dilation[0]),
+                           groups=int(l_conv.groups),
+                           bias=l_conv.bias is not None or bias is not None)
+    with torch.no_grad():
+        conv.weight.copy_(l_conv.weight if weight is None else weight)
+        if bias is not None:
+            conv.bias.copy_(bias)
+        elif l_conv.bias is not None:
+            conv.bias.copy_(l_conv.bias)
+    return conv
+
+
+class ScriptFilterBlock(torch_nn.Module):
+    """ NeuralFilterBlock in channel-first layout, scriptable
+    """
+    def __init__(self, block):
+        super(ScriptFilterBlock, self).__init__()
+        self.l_ff_1 = block.l_ff_1
+        self.l_ff_2 = block.l_ff_2
+        self.l_ff_3 = block.l_ff_3
+        self.l_convs = torch_nn.ModuleList(
+            [_plain_conv(l_conv) for l_conv in block.l_convs])
+        self.pads = [int(l_conv.pad_le) for l_conv in block.l_convs]
+        self.scale = float(block.scale.item())
+
+    def forward(self, signal, context):
+        """ signal (batchsize, length, 1)
+            context (batchsize, hidden_size, length), channel-first
+        """
+        hidden = torch.tanh(self.l_ff_1(signal)).transpose(1, 2)
+        idx = 0
+        for l_conv in self.l_convs:
+            tmp = torch_nn_func.pad(hidden, [self.pads[idx], 0])
+            hidden = hidden + torch.tanh(l_conv(tmp)) + context
+            idx += 1
+        hidden = hidden.transpose(1, 2) * self.scale
+        hidden = torch.tanh(self.l_ff_2(hidden))
+        hidden = torch.tanh(self.l_ff_3(hidden))
+        return hidden + signal
+
+
+class ScriptNSF(torch_nn.Module):
+    """ Inference-only, scriptable copy of a sinc_nsf.Model
+    ScriptNSF(model, table_size = 1024, flag_noise = True,
+              concurrent_branches = False)
+
+    model: trained sinc_nsf.Model
+    table_size: size of the SincFilterBank table of the sinc filters
+    flag_noise: use source noise (False for deterministic output)
+    concurrent_branches: run the harmonic branch as an inter-op task
+               (torch.jit.fork) concurrently with the noise branch
+
+    output = ScriptNSF(x, phase_ini=None, noise_offset=None), same as
+             model(x)
+    x: (batchsize, length, dim), output: (batchsize, length * up_sample)
+    phase_ini: initial phase of the sines (batchsize, harmonic_num + 1),
+               to generate a chunk of a longer sequence: see frame_phase
+               and context_frames (receptive.py)
+    noise_offset: position of the first sample of x (batchsize,) in the
+               seeded noise table, when the model has one (see
+               Model.set_noise_table, noise_table_size > 0): with
+               initial_phase, windows of a sound are the same as the
+               pickled model on the whole sound
+    """
+    def __init__(self, model, table_size=1024, flag_noise=True,
+                 concurrent_branches=False):
+        super(ScriptNSF, self).__init__()
+        m_cond = model.m_cond
+        sin_gen = model.m_source.l_sin_gen
+        m_filter = model.m_filter
+        with torch.no_grad():
+            in_m = model.input_mean.detach().float()
+            in_s = model.input_std.detach().float()
+
+            # first convolution on normalized input:
+            #  conv(W, pad_0((x - m) / s)) + b
+            #  = conv(W / s, pad_m(x)) + b - sum(W * m / s)
+            l_conv = m_cond.l_conv1ds[0]
+            weight = l_conv.weight / in_s.view(1, -1, 1)
+            bias = l_conv.bias - torch.sum(weight * in_m.view(1, -1, 1),
+                                           dim=(1, 2))
+            self.l_conv_in = _plain_conv(l_conv, weight, bias)
+            self.register_buffer('pad_value', in_m.view(1, -1, 1).clone())
+            self.conv_in_pads = [int(l_conv.pad_le), int(l_conv.pad_ri)]
+            # normalized F0 for the smoothed F0 branch
+            self.f0_scale = float(1.0 / in_s[-1].item())
+            self.f0_shift = float(-in_m[-1].item() / in_s[-1].item())
+        self.l_convs = torch_nn.ModuleList(
+            [_plain_conv(l_conv) for l_conv in m_cond.l_conv1ds[1:]])
+        self.conv_pads = [int(l_conv.pad_le) for l_conv in m_cond.l_conv1ds[1:]]
+
+        # condition module configuration
+        self.up_sample = m_cond.up_sample
+        self.l_fused_upsamp = sinc_nsf.FusedUpSampling(m_cond)
+
+        # source module
+        self.sampling_rate = float(sin_gen.sampling_rate)
+        self.sine_amp = float(sin_gen.sine_amp)
+        self.noise_std = float(sin_gen.noise_std)
+        self.sin_voiced_threshold = float(sin_gen.voiced_threshold)
+        self.register_buffer('harmonics', torch.arange(
+            1, sin_gen.dim + 1, dtype=torch.float32))
+        self.l_source_linear = model.m_source.l_linear
+        self.flag_noise = flag_noise
+        if 'l_noise_table' in sin_gen._modules:
+            l_noise = sin_gen.l_noise_table
+            self.register_buffer('noise_table', l_noise.table.detach().cpu())
+            self.register_buffer('noise_phase', l_noise.phase.detach().cpu())
+            self.noise_table_size = int(l_noise.size)
+        else:
+            self.register_buffer('noise_table', torch.zeros(0, sin_gen.dim + 1))
+            self.register_buffer('noise_phase', torch.zeros(sin_gen.dim + 1))
+            self.noise_table_size = 0
+
+        # filter module
+        self.l_har_blocks = torch_nn.ModuleList(
+            [ScriptFilterBlock(blk) for blk in m_filter.l_har_blocks])
+        self.l_noi_blocks = torch_nn.ModuleList(
+            [ScriptFilterBlock(blk) for blk in m_filter.l_noi_blocks])
+        l_table = sinc_nsf.SincFilterBank(m_filter.sinc_order, table_size)
+        self.register_buffer('sinc_table', l_table.table)
+        self.register_buffer('sinc_table_diff', l_table.table_diff)
+        self.sinc_order = l_table.order
+        self.cut_f_min = float(l_table.cut_f_min)
+        self.cut_f_step = float(l_table.cut_f_step)
+        self.table_size = table_size
+        self.chunk_size = m_filter.l_tv_filtering.chunk_size
+        self.concurrent_branches = concurrent_branches
+
+        # frames of context around a chunk for exact chunked generation
+        rf = receptive.receptive_field(model)
+        self.context_frames = [int(rf['left_frames']),
+                               int(rf['right_frames'])]
+
+    def _condition(self, x):
+        """ context (channel-first), f0_upsamp, cut_f
+        """
+        batch = x.shape[0]
+        tmp = x.transpose(1, 2)
+        tmp = torch.cat([self.pad_value.expand(batch, -1,
+                                               self.conv_in_pads[0]),
+                         tmp,
+                         self.pad_value.expand(batch, -1,
+                                               self.conv_in_pads[1])], dim=2)
+        tmp = torch.tanh(self.l_conv_in(tmp))
+        idx = 0
+        for l_conv in self.l_convs:
+            pad = self.conv_pads[idx]
+            tmp = torch.tanh(l_conv(torch_nn_func.pad(tmp, [pad, pad])))
+            idx += 1
+        # closed-form up-sampling and smoothing (channel-last)
+        f0 = x[:, :, -1:]
+        context, f0_upsamp, cut_f, _ = self.l_fused_upsamp(
+            tmp.transpose(1, 2), f0 * self.f0_scale + self.f0_shift, f0)
+        context = context.transpose(1, 2)
+        return context, f0_upsamp, cut_f
+
+    @torch.jit.export
+    def frame_phase(self, f0):
+        """ phase_ini of the sines after the frames f0 (batchsize, length, 1)
+            (same as SineGen.frame_phase)
+        """
+        rad_values = (f0 * self.harmonics / self.sampling_rate) % 1
+        return (torch.sum(rad_values.double() * self.up_sample, dim=1)
+                % 1).float()
+
+    def _noise(self, batch: int, length: int,
+               noise_offset: Optional[torch.Tensor]):
+        """ (batchsize, length, harmonic_num + 2) rows of the noise table
+        """
+        idx = torch.arange(length, device=self.noise_table.device)
+        if noise_offset is None:
+            idx = idx.unsqueeze(0).expand(batch, length)
+        else:
+            idx = noise_offset.view(-1, 1) + idx
+        return self.noise_table[idx % self.noise_table_size]
+
+    @torch.jit.export
+    def initial_phase(self, f0):
+        """ phase_ini of the sines at the first frame of a sound, for a
+            batch of F0 f0 (batchsize, length, 1): the start of the noise
+            table if set, 0 otherwise (same as SineGen._rand_ini)
+        """
+        phase = torch.zeros(f0.shape[0], self.harmonics.shape[0],
+                            device=f0.device)
+        if self.flag_noise and self.noise_table_size > 0:
+            phase[:, 1:] = self.noise_phase[1:self.harmonics.shape[0]]
+        return phase
+
+    def _source(self, f0, phase_ini: Optional[torch.Tensor],
+                noise_offset: Optional[torch.Tensor]):
+        """ harmonic source, noise source
+        """
+        rad_values = (f0 * self.harmonics / self.sampling_rate) % 1
+        if phase_ini is not None:
+            rad_values[:, 0, :] = rad_values[:, 0, :] + phase_ini
+        elif self.flag_noise:
+            if self.noise_table_size > 0:
+                rand_ini = self.noise_phase[0:rad_values.shape[2]].expand(
+                    f0.shape[0], rad_values.shape[2]).clone()
+            else:
+                rand_ini = torch.rand(f0.shape[0], rad_values.shape[2],
+                                      device=f0.device)
+            rand_ini[:, 0] = 0
+            rad_values[:, 0, :] = rad_values[:, 0, :] + rand_ini
+        tmp_over_one = torch.cumsum(rad_values, 1) % 1
+        tmp_over_one_idx = (tmp_over_one[:, 1:, :]
+                            - tmp_over_one[:, :-1, :]) < 0
+        cumsum_shift = torch.zeros_like(rad_values)
+        cumsum_shift[:, 1:, :] = tmp_over_one_idx.float() * -1.0
+        sines = torch.sin(torch.cumsum(rad_values + cumsum_shift, dim=1)
+                          * 2 * np.pi) * self.sine_amp
+
+        uv = (f0 > self.sin_voiced_threshold).float()
+        noise_amp = uv * self.noise_std + (1 - uv) * self.sine_amp / 3
+        if self.flag_noise and self.noise_table_size > 0:
+            table = self._noise(f0.shape[0], f0.shape[1], noise_offset)
+            dim = sines.shape[2]
+            sines = sines * uv + noise_amp * table[:, :, 0:dim]
+            noise = table[:, :, dim:dim + 1] * self.sine_amp / 3
+        elif self.flag_noise:
+            sines = sines * uv + noise_amp * torch.randn_like(sines)
+            noise = torch.randn_like(uv) * self.sine_amp / 3
+        else:
+            sines = sines * uv
+            noise = torch.zeros_like(uv)
+        return torch.tanh(self.l_source_linear(sines)), noise
+
+    def _sinc_coef(self, cut_f):
+        pos = (cut_f[:, :, 0] - self.cut_f_min) / self.cut_f_step
+        pos = torch.clamp(pos, 0.0, float(self.table_size - 1))
+        idx = torch.floor(pos)
+        weight = (pos - idx).unsqueeze(-1)
+        idx = idx.long()
+        coef = self.sinc_table[idx] + weight * self.sinc_table_diff[idx]
+        return coef[:, :, 0:self.sinc_order], coef[:, :, self.sinc_order:]
+
+    def _tv_filtering(self, signal, f_coef):
+        order_k = f_coef.shape[-1]
+        signal_l = signal.shape[1]
+        padded_signal = torch_nn_func.pad(signal, [0, 0, order_k - 1, 0])
+        y = torch.empty_like(signal)
+        for st in range(0, signal_l, self.chunk_size):
+            ed = min(st + self.chunk_size, signal_l)
+            windows = padded_signal[:, st:ed + order_k - 1, :].unfold(
+                1, order_k, 1)
+            rev_coef = torch.flip(f_coef[:, st:ed, :], dims=[2]).unsqueeze(-1)
+            y[:, st:ed, :] = torch.matmul(windows, rev_coef).squeeze(-1)
+        return y
+
+    def _har_branch(self, har_component, context, lp_coef):
+        for l_blk in self.l_har_blocks:
+            har_component = l_blk(har_component, context)
+        return self._tv_filtering(har_component, lp_coef)
+
+    def _noi_branch(self, noi_component, context, hp_coef):
+        for l_blk in self.l_noi_blocks:
+            noi_component = l_blk(noi_component, context)
+        return self._tv_filtering(noi_component, hp_coef)
+
+    def forward(self, x, phase_ini: Optional[torch.Tensor] = None,
+                noise_offset: Optional[torch.Tensor] = None):
+        context, f0_upsamp, cut_f = self._condition(x)
+        har_component, noi_component = self._source(f0_upsamp, phase_ini,
+                                                     noise_offset)
+        lp_coef, hp_coef = self._sinc_coef(cut_f)
+        if self.concurrent_branches:
+            har_future = torch.jit.fork(self._har_branch, har_component,
+                                        context, lp_coef)
+            noi_signal = self._noi_branch(noi_component, context, hp_coef)
+            output = torch.jit.wait(har_future) + noi_signal
+        else:
+            output = self._har_branch(har_component, context, lp_coef) \
+                     + self._noi_branch(noi_component, context, hp_coef)
+        return output.squeeze(-1)
+
+
+def export_torchscript(model, ts_path, table_size=1024, optimize=True,
+                       concurrent_branches=False):
+    """ script_model = export_torchscript(model, ts_path, table_size,
+                                         optimize, concurrent_branches)
+    Script, freeze and save a sinc_nsf.Model to ts_path (CPU)
+    """
+    model = model.cpu().eval()
+    script_model = torch.jit.script(
+        ScriptNSF(model, table_size,
+                  concurrent_branches=concurrent_branches).eval())
+    if optimize:
+        script_model = torch.jit.freeze(
+            script_model, preserved_attrs=['context_frames', 'frame_phase',
+                                           'initial_phase',
+                                           'noise_table_size'])
+        script_model = torch.jit.optimize_for_inference(script_model)
+    torch.jit.save(script_model, ts_path)
+    return script_model
+
+
+def export_onnx(model, onnx_path, table_size=1024, length=16):
+    """ export_onnx(model, onnx_path, table_size, length)
+    Export a sinc_nsf.Model to ONNX, with dynamic batch and length axes
+    """
+    model = model.cpu().eval()
+    example = torch.ones(1, length, model.input_dim)
+    torch.onnx.export(ScriptNSF(model, table_size).eval(), (example,),
+                      onnx_path, input_names=['features'],
+                      output_names=['waveform'],
+                      dynamic_axes={'features': {0: 'batch', 1: 'frames'},
+                                    'waveform': {0: 'batch', 1: 'samples'}},
+                      opset_version=13)
+
+
+def check_export(model, table_size=1024, length=16,
+                 concurrent_branches=False):
+    """ err = check_export(model, table_size, length, concurrent_branches)
+    Maximum difference between the frozen TorchScript graph and the
+    original model on random features, with the source noise disabled,
+    relative to the largest absolute value of the original output
+    """
+    scale = torch.tensor([0.1, 0.05, 1700, 0.1, 1000, 900, 300])
+    x = torch.rand(1, length, model.input_dim) * scale[:model.input_dim]
+    script_model = torch.jit.freeze(torch.jit.script(
+        ScriptNSF(model, table_size, flag_noise=False,
+                  concurrent_branches=concurrent_branches).eval()))
+    flag_noise = model.get_source_noise()
+    model.set_source_noise(False)
+    try:
+        with torch.no_grad():
+            ref = model(x)
+            output = script_model(x)
+    finally:
+        model.set_source_noise(flag_noise)
+    return ((ref - output).abs().max()
+            / ref.abs().max().clamp(min=1e-12)).item()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Export NSF model')
+    parser.add_argument('checkpoint', type=str, help='pickled sinc_nsf.Model')
+    parser.add_argument('output', type=str, help='TorchScript artifact')
+    parser.add_argument('--onnx', type=str, default=None,
+                        help='optional ONNX artifact')
+    parser.add_argument('--table_size', type=int, default=1024,
+                        help='size of the sinc filter table')
+    parser.add_argument('--concurrent', action='store_true',
+                        help='run the harmonic and noise branches '
+                             'concurrently (inter-op parallelism)')
+    parser.add_argument('--noise_seed', type=int, default=None,
+                        help='seeded source noise table (reproducible '
+                             'renders), random noise if not given')
+    args = parser.parse_args()
+    nsf_model = torch.load(args.checkpoint, map_location="cpu")
+    nsf_model.eval()
+    if args.noise_seed is not None:
+        nsf_model.set_noise_table(args.noise_seed)
+    print("Max relative error of the exported graph: {:.2e}".format(
+        check_export(nsf_model, args.table_size,
+                     concurrent_branches=args.concurrent)))
+    export_torchscript(nsf_model, args.output, args.table_size,
+                       concurrent_branches=args.concurrent)
+    print("Saved " + args.output)
+    if args.onnx is not None:
+        export_onnx(nsf_model, args.onnx, args.table_size)
+        print("Saved " + args.onnx)
@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+"""
+longform.py for the hn-sinc-NSF model in sinc_nsf.py
+
+Memory-bounded rendering of long feature sequences
+
+Model.forward on L frames holds (batchsize, L * up_sample, dim) tensors
+in every layer (sinc filter coefficients, hidden features of the filter
+blocks, ...). render_long() streams the sequence through
+Model.forward_step instead, a few frames at a time: the context of the
+layers is carried in the streaming state, the output is the same as
+Model.forward, and the memory only depends on the number of frames per
+step, chosen to fit a peak memory target. The memory of a step is
+measured on short renders (memory_model): the streaming state and the
+look-ahead frames released by the last step set a floor, about 100 MB
+for the impacts model on CPU (more in a process whose heap is already
+fragmented).
+
+Usage: $: python -m models.nsf.longform model.th [frames] [target_MB]
+       (from the code/ directory)
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+
+import ctypes
+import os
+import sys
+import threading
+import time
+import numpy as np
+import torch
+
+from models.nsf import receptive
+
+
+def estimate_memory(model, batch=1):
+    """ fixed, per_frame = estimate_memory(model, batch=1)
+    Estimated memory (bytes) of render_long with n frames per step,
+    fixed + per_frame * n, when it cannot be measured (memory_model)
+
+    fixed:     streaming state (dilation caches of the filter blocks)
+               and the last step, which also releases the look-ahead
+               frames of the condition module
+    per_frame: buffers of the new samples in the dilation caches, live
+               hidden features (filter blocks and condition module),
+               sines of the harmonics (float64 phase accumulation), sinc
+               filter coefficients and FIR temporaries
+    """
+    m_filter = model.m_filter
+    hidden = m_filter.hidden_size
+    blocks = list(m_filter.l_har_blocks) + list(m_filter.l_noi_blocks)
+    n_convs = sum([len(blk.l_convs) for blk in blocks])
+    span = sum([int(l_conv.pad_le) for blk in blocks for l_conv in blk.l_convs])
+    harmonic_dim = model.m_source.l_sin_gen.dim
+    order = m_filter.sinc_order
+    up_sample = int(model.m_cond.up_sample)
+    per_frame = 4 * up_sample * (hidden * (n_convs + 8) + 10 * harmonic_dim
+                                 + 6 * order + 16)
+    look_ahead = receptive.receptive_field(model)['right_frames']
+    fixed = 4 * hidden * span + per_frame * look_ahead
+    return batch * fixed, batch * per_frame
+
+
+def measure_peak(model, x, step, n_runs=2):
+    """ peak = measure_peak(model, x, step, n_runs=2)
+    Largest peak memory (bytes) of n_runs short streaming renders of the
+    first frames of x (batchsize, length, dim) with step frames per
+    step: steady steps once the look-ahead of the condition module is
+    filled, then the last step, which also releases the look-ahead
+    frames. None if the memory cannot be measured (see _PeakMemory)
+    """
+    look_ahead = receptive.receptive_field(model)['right_frames']
+    length = look_ahead + 3 * step
+    x_cal = x[:, torch.arange(length, device=x.device) % x.shape[1]]
+    peak = None
+    for _ in range(n_runs):
+        measure = _PeakMemory(x.device)
+        measure.start()
+        _stream(model, x_cal, step)
+        run_peak = measure.stop()
+        if run_peak is None:
+            return None
+        peak = run_peak if peak is None else max(peak, run_peak)
+    return peak
+
+
+def memory_model(model, x, steps=(1, 8)):
+    """ fixed, per_frame = memory_model(model, x, steps=(1, 8))
+    Peak memory (bytes) of render_long with n frames per step,
+    fixed + per_frame * n, fitted on the peaks measured with steps
+    frames per step (measure_peak)
+
+    The measured peaks include the streaming state (dilation caches,
+    condition module), the look-ahead frames released by the last step
+    and the overhead of the allocator. A first render, not measured,
+    does the one-time initializations of torch. Falls back to
+    estimate_memory() when the memory cannot be measured
+    """
+    _stream(model, x[:, :steps[0]], steps[0])
+    peaks = [measure_peak(model, x, step) for step in steps]
+    if None in peaks:
+        return estimate_memory(model, x.shape[0])
+    per_frame = max(1, (peaks[-1] - peaks[0]) // (steps[-1] - steps[0]))
+    return max(0, peaks[0] - per_frame * steps[0]), per_frame
+
+
+def frames_for_budget(model, peak_bytes, x, max_frames=None, costs=None,
+                      margin=0.3, n_checks=3):
+    """ frames = frames_for_budget(model, peak_bytes, x, max_frames, costs,
+                                   margin, n_checks)
+    Largest number of frames per step whose memory fits in peak_bytes
+    (at least 1 frame), costs = (fixed, per_frame) from memory_model(),
+    measured on x if None
+
+    The memory does not grow exactly linearly with the frames per step
+    (allocator): the number of frames given by costs is checked with
+    measure_peak() and scaled down while its peak does not fit, up to
+    n_checks times. The fraction margin of peak_bytes is kept for the
+    variations of the peak from one render to the other: in a process
+    whose heap is fragmented by previous work, the peak of a long render
+    was measured up to 45% above the one of the short renders
+    """
+    fixed, per_frame = memory_model(model, x) if costs is None else costs
+    budget = peak_bytes * (1 - margin)
+    frames = int((budget - fixed) // per_frame)
+    if max_frames is not None:
+        frames = min(frames, max_frames)
+    for _ in range(n_checks):
+        if frames <= 1:
+            break
+        peak = measure_peak(model, x, frames)
+        if peak is None or peak <= budget:
+            break
+        frames = min(frames - 1, int(frames * max(0, budget - fixed)
+                                     / max(1, peak - fixed)))
+    return max(1, frames)
+
+
+class _PeakMemory():
+    """ peak memory of the process above its level at start()
+    CUDA: peak allocated memory of the caching allocator
+    CPU:  peak resident set size, tracked by the kernel (VmHWM, reset
+          at start), or sampled every interval seconds by a thread when
+          it cannot be reset (Linux /proc, None elsewhere). Sampling
+          misses short-lived peaks
+    """
+    def __init__(self, device, interval=0.001):
+        self.device = torch.device(device)
+        self.interval = interval
+        self.base = 0
+        self.peak = 0
+        self.running = False
+        self.thread = None
+        self.high_water = False
+        self.page_size = os.sysconf('SC_PAGE_SIZE') \
+                         if hasattr(os, 'sysconf') else 4096
+
+    def _rss(self):
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * self.page_size
+
+    def _high_water(self):
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+        return None
+
+    def _reset_high_water(self):
+        """ reset the peak resident set size (VmHWM) to the current one
+        """
+        try:
+            with open('/proc/self/clear_refs', 'w') as f:
+                f.write('5')
+        except (IOError, OSError):
+            return False
+        return self._high_water() is not None
+
+    def _sample(self):
+        while self.running:
+            self.peak = max(self.peak, self._rss())
+            time.sleep(self.interval)
+
+    def start(self):
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+            torch.cuda.reset_peak_memory_stats(self.device)
+            self.base = torch.cuda.memory_allocated(self.device)
+            return
+        if not os.path.exists('/proc/self/statm'):
+            return
+        # give the memory freed by previous renders back to the system,
+        # so that the resident size starts from the memory in use
+        try:
+            ctypes.CDLL('libc.so.6').malloc_trim(0)
+        except (OSError, AttributeError):
+            pass
+        self.high_water = self._reset_high_water()
+        self.base = self.peak = self._rss()
+        if self.high_water:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self._sample, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """ peak memory above the start level (bytes), None if unknown
+        """
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+            return torch.cuda.max_memory_allocated(self.device) - self.base
+        if self.high_water:
+            return max(self._high_water(), self._rss()) - self.base
+        if self.thread is None:
+            return None
+        self.running = False
+        self.thread.join()
+        self.peak = max(self.peak, self._rss())
+        return self.peak - self.base
+
+
+def _stream(model, x, step, out=None):
+    """ streaming render of x with step frames per step, written to out
+    """
+    state = model.init_state()
+    pos = 0
+    with torch.no_grad():
+        for st in range(0, x.shape[1], step):
+            ed = min(st + step, x.shape[1])
+            output = model.forward_step(x[:, st:ed], state,
+                                        flush=ed >= x.shape[1])
+            if out is not None:
+                out[:, pos:pos + output.shape[1]] = output.cpu().numpy()
+            pos += output.shape[1]
+
+
+def render_long(model, x, peak_bytes=128 * 1024 * 1024, out=None,
+                max_frames=None, costs=None):
+    """ output, report = render_long(model, x, peak_bytes, out,
+                                     max_frames, costs)
+    Same output as model(x) for a long feature sequence, rendered with
+    a bounded memory
+
+    model:      sinc_nsf.Model
+    x:          features (batchsize, length, dim)
+    peak_bytes: memory target of the rendering (model and output excluded)
+    out:        optional array (batchsize, length * up_sample) to write
+                the output to (e.g. a numpy.memmap for very long renders),
+                a float32 numpy array is allocated if None
+    costs:      (fixed, per_frame) from memory_model(), to calibrate once
+                for several renders, measured on x if None
+    report:     frames per step, estimated and measured peak memory
+                (bytes), duration (s) and real-time factor
+    """
+    up_sample = int(model.m_cond.up_sample)
+    batch, length = x.shape[0], x.shape[1]
+    if costs is None:
+        costs = memory_model(model, x)
+    step = frames_for_budget(model, peak_bytes, x, max_frames, costs)
+    if out is None:
+        out = np.empty([batch, length * up_sample], dtype=np.float32)
+        # written now, so that the output is not in the measured peak
+        out.fill(0)
+
+    peak = _PeakMemory(x.device)
+    peak.start()
+    tic = time.perf_counter()
+    _stream(model, x, step, out)
+    duration = time.perf_counter() - tic
+    report = {'frames per step': step,
+              'estimated peak (bytes)': costs[0] + costs[1] * step,
+              'measured peak (bytes)': peak.stop(),
+              'duration (s)': duration,
+              'real-time factor': duration * model.sampling_rate
+                                  / max(1, length * up_sample)}
+    return out, report
+
+
+def full_forward_peak(model, x):
+    """ peak = full_forward_peak(model, x)
+    Measured peak memory (bytes) of model(x), for comparison
+    """
+    peak = _PeakMemory(x.device)
+    peak.start()
+    with torch.no_grad():
+        output = model(x)
+    del output
+    return peak.stop()
+
+
+if __name__ == "__main__":
+    nsf_model = torch.load(sys.argv[1], map_location="cpu")
+    nsf_model.eval()
+    n_frames = int(sys.argv[2]) if len(sys.argv) > 2 else 1300
+    target = float(sys.argv[3]) if len(sys.argv) > 3 else 128
+    scale = torch.tensor([0.1, 0.05, 1700, 0.1, 1000, 900, 300])
+    features = torch.rand(1, n_frames, 7) * scale
+    _, long_report = render_long(nsf_model, features,
+                                 int(target * 1024 * 1024))
+    for k, v in long_report.items():
+        print("{:s}: {}".format(k, v))
@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+"""
+quantize.py for the hn-sinc-NSF model in sinc_nsf.py
+
+Int8 inference profile on CPU:
+ - dynamic int8 quantization of the linear layers of the neural filter
+   blocks (l_ff_1, l_ff_2, l_ff_3)
+ - static int8 quantization of the dilated convolutions of the neural
+   filter blocks, with input / output ranges calibrated on impact features
+
+Usage: $: python -m models.nsf.quantize model.th  (from the code/ directory)
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+
+import copy
+import glob
+import sys
+import time
+import numpy as np
+import torch
+import torch.nn as torch_nn
+import torch.ao.nn.quantized as torch_nnq
+from torch.ao import quantization as torch_quant
+
+from models.nsf import sinc_nsf
+
+
+class QuantConv1dKeepLength(sinc_nsf.Conv1dKeepLength):
+    """ Conv1dKeepLength with static int8 quantization (CPU only)
+
+    l_conv = QuantConv1dKeepLength.from_float(conv) copies a trained
+    Conv1dKeepLength. Until convert() is called, the layer computes in
+    float and records the ranges of its input and output (calibration).
+    After convert(), the convolution runs on int8 weights and quint8
+    activations; forward, forward_step and forward_cached are unchanged.
+    """
+    @classmethod
+    def from_float(cls, l_conv):
+        tanh = isinstance(l_conv.l_ac, torch_nn.Tanh)
+        q_conv = cls(l_conv.in_channels, l_conv.out_channels,
+                     l_conv.dilation[0], l_conv.kernel_size[0],
+                     causal=l_conv.causal, stride=l_conv.stride[0],
+                     groups=l_conv.groups, bias=l_conv.bias is not None,
+                     tanh=tanh, pad_mode=l_conv.pad_mode)
+        q_conv.load_state_dict(l_conv.state_dict())
+        q_conv.to(l_conv.weight.device)
+        q_conv.in_observer = torch_quant.MinMaxObserver(dtype=torch.quint8)
+        q_conv.out_observer = torch_quant.MinMaxObserver(dtype=torch.quint8)
+        return q_conv
+
+    def convert(self):
+        """ pack the int8 weights with the calibrated activation ranges
+        """
+        w_observer = torch_quant.PerChannelMinMaxObserver(
+            ch_axis=0, dtype=torch.qint8,
+            qscheme=torch.per_channel_symmetric)
+        w_observer(self.weight.detach())
+        w_scale, w_zero_point = w_observer.calculate_qparams()
+        q_weight = torch.quantize_per_channel(
+            self.weight.detach().float(), w_scale.float(),
+            w_zero_point.long(), 0, torch.qint8)
+        in_scale, in_zero_point = self.in_observer.calculate_qparams()
+        out_scale, out_zero_point = self.out_observer.calculate_qparams()
+
+        self.l_qconv = torch_nnq.Conv1d(
+            self.in_channels, self.out_channels, self.kernel_size[0],
+            stride=self.stride[0], padding=0, dilation=self.dilation[0],
+            groups=self.groups, bias=self.bias is not None)
+        self.l_qconv.set_weight_bias(
+            q_weight, None if self.bias is None else self.bias.detach())
+        self.l_qconv.scale = float(out_scale)
+        self.l_qconv.zero_point = int(out_zero_point)
+        self.in_scale = float(in_scale)
+        self.in_zero_point = int(in_zero_point)
+
+    def _conv_forward(self, input, weight, bias):
+        if 'l_qconv' not in self._modules:
+            # calibration
+            self.in_observer(input.detach())
+            output = super(QuantConv1dKeepLength, self)._conv_forward(
+                input, weight, bias)
+            self.out_observer(output.detach())
+            return output
+        q_input = torch.quantize_per_tensor(
+            input.contiguous(), self.in_scale, self.in_zero_point,
+            torch.quint8)
+        return self.l_qconv(q_input).dequantize()
+
+
+def _select_engine():
+    """ fbgemm / x86 on x86 hosts, qnnpack on ARM boards
+    """
+    engines = torch.backends.quantized.supported_engines
+    for engine in ['x86', 'fbgemm', 'qnnpack']:
+        if engine in engines:
+            torch.backends.quantized.engine = engine
+            return engine
+    print("No quantized engine available on this host")
+    sys.exit(1)
+
+
+def load_calibration_features(pattern="models/features/*.npy",
+                              n_files=8, seed=0):
+    """ features_list = load_calibration_features(pattern, n_files, seed)
+    Load the impact features of n_files files of the feature store
+    (models/features.py) as tensors (batchsize=1, length, 7) on CPU.
+    The files are a fixed random subset (seed) of the store, so that
+    the calibration does not run the model on a whole sample library
+    """
+    f_paths = sorted(glob.glob(pattern))
+    if len(f_paths) > n_files:
+        rng = np.random.RandomState(seed)
+        f_paths = sorted(rng.choice(f_paths, n_files, replace=False))
+    return [torch.tensor(np.load(f_path, mmap_mode="r")).unsqueeze(0)
+            for f_path in f_paths]
+
+
+def quantize_model(model, calib_features, quant_linear=False,
+                   quant_conv=True):
+    """ q_model = quantize_model(model, calib_features, quant_linear=False,
+                                 quant_conv=True)
+    model:          trained sinc_nsf.Model (left unchanged)
+    calib_features: list of tensors (batchsize, length, dim), used to
+                    calibrate the ranges of the convolution activations
+    quant_linear:   dynamic int8 for l_ff_1/2/3 (off by default: these
+                    layers are narrow, 1 -> 64 -> 16 -> 1, so the int8
+                    kernels cost more SNR than they save time)
+    quant_conv:     static int8 for the dilated convolutions
+    q_model:        int8 copy of the model on CPU
+    """
+    _select_engine()
+    q_model = copy.deepcopy(model).cpu().eval()
+    l_blocks = list(q_model.m_filter.l_har_blocks) \
+               + list(q_model.m_filter.l_noi_blocks)
+    if quant_conv:
+        if len(calib_features) == 0:
+            print("Quantization needs calibration features")
+            sys.exit(1)
+        for l_blk in l_blocks:
+            for idx, l_conv in enumerate(l_blk.l_convs):
+                l_blk.l_convs[idx] = QuantConv1dKeepLength.from_float(l_conv)
+        with torch.no_grad():
+            for features in calib_features:
+                q_model(features.cpu().float())
+        for l_blk in l_blocks:
+            for l_conv in l_blk.l_convs:
+                l_conv.convert()
+    if quant_linear:
+        for l_blk in l_blocks:
+            torch_quant.quantize_dynamic(
+                l_blk, {torch_nn.Linear}, dtype=torch.qint8, inplace=True)
+    return q_model
+
+
+def _spectral_distance(ref, output, n_fft=1024, floor_db=-80):
+    """ log-spectral distance (dB) between two waveforms (batch, length)
+    bins below floor_db (relative to the maximum of ref) are clipped
+    """
+    window = torch.hann_window(n_fft)
+    spec_ref = torch.stft(ref, n_fft, window=window, return_complex=True)
+    spec_out = torch.stft(output, n_fft, window=window, return_complex=True)
+    floor = torch.max(spec_ref.abs() ** 2) * 10 ** (floor_db / 10) + 1e-20
+    log_ref = 10 * torch.log10(torch.clamp(spec_ref.abs() ** 2, min=floor))
+    log_out = 10 * torch.log10(torch.clamp(spec_out.abs() ** 2, min=floor))
+    return torch.sqrt(torch.mean((log_ref - log_out) ** 2, dim=1)).mean()
+
+
+def quality_report(model, q_model, features_list, n_runs=3):
+    """ report = quality_report(model, q_model, features_list, n_runs)
+    SNR (dB) and log-spectral distance (dB) of the quantized model
+    against the float model (source noise disabled), and CPU time of
+    one forward pass of each model on the first features
+    """
+    flag_noise = [model.get_source_noise(), q_model.get_source_noise()]
+    model.set_source_noise(False)
+    q_model.set_source_noise(False)
+    snr = []
+    lsd = []
+    try:
+        with torch.no_grad():
+            for features in features_list:
+                features = features.cpu().float()
+                ref = model(features)
+                output = q_model(features)
+                snr.append(10 * np.log10(
+                    torch.sum(ref ** 2).item()
+                    / max(torch.sum((ref - output) ** 2).item(), 1e-20)))
+                lsd.append(_spectral_distance(ref, output).item())
+    finally:
+        model.set_source_noise(flag_noise[0])
+        q_model.set_source_noise(flag_noise[1])
+
+    report = {'snr (dB)': np.mean(snr), 'spectral distance (dB)': np.mean(lsd)}
+    for name, l_model in [('float32', model), ('int8', q_model)]:
+        with torch.no_grad():
+            l_model(features_list[0])
+            st = time.perf_counter()
+            for _ in range(n_runs):
+                l_model(features_list[0])
+        report[name + ' (s)'] = (time.perf_counter() - st) / n_runs
+    report['speedup'] = report['float32 (s)'] / report['int8 (s)']
+    return report
+
+
+if __name__ == "__main__":
+    nsf_model = torch.load(sys.argv[1], map_location="cpu")
+    nsf_model.eval()
+    features_list = load_calibration_features()
+    if len(features_list) == 0:
+        print("No features found in models/features/*.npy")
+        sys.exit(1)
+    print("Quantized engine: " + _select_engine())
+    for quant_linear in [False, True]:
+        print("Int8 convolutions" + (" and linear layers" if quant_linear
+                                     else ""))
+        q_nsf_model = quantize_model(nsf_model, features_list, quant_linear)
+        report = quality_report(nsf_model, q_nsf_model, features_list)
+        for k, v in report.items():
+            print("  {:s}: {}".format(k, v))
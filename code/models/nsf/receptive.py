@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+"""
+receptive.py for the hn-sinc-NSF model in sinc_nsf.py
+
+Receptive field of sinc_nsf.Model and exact chunked generation
+
+An output sample depends on a finite window of input frames, except
+for the phase of the sine source, which accumulates the F0 of all the
+past frames. A chunk of frames generated with the left / right context
+given by receptive_field() and the phase of the frames before it
+(SineGen.frame_phase) is equal to the same frames of the output of a
+forward pass on the whole sequence (source noise disabled, or read from
+a seeded noise table at the position of the chunk, see
+Model.set_noise_table).
+
+Usage: $: python -m models.nsf.receptive model.th  (from the code/ directory)
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+
+import sys
+import numpy as np
+import torch
+import torch.nn as torch_nn
+
+from models.nsf import sinc_nsf
+
+
+def layer_context(layer):
+    """ left, right = layer_context(layer)
+    Number of past (left) and future (right) input steps used by one
+    output step of a layer: Conv1dKeepLength (and MovingAverage),
+    UpSampleLayer (smoothing at the up-sampled rate), Identity
+    """
+    if isinstance(layer, sinc_nsf.Conv1dKeepLength):
+        return int(layer.pad_le), int(layer.pad_ri)
+    if isinstance(layer, sinc_nsf.UpSampleLayer):
+        left_1, right_1 = layer_context(layer.l_ave1)
+        left_2, right_2 = layer_context(layer.l_ave2)
+        return left_1 + left_2, right_1 + right_2
+    if isinstance(layer, torch_nn.Identity):
+        return 0, 0
+    print("Unknown context of layer {:s}".format(type(layer).__name__))
+    sys.exit(1)
+
+
+def _chain_context(layers):
+    """ context of layers applied one after the other
+    """
+    contexts = [layer_context(layer) for layer in layers]
+    return sum([c[0] for c in contexts]), sum([c[1] for c in contexts])
+
+
+def receptive_field(model):
+    """ rf = receptive_field(model)
+    Context of one output sample of a sinc_nsf.Model
+
+    rf['left_samples'], rf['right_samples']: past / future samples of
+        the up-sampled condition features that an output sample uses
+    rf['left_frames'], rf['right_frames']: frames of context to add
+        before / after a chunk of frames so that its samples are exact
+    rf['paths']: (left, right) samples of each path from the condition
+        module to the output
+    """
+    m_cond = model.m_cond
+    m_filter = model.m_filter
+    up_sample = int(m_cond.up_sample)
+
+    # filter module: causal dilated convolutions in both branches and
+    # causal time-variant FIR filtering (sinc_order - 1 past samples)
+    har_left = sum([_chain_context(blk.l_convs)[0]
+                    for blk in m_filter.l_har_blocks])
+    noi_left = sum([_chain_context(blk.l_convs)[0]
+                    for blk in m_filter.l_noi_blocks])
+    filter_left = max(har_left, noi_left) + int(m_filter.sinc_order) - 1
+
+    # condition module, at the sample level
+    hid_left, hid_right = layer_context(m_cond.l_upsamp)
+    f0_left, f0_right = layer_context(m_cond.l_upsamp_f0_hi)
+    cut_left, cut_right = layer_context(m_cond.l_cut_f_smooth)
+    # cut_f only gives the FIR coefficients of the current sample: its
+    # path skips the filter blocks and the past samples of the filtering
+    paths = {'context': (filter_left + hid_left, hid_right),
+             'f0_context': (filter_left + f0_left, f0_right),
+             'cut_f': (cut_left + hid_left, cut_right + hid_right),
+             'source': (filter_left, 0)}
+    left_samples = max([p[0] for p in paths.values()])
+    right_samples = max([p[1] for p in paths.values()])
+
+    # frame-level convolutions before the up-sampling
+    conv_left, conv_right = _chain_context(m_cond.l_conv1ds)
+    # the samples of frame f are [f * up, (f + 1) * up)
+    left_frames = conv_left + int(np.ceil(left_samples / up_sample))
+    right_frames = conv_right + (up_sample - 1 + right_samples) // up_sample
+    return {'left_samples': left_samples, 'right_samples': right_samples,
+            'left_frames': left_frames, 'right_frames': right_frames,
+            'up_sample': up_sample, 'paths': paths}
+
+
+def start_phase(model, x, start):
+    """ phase = start_phase(model, x, start)
+    Phase of the sines at the frame start of x (batchsize, length, dim)
+    in a forward pass on the whole sequence (random start if the source
+    noise is on, the start of the noise table if set), the phase_ini of
+    a chunk or a stream (Model.init_state) beginning at that frame
+    """
+    sin_gen = model.m_source.l_sin_gen
+    phase = sin_gen._rand_ini(
+        x.new_zeros([x.shape[0], 1, sin_gen.dim]))
+    return (phase + sin_gen.frame_phase(
+        x[:, :start, -1:], int(model.m_cond.up_sample))) % 1
+
+
+def forward_chunk(model, x, start, end, rf, phase_ini=None):
+    """ output = forward_chunk(model, x, start, end, rf, phase_ini=None)
+    Samples of the frames [start, end) of x (batchsize, length, dim),
+    computed on the frames [start - left, end + right] only
+
+    rf: from receptive_field(model)
+    phase_ini: phase of the sines at the beginning of the context
+               (batchsize, harmonic_num + 1), computed from the frames
+               before it if None
+    """
+    up_sample = rf['up_sample']
+    ctx_st = max(0, start - rf['left_frames'])
+    ctx_ed = min(x.shape[1], end + rf['right_frames'])
+    if phase_ini is None:
+        phase_ini = model.m_source.l_sin_gen.frame_phase(
+            x[:, :ctx_st, -1:], up_sample)
+    x_ctx = x[:, ctx_st:ctx_ed]
+    f0 = x_ctx[:, :, -1:]
+    cond_feat, f0_upsamped, cut_f, _ = model.m_cond(
+        model.normalize_input(x_ctx), f0)
+    har_source, noi_source, _ = model.m_source(f0_upsamped, phase_ini,
+                                               ctx_st * up_sample)
+    output = model.m_filter(har_source, noi_source, cond_feat, cut_f)
+    output = output.squeeze(-1)
+    return output[:, (start - ctx_st) * up_sample:(end - ctx_st) * up_sample]
+
+
+def generate_chunked(model, x, chunk=15, rf=None):
+    """ output = generate_chunked(model, x, chunk=15, rf=None)
+    Same as model(x), computed chunk frames at a time with the minimal
+    exact context around each chunk. The phase of the sines is carried
+    from chunk to chunk (with a random start if the source noise is on,
+    the start of the noise table if set)
+    """
+    rf = receptive_field(model) if rf is None else rf
+    sin_gen = model.m_source.l_sin_gen
+    phase = start_phase(model, x, 0)
+    output = []
+    phase_frame = 0
+    with torch.no_grad():
+        for st in range(0, x.shape[1], chunk):
+            ed = min(st + chunk, x.shape[1])
+            # advance the phase to the beginning of the context
+            ctx_st = max(0, st - rf['left_frames'])
+            phase = (phase + sin_gen.frame_phase(
+                x[:, phase_frame:ctx_st, -1:], rf['up_sample'])) % 1
+            phase_frame = ctx_st
+            output.append(forward_chunk(model, x, st, ed, rf, phase))
+    return torch.cat(output, dim=1)
+
+
+def check_chunked(model, length=64, chunks=(1, 7, 15), rtol=1e-3):
+    """ report = check_chunked(model, length, chunks, rtol)
+    Compare generate_chunked with model(x) on random features (source
+    noise disabled), for each chunk size, relative to the largest
+    absolute value of model(x). The chunks restart from the phase of the
+    sines accumulated in float64, model(x) accumulates it in float32
+    """
+    scale = torch.tensor([0.1, 0.05, 1700, 0.1, 1000, 900, 300])
+    x = torch.rand(1, length, 7) * scale
+    rf = receptive_field(model)
+    flag_noise = model.get_source_noise()
+    model.set_source_noise(False)
+    report = {}
+    match = True
+    try:
+        with torch.no_grad():
+            ref = model(x)
+            for chunk in chunks:
+                output = generate_chunked(model, x, chunk, rf)
+                err = ((output - ref).abs().max()
+                       / ref.abs().max().clamp(min=1e-12)).item()
+                report[chunk] = "max_rel_err {:.2e}".format(err)
+                match = match and output.shape == ref.shape and err < rtol
+    finally:
+        model.set_source_noise(flag_noise)
+    report['match'] = match
+    return report
+
+
+if __name__ == "__main__":
+    nsf_model = torch.load(sys.argv[1], map_location="cpu")
+    nsf_model.eval()
+    rf = receptive_field(nsf_model)
+    for k, v in rf.items():
+        print("{:s}: {}".format(k, v))
+    for k, v in check_chunked(nsf_model).items():
+        print("chunk {}: {}".format(k, v))
@@ -11,6 +11,8 @@ from __future__ import absolute_import
 from __future__ import print_function
 
 import sys
+import threading
+import concurrent.futures
 import numpy as np
 import torch
 import torch.nn as torch_nn
@@ -23,6 +25,103 @@ __email__ = "wangxin@nii.ac.jp"
 __copyright__ = "Copyright 2020, Xin Wang"
 
 
+##############
+# Streaming helpers
+#
+# Stateful layers define init_state() and forward_step(data, state, ...):
+# calling forward_step on consecutive pieces of a sequence (with
+# flush=True on the last piece) gives, once concatenated, the output of
+# forward() on the whole sequence.
+
+def stream_align(pending, tensors):
+    """ tensors = stream_align(pending, tensors)
+    Synchronize streams with different latencies
+
+    pending: list of the samples not returned yet for each stream
+             (list of None at the start of the stream), updated in place
+    tensors: list of the new samples of each stream (batch, length, dim)
+
+    Return the samples that are available in all streams (same length)
+    """
+    tensors = [x if p is None else torch.cat([p, x], dim=1) \
+               for p, x in zip(pending, tensors)]
+    length = min([x.shape[1] for x in tensors])
+    pending[:] = [x[:, length:] for x in tensors]
+    return [x[:, :length] for x in tensors]
+
+def stream_cumsum(acc, values):
+    """ output, acc = stream_cumsum(acc, values)
+    torch.cumsum of values along dim 1, continuing from the accumulator
+    acc (batch, 1, dim) of the previous call (float64, None at start)
+
+    torch.cumsum accumulates float32 in float64 on CPU: accumulating
+    in float64 here gives the same values as a cumsum over the whole
+    sequence
+    """
+    if acc is None:
+        acc = torch.zeros_like(values[:, 0:1, :], dtype=torch.float64)
+    tmp = torch.cumsum(torch.cat([acc, values.double()], dim=1), dim=1)
+    return tmp[:, 1:].to(values.dtype), tmp[:, -1:]
+
+def step_layer(layer, data, state, flush=False):
+    """ output = step_layer(layer, data, state, flush=False)
+    Run a layer on the next samples of a stream, layers without
+    forward_step (Identity, Tanh, ...) are stateless
+    """
+    if hasattr(layer, 'forward_step'):
+        return layer.forward_step(data, state, flush)
+    return layer(data)
+
+def init_layer_state(layer):
+    """ state = init_layer_state(layer)
+    State of step_layer(layer, ...), empty for stateless layers
+    """
+    if hasattr(layer, 'init_state'):
+        return layer.init_state()
+    return {}
+
+# The tensors of a state are batch-first: the states of several streams
+# with the same signature can be batched and split again
+
+def state_signature(state):
+    """ signature = state_signature(state)
+    Structure of a state with the shapes of its tensors (without the
+    batch dimension), states with equal signatures can be concatenated
+    """
+    if isinstance(state, dict):
+        return tuple((k, state_signature(v)) for k, v in state.items())
+    if isinstance(state, list):
+        return tuple(state_signature(v) for v in state)
+    if torch.is_tensor(state):
+        return tuple(state.shape[1:])
+    return state
+
+def state_cat(states):
+    """ state = state_cat(states)
+    Concatenate a list of states with the same signature along the batch
+    """
+    if isinstance(states[0], dict):
+        return {k: state_cat([s[k] for s in states]) for k in states[0]}
+    if isinstance(states[0], list):
+        return [state_cat([s[i] for s in states]) \
+                for i in range(len(states[0]))]
+    if torch.is_tensor(states[0]):
+        return torch.cat(states, dim=0)
+    return states[0]
+
+def state_select(state, index):
+    """ state = state_select(state, index)
+    Streams index (list of batch indices) of a batched state
+    """
+    if isinstance(state, dict):
+        return {k: state_select(v, index) for k, v in state.items()}
+    if isinstance(state, list):
+        return [state_select(v, index) for v in state]
+    if torch.is_tensor(state):
+        return state[index]
+    return state
+
+
 ##############
 # Building blocks (torch.nn modules + dimension operation)
 
@@ -100,6 +199,83 @@ class Conv1dKeepLength(torch_nn.Conv1d):
         output = self.l_ac(super(Conv1dKeepLength, self).forward(x))
         return output.permute(0, 2, 1)
 
+    def init_state(self):
+        """ state = init_state(self)
+        buf: last input samples, (batchsize, dim_in, length)
+             None before the first input (left padding not applied yet)
+        """
+        return {'buf': None}
+
+    def forward_step(self, data, state, flush=False):
+        """ output = forward_step(self, data, state, flush=False)
+        data:   (batchsize, length, dim_in), next samples of the input
+        state:  from init_state(), updated in place
+        flush:  data is the end of the input, do the right padding
+        output: (batchsize, length_out, dim_out), next samples of output
+
+        The non-causal convolution outputs its samples pad_ri samples
+        later than it receives the input, they are released by flush
+        """
+        x = data.permute(0, 2, 1)
+        if state['buf'] is None:
+            if x.shape[2] == 0:
+                return data.new_zeros([data.shape[0], 0, self.out_channels])
+            # beginning of the sequence: left padding
+            x = torch_nn_func.pad(x.unsqueeze(2), (self.pad_le, 0, 0, 0), \
+                                  mode = self.pad_mode).squeeze(2)
+        else:
+            x = torch.cat([state['buf'], x], dim=2)
+        if flush:
+            x = torch_nn_func.pad(x.unsqueeze(2), (0, self.pad_ri, 0, 0), \
+                                  mode = self.pad_mode).squeeze(2)
+
+        # number of output samples, the rest is kept for the next step
+        out_l = x.shape[2] - self.dilation[0] * (self.kernel_size[0] - 1)
+        if out_l <= 0:
+            state['buf'] = x
+            return data.new_zeros([data.shape[0], 0, self.out_channels])
+        state['buf'] = x[:, :, out_l:].clone()
+        output = self.l_ac(super(Conv1dKeepLength, self).forward(x))
+        return output.permute(0, 2, 1)
+
+    def init_cache(self):
+        """ cache = init_cache(self)
+        Cache of forward_cached (causal convolution only)
+        buf: (batchsize, dim_in, pad_le + block_length), the pad_le past
+             input samples followed by room for the new samples,
+             allocated at the first call and grown if a longer block comes
+        """
+        return {'buf': None}
+
+    def forward_cached(self, x, cache):
+        """ output = forward_cached(self, x, cache)
+        Causal convolution of the next samples x (batchsize, dim_in, length)
+        -> output (batchsize, dim_out, length), in channel-first layout.
+
+        Fast-WaveNet style: the past inputs needed by the dilated kernel
+        stay in a preallocated buffer, only the new samples are convolved
+        """
+        span = self.pad_le
+        length = x.shape[2]
+        if length == 0:
+            return x.new_zeros([x.shape[0], self.out_channels, 0])
+        buf = cache['buf']
+        if buf is None or buf.shape[2] < span + length:
+            new_buf = x.new_zeros([x.shape[0], x.shape[1], span + length])
+            if buf is not None:
+                new_buf[:, :, :span] = buf[:, :, :span]
+            buf = cache['buf'] = new_buf
+        buf[:, :, span:span + length] = x
+        output = self.l_ac(super(Conv1dKeepLength, self).forward(
+            buf[:, :, :span + length]))
+
+        # keep the last pad_le inputs at the start of the buffer
+        if length >= span:
+            buf[:, :, :span] = buf[:, :, length:length + span]
+        else:
+            buf[:, :, :span] = buf[:, :, length:length + span].clone()
+        return output
+
 # 
 # Moving average
 class MovingAverage(Conv1dKeepLength):
@@ -173,24 +349,101 @@ class TimeVarFIRFilter(torch_nn.Module):
      For n in [1, sequence_length):
        output(0, n, 1) = \sum_{k=1}^{K} signal(0, n-k, 1)*coef(0, n, k)
        
-    Note: filter coef (0, n, :) is only used to compute the output 
+    Note: filter coef (0, n, :) is only used to compute the output
           at (0, n, 1)
+
+    engine: 'roll' (original loop over the filter taps) or 'unfold'
+            (single pass over a strided view of the signal, processed
+            in chunks of chunk_size time steps to bound the memory of
+            the (batchsize, chunk_size, dim, K) temporary buffer)
     """
-    def __init__(self):
+    # class-level defaults, so that pickled models also have them
+    engine = 'unfold'
+    chunk_size = 16384
+
+    def __init__(self, engine='unfold', chunk_size=16384):
         super(TimeVarFIRFilter, self).__init__()
-    
+        self.engine = engine
+        self.chunk_size = chunk_size
+
     def forward(self, signal, f_coef):
-        """ 
+        """
         Filter coefs: (batchsize=1, signal_length, filter_order = K)
         Signal:       (batchsize=1, signal_length, 1)
-        
+
         Output:       (batchsize=1, signal_length, 1)
-        
+
         For n in [1, sequence_length):
           output(0, n, 1)= \sum_{k=1}^{K} signal(0, n-k, 1)*coef(0, n, k)
-          
+        """
+        if self.engine == 'roll':
+            return self._forward_roll(signal, f_coef)
+        elif self.engine == 'unfold':
+            return self._forward_unfold(signal, f_coef)
+        else:
+            print("Unknown TimeVarFIRFilter engine {:s}".format(self.engine))
+            sys.exit(1)
+
+    def _forward_unfold(self, signal, f_coef):
+        """
+        Same output as _forward_roll, computed on a strided view
+
+        Suppose signal [x_1, ..., x_N], filter [a_1, ..., a_K]
+        left-pad the signal with K-1 zeros and take the sliding windows
+        [0, ..., 0, x_1], [0, ..., x_1, x_2], ..., [x_N-K+1, ..., x_N]
+        y_n is then the dot product of the n-th window with the
+        reversed coefficients [a_K, ..., a_1] of time step n
+        """
+        order_k = f_coef.shape[-1]
+        # pad to (batchsize=1, filter_order-1 + signal_length, dim)
+        padded_signal = torch_nn_func.pad(signal, (0, 0, order_k - 1, 0))
+        return self._filter_padded(padded_signal, f_coef)
+
+    def _filter_padded(self, padded_signal, f_coef):
+        """ filtering of the signal preceded by its K-1 past samples
+        padded_signal: (batchsize=1, filter_order-1 + signal_length, dim)
+        """
+        order_k = f_coef.shape[-1]
+        signal_l = padded_signal.shape[1] - (order_k - 1)
+
+        y = padded_signal.new_empty([padded_signal.shape[0], signal_l,
+                                     padded_signal.shape[2]])
+        for st in range(0, signal_l, self.chunk_size):
+            ed = min(st + self.chunk_size, signal_l)
+            # view (batchsize=1, ed - st, dim, filter_order), no copy
+            windows = padded_signal[:, st:ed + order_k - 1, :].unfold(
+                1, order_k, 1)
+            # reverse the taps to match the order inside the windows
+            # (batchsize=1, ed - st, filter_order, 1)
+            rev_coef = torch.flip(f_coef[:, st:ed, :], dims=[2]).unsqueeze(-1)
+            # batched dot products
+            y[:, st:ed, :] = torch.matmul(windows, rev_coef).squeeze(-1)
+        return y
+
+    def init_state(self):
+        """ state = init_state(self)
+        buf: last K-1 samples of the signal (None: zeros at the start)
+        """
+        return {'buf': None}
+
+    def forward_step(self, signal, f_coef, state):
+        """ output = forward_step(self, signal, f_coef, state)
+        Filtering of the next samples of the signal, causal: output has
+        the same length as signal
+        """
+        order_k = f_coef.shape[-1]
+        if state['buf'] is None:
+            padded_signal = torch_nn_func.pad(signal, \
+                                              (0, 0, order_k - 1, 0))
+        else:
+            padded_signal = torch.cat([state['buf'], signal], dim=1)
+        state['buf'] = padded_signal[:, -(order_k - 1):].clone()
+        return self._filter_padded(padded_signal, f_coef)
+
+    def _forward_roll(self, signal, f_coef):
+        """
         This method may be not efficient:
-        
+
         Suppose signal [x_1, ..., x_N], filter [a_1, ..., a_K]
         output         [y_1, y_2, y_3, ..., y_N, *, * ... *]
                = a_1 * [x_1, x_2, x_3, ..., x_N,   0, ...,   0]
@@ -327,6 +580,72 @@ class SincFilter(torch_nn.Module):
         return lp_coef, hp_coef
 
 
+# Sinc filter lookup table
+class SincFilterBank(torch_nn.Module):
+    """ SincFilterBank
+        Same interface as SincFilter, but the filters are read from a
+        table precomputed by SincFilter for table_size cut-off
+        frequencies uniformly spaced in [cut_f_min, cut_f_max].
+
+        SincFilterBank(filter_order, table_size = 1024,
+                       cut_f_min = 0.1, cut_f_max = 0.9,
+                       interpolate = True)
+
+        filter_order: order of the sinc filters
+        table_size: number of filters in the table
+        cut_f_min, cut_f_max: range of the table. The cut-off frequency
+            given by CondModuleHnSincNSF.get_cut_f is within (0.1, 0.9),
+            input outside of the range is clipped to it
+        interpolate: linearly interpolate between the two neighbouring
+            filters (True) or take the nearest one (False)
+
+        Example:
+        sinc_table = SincFilterBank(31, 1024)
+        lp_coef, hp_coef = sinc_table(torch.ones(1, 10, 1) * 0.2)
+    """
+    def __init__(self, filter_order, table_size = 1024, cut_f_min = 0.1,
+                 cut_f_max = 0.9, interpolate = True):
+        super(SincFilterBank, self).__init__()
+        self.order = (filter_order - 1) // 2 * 2 + 1
+        self.table_size = table_size
+        self.cut_f_min = cut_f_min
+        self.cut_f_max = cut_f_max
+        self.cut_f_step = (cut_f_max - cut_f_min) / (table_size - 1)
+        self.interpolate = interpolate
+
+        # (table_size, filter_order * 2), [lp_coef, hp_coef] in each row
+        # so that both filters are read by a single indexing
+        with torch.no_grad():
+            grid = torch.linspace(cut_f_min, cut_f_max, table_size,
+                                  dtype=torch.float64)
+            lp_coef, hp_coef = SincFilter(filter_order)(grid.view(1, -1, 1))
+            table = torch.cat([lp_coef[0], hp_coef[0]], dim=1)
+        self.register_buffer('table', table.float())
+        # difference between neighbouring filters, for interpolation
+        self.register_buffer('table_diff',
+                             torch.diff(table, dim=0, append=table[-1:])
+                             .float())
+
+    def forward(self, cut_f):
+        """ lp_coef, hp_coef = forward(self, cut_f)
+        cut-off frequency cut_f (batchsize=1, length, dim = 1)
+
+        lp_coef: low-pass filter coefs  (batchsize, length, filter_order)
+        hp_coef: high-pass filter coefs (batchsize, length, filter_order)
+        """
+        # fractional position in the table (batchsize=1, length)
+        pos = (cut_f[:, :, 0] - self.cut_f_min) / self.cut_f_step
+        pos = torch.clamp(pos, 0, self.table_size - 1)
+        if self.interpolate:
+            idx = torch.floor(pos)
+            weight = (pos - idx).unsqueeze(-1)
+            idx = idx.long()
+            coef = self.table[idx] + weight * self.table_diff[idx]
+        else:
+            coef = self.table[torch.round(pos).long()]
+        return coef[:, :, 0:self.order], coef[:, :, self.order:]
+
+
 # 
 # Up sampling
 class UpSampleLayer(torch_nn.Module):
@@ -354,7 +673,138 @@ class UpSampleLayer(torch_nn.Module):
         # permute it backt to (batchsize=1, length, dim)
         # and do two moving average
         return self.l_ave1(self.l_ave2(up_sampled_data.permute(0, 2, 1)))
-    
+
+    def init_state(self):
+        """ state = init_state(self)
+        states of the two moving average layers
+        """
+        return {'ave1': init_layer_state(self.l_ave1),
+                'ave2': init_layer_state(self.l_ave2)}
+
+    def forward_step(self, x, state, flush=False):
+        """ output = forward_step(self, x, state, flush=False)
+        x: next frames (batchsize, length, dim)
+        """
+        # nearest up-sampling is done frame by frame
+        up_sampled_data = torch.repeat_interleave(x, self.scale_factor, 1)
+        up_sampled_data = step_layer(self.l_ave2, up_sampled_data, \
+                                     state['ave2'], flush)
+        return step_layer(self.l_ave1, up_sampled_data, state['ave1'], flush)
+
+
+def frame_interp_weights(up_sample, windows):
+    """ weight, left = frame_interp_weights(up_sample, windows)
+    Weights of the closed form of nearest up-sampling followed by moving
+    averages: output sample f * up_sample + r is
+    sum_k weight[r, k] * x[f - left + k]
+
+    up_sample: up-sampling rate
+    windows: list of (window_len, pad_le) of the moving averages
+    weight: (up_sample, taps) numpy array (float64)
+    left: number of frames before the current one (taps - 1 - left after)
+    """
+    # moving averages at the sample level: y[n] = sum_m kernel[m] s[n + m],
+    # offsets m in [-kernel_le, kernel_ri]
+    kernel = np.ones(1)
+    kernel_le = 0
+    for window_len, pad_le in windows:
+        kernel = np.convolve(kernel, np.ones(window_len) / window_len)
+        kernel_le += pad_le
+    kernel_ri = kernel.shape[0] - 1 - kernel_le
+
+    # the samples of frame f are [f * up_sample, (f + 1) * up_sample)
+    left = -(-kernel_le // up_sample)
+    right = (up_sample - 1 + kernel_ri) // up_sample
+    offsets = np.arange(-kernel_le, kernel_ri + 1)
+    pos = np.arange(up_sample)
+    taps = (pos[:, None] + offsets[None, :]) // up_sample + left
+    weight = np.zeros([up_sample, left + right + 1])
+    np.add.at(weight, (np.repeat(pos, offsets.shape[0]), taps.ravel()), \
+              np.tile(kernel, up_sample))
+    return weight, left
+
+
+class FrameInterpolation(torch_nn.Module):
+    """ Closed-form up-sampling of frame-level features
+    FrameInterpolation(up_sample, windows)
+
+    Same output as nearest up-sampling followed by MovingAverage layers
+    (replicate padding) of windows = [(window_len, pad_le), ...], in one
+    pass over the frames: each output sample is a fixed combination of a
+    few neighbouring frames (piecewise polynomial interpolation). The
+    streaming version (forward_step) keeps the last taps - 1 frames.
+
+    The frames are padded by replicate, which is the same as the
+    replicate padding of the samples when the input of each moving
+    average is constant over its padding length at the edges, e.g. one
+    or two moving averages with window_len <= up_sample (UpSampleLayer).
+    Otherwise the first / last samples differ (see the cut-off frequency
+    in FusedUpSampling)
+
+    Input tensor: (batchsize, length, dim)
+    Output tensor: (batchsize, length * up_sample, dim)
+    """
+    def __init__(self, up_sample, windows):
+        super(FrameInterpolation, self).__init__()
+        weight, left = frame_interp_weights(up_sample, windows)
+        self.up_sample = up_sample
+        self.taps = weight.shape[1]
+        self.left = left
+        self.right = self.taps - 1 - left
+        self.register_buffer('weight', \
+                             torch.tensor(weight, dtype=torch.float32))
+
+    def forward(self, x):
+        # replicate padding of the frames, (batchsize, dim, length + pad)
+        x_pad = torch_nn_func.pad(x.permute(0, 2, 1), \
+                                  (self.left, self.right), mode='replicate')
+        return self._interpolate(x_pad)
+
+    def _interpolate(self, x_pad):
+        """ output samples of the padded frames (batchsize, dim, length),
+        (batchsize, (length - taps + 1) * up_sample, dim)
+        """
+        batch, dim, length = x_pad.shape
+        # (batchsize, dim, length, taps) x (up_sample, taps)
+        frames = x_pad.unfold(2, self.taps, 1)
+        output = torch.einsum('bdlk,rk->blrd', frames, self.weight)
+        return output.reshape(batch, (length - self.taps + 1) \
+                              * self.up_sample, dim)
+
+    def init_state(self):
+        """ state = init_state(self)
+        buf: last input frames (batchsize, dim, taps - 1), None before
+             the first frame (left padding not applied yet)
+        """
+        return {'buf': None}
+
+    def forward_step(self, x, state, flush=False):
+        """ output = forward_step(self, x, state, flush=False)
+        Same as forward() on the next frames x (batchsize, length, dim).
+        The samples of a frame are released right frames later, the last
+        ones by flush
+        """
+        x_pad = x.permute(0, 2, 1)
+        if state['buf'] is None:
+            if x_pad.shape[2] == 0:
+                return x.new_zeros([x.shape[0], 0, x.shape[2]])
+            # beginning of the sequence: left padding
+            x_pad = torch_nn_func.pad(x_pad, (self.left, 0), \
+                                      mode='replicate')
+        else:
+            x_pad = torch.cat([state['buf'], x_pad], dim=2)
+        if flush:
+            x_pad = torch_nn_func.pad(x_pad, (0, self.right), \
+                                      mode='replicate')
+
+        # number of output frames, the rest is kept for the next step
+        out_l = x_pad.shape[2] - (self.taps - 1)
+        if out_l <= 0:
+            state['buf'] = x_pad
+            return x.new_zeros([x.shape[0], 0, x.shape[2]])
+        state['buf'] = x_pad[:, :, out_l:].clone()
+        return self._interpolate(x_pad)
+
 
 # Neural filter block (1 block)
 class NeuralFilterBlock(torch_nn.Module):
@@ -416,11 +866,75 @@ class NeuralFilterBlock(torch_nn.Module):
         output_signal = tmp_hidden + signal
         
         return output_signal
+
+    def init_state(self):
+        """ state = init_state(self)
+        dilation caches of the causal convolutions
+        """
+        return {'convs': [l_conv.init_cache() for l_conv in self.l_convs]}
+
+    def forward_step(self, signal, context, state):
+        """ output = forward_step(self, signal, context, state)
+        Same as forward() on the next samples of signal and context.
+        The hidden features stay in channel-first layout through the
+        dilated convs, which only convolve the new samples (the past
+        ones are kept in their caches)
+        """
+        tmp_hidden = self.l_ff_1_tanh(self.l_ff_1(signal)).transpose(1, 2)\
+                                                          .contiguous()
+        context = context.transpose(1, 2).contiguous()
+        for l_conv, l_cache in zip(self.l_convs, state['convs']):
+            tmp_hidden = tmp_hidden \
+                         + l_conv.forward_cached(tmp_hidden, l_cache) \
+                         + context
+        tmp_hidden = tmp_hidden.transpose(1, 2) * self.scale
+        tmp_hidden = self.l_ff_2_tanh(self.l_ff_2(tmp_hidden))
+        tmp_hidden = self.l_ff_3_tanh(self.l_ff_3(tmp_hidden))
+        return tmp_hidden + signal
     
 # 
 # Sine waveform generator
 # 
 # Sine waveform generator
+class NoiseTable(torch_nn.Module):
+    """ Seeded source noise, read at sample offsets
+    NoiseTable(dim, size = 2 ** 17, seed = 0)
+
+    dim: number of noise channels
+    size: number of samples of the table (the noise repeats after size
+          samples, about 6 s at 22.05 kHz by default)
+    seed: seed of the table (the global torch generator is not used)
+
+    noise = read(offset, length, col_st, col_ed)
+    offset: position of the first sample, int or tensor (batchsize,)
+    noise: (batchsize or 1, length, col_ed - col_st), columns
+           [col_st, col_ed) of the table from sample offset on, a view of
+           the table when it does not wrap around
+    phase: (dim,) uniform values, the initial phases of the sines
+    """
+    def __init__(self, dim, size = 2 ** 17, seed = 0):
+        super(NoiseTable, self).__init__()
+        generator = torch.Generator().manual_seed(seed)
+        self.size = size
+        self.seed = seed
+        self.register_buffer('table', \
+                             torch.randn(size, dim, generator = generator))
+        self.register_buffer('phase', torch.rand(dim, generator = generator))
+
+    def read(self, offset, length, col_st, col_ed):
+        table = self.table[:, col_st:col_ed]
+        if torch.is_tensor(offset):
+            idx = (offset.view(-1, 1) + torch.arange(
+                length, device = offset.device)) % self.size
+            return table[idx]
+        offset = offset % self.size
+        if offset + length <= self.size:
+            return table[offset:offset + length].unsqueeze(0)
+        idx = (offset + torch.arange(length, device = table.device)) \
+              % self.size
+        return table[idx].unsqueeze(0)
+
+
 class SineGen(torch_nn.Module):
     """ Definition of sine generator
     SineGen(samp_rate, harmonic_num = 0, 
@@ -437,7 +951,27 @@ class SineGen(torch_nn.Module):
     
     Note: when flag_for_pulse is True, the first time step of a voiced
         segment is always sin(np.pi) or cos(0)
+
+    flag_noise: when False, the initial phases and the additive noise
+        are set to 0 so that the output is deterministic (default True)
+    flag_continuous: when True, each call of forward() continues the
+        phase of the previous call (per harmonic), and only the new
+        samples are accumulated: long sequences can be generated chunk
+        by chunk without phase jumps. reset_phase() restarts the phase
+        (default False)
+    set_noise_table(): the initial phases and the additive noise are
+        read from a seeded NoiseTable at the position of the samples
+        instead of drawn at random: the same features give the same
+        output, also when generated in steps or chunks (noise_offset)
+    harmonic_num argument of forward() / forward_step(): only generate
+        the first overtones (None: all of them), cheaper approximation
+        (see Quality)
     """
+    # class-level defaults, so that pickled models also have them
+    flag_noise = True
+    flag_continuous = False
+    phase_state = None
+
     def __init__(self, samp_rate, harmonic_num = 0, 
                  sine_amp = 0.1, noise_std = 0.003,
                  voiced_threshold = 0,
@@ -456,20 +990,69 @@ class SineGen(torch_nn.Module):
         uv = torch.ones_like(f0)
         uv = uv * (f0 > self.voiced_threshold)
         return uv
+
+    def set_noise_table(self, size = 2 ** 17, seed = 0, device = None):
+        """ set_noise_table(self, size = 2 ** 17, seed = 0, device = None)
+        Read the noise from a seeded NoiseTable, one column per harmonic
+        and one for the noise branch of SourceModuleHnNSF
+        device: device of the table (None: device of the previous
+                table, or CPU)
+        """
+        if device is None and 'l_noise_table' in self._modules:
+            device = self.l_noise_table.table.device
+        self.l_noise_table = NoiseTable(self.dim + 1, size, seed)
+        if device is not None:
+            self.l_noise_table = self.l_noise_table.to(device)
+
+    def remove_noise_table(self):
+        """ remove_noise_table(self)
+        Go back to random noise
+        """
+        if 'l_noise_table' in self._modules:
+            del self.l_noise_table
+
+    def _rand_ini(self, f0_values):
+        # initial phase noise (no noise for fundamental component)
+        if 'l_noise_table' in self._modules:
+            rand_ini = self.l_noise_table.phase[0:f0_values.shape[2]]
+            rand_ini = rand_ini.to(f0_values)
+            rand_ini = rand_ini.expand(f0_values.shape[0], -1).clone()
+        else:
+            rand_ini = torch.rand(f0_values.shape[0], f0_values.shape[2],\
+                                  device = f0_values.device)
+        rand_ini[:, 0] = 0
+        if not self.flag_noise:
+            rand_ini.zero_()
+        return rand_ini
+
+    def noise_like(self, x, offset = 0, column = 0):
+        """ standard Gaussian noise in the shape of x (batchsize,
+        length, dim), from the noise table if set: columns [column,
+        column + dim) from sample offset (int or tensor (batchsize,))
+        """
+        if not self.flag_noise:
+            return torch.zeros_like(x)
+        if 'l_noise_table' not in self._modules:
+            return torch.randn_like(x)
+        noise = self.l_noise_table.read(offset, x.shape[1], column, \
+                                        column + x.shape[2])
+        return noise.to(x).expand(x.shape)
             
-    def _f02sine(self, f0_values):
+    def _f02sine(self, f0_values, phase_ini=None):
         """ f0_values: (batchsize, length, dim)
             where dim indicates fundamental tone and overtones
+            phase_ini: (batchsize, dim), initial phase (in periods) of
+            each harmonic, replaces the initial phase noise if given
         """
         # convert to F0 in rad. The interger part n can be ignored
         # because 2 * np.pi * n doesn't affect phase
         rad_values = (f0_values / self.sampling_rate) % 1
         
         # initial phase noise (no noise for fundamental component)
-        rand_ini = torch.rand(f0_values.shape[0], f0_values.shape[2],\
-                              device = f0_values.device)
-        rand_ini[:, 0] = 0
-        rad_values[:, 0, :] = rad_values[:, 0, :] + rand_ini
+        if phase_ini is None:
+            phase_ini = self._rand_ini(f0_values)
+        rad_values[:, 0, :] = rad_values[:, 0, :] \
+                              + phase_ini[:, 0:f0_values.shape[2]]
         
         # instantanouse phase sine[t] = sin(2*pi \sum_i=1 ^{t} rad)
         if not self.flag_for_pulse:
@@ -516,42 +1099,163 @@ class SineGen(torch_nn.Module):
             # get the sines
             sines = torch.cos(i_phase * 2 * np.pi)
         return  sines
-    
-    
-    def forward(self, f0):
-        """ sine_tensor, uv = forward(f0)
+
+    def _f02sine_step(self, f0_values, state):
+        """ Same as _f02sine (normal case) on the next samples of
+            f0_values, the phase is accumulated in state
+        """
+        rad_values = (f0_values / self.sampling_rate) % 1
+        if state['rad_cumsum'] is None:
+            if state.get('phase_ini') is None:
+                phase_ini = self._rand_ini(f0_values)
+            else:
+                phase_ini = state['phase_ini'][:, 0:f0_values.shape[2]]
+                state['phase_ini'] = None
+            rad_values[:, 0, :] = rad_values[:, 0, :] \
+                                  + phase_ini.to(f0_values)
+
+        # same -1 shifts as in _f02sine, the first time step is compared
+        # with the last one of the previous step
+        tmp_over_one, state['rad_cumsum'] = stream_cumsum(
+            state['rad_cumsum'], rad_values)
+        tmp_over_one = tmp_over_one % 1
+        if state['over_one'] is None:
+            prev_over_one = tmp_over_one[:, 0:1, :]
+        else:
+            prev_over_one = state['over_one']
+        prev_over_one = torch.cat([prev_over_one, tmp_over_one[:, :-1]], 1)
+        cumsum_shift = (tmp_over_one - prev_over_one < 0) * -1.0
+        state['over_one'] = tmp_over_one[:, -1:, :]
+
+        i_phase, state['phase'] = stream_cumsum(state['phase'], \
+                                                rad_values + cumsum_shift)
+        return torch.sin(i_phase * 2 * np.pi)
+
+    def n_sines(self, harmonic_num = None):
+        """ number of sines generated (fundamental tone and overtones)
+        with harmonic_num overtones (None: all of them)
+        """
+        if harmonic_num is None:
+            return self.dim
+        return min(self.dim, harmonic_num + 1)
+
+    def _f0_harmonics(self, f0, harmonic_num = None):
+        """ f0_buf = _f0_harmonics(f0, harmonic_num = None)
+        f0: (batchsize, length, 1)
+        f0_buf: (batchsize, length, n_sines(harmonic_num)), F0 of the
+                fundamental tone and of the overtones
+        """
+        # fundamental component and (idx+1)-th overtone, (idx+2)-th
+        # harmonic, in a single broadcasted multiplication
+        harmonics = torch.arange(1, self.n_sines(harmonic_num) + 1,
+                                 dtype=f0.dtype, device=f0.device)
+        return f0[:, :, 0:1] * harmonics
+
+    def _add_noise(self, sine_waves, f0, offset = 0):
+        """ sine_waves, uv, noise = _add_noise(sine_waves, f0, offset)
+        """
+        # generate uv signal
+        #uv = torch.ones(f0.shape)
+        #uv = uv * (f0 > self.voiced_threshold)
+        uv = self._f02uv(f0)
+
+        # noise: for unvoiced should be similar to sine_amp
+        #        std = self.sine_amp/3 -> max value ~ self.sine_amp
+        #.       for voiced regions is self.noise_std
+        noise_amp = uv * self.noise_std + (1-uv) * self.sine_amp / 3
+        noise = noise_amp * self.noise_like(sine_waves, offset)
+
+        # first: set the unvoiced part to 0 by uv
+        # then: additive noise
+        sine_waves = sine_waves * uv + noise
+        return sine_waves, uv, noise
+
+    def forward(self, f0, phase_ini=None, noise_offset=0,
+                harmonic_num=None):
+        """ sine_tensor, uv = forward(f0, phase_ini=None, noise_offset=0,
+                                      harmonic_num=None)
         input F0: tensor(batchsize=1, length, dim=1)
                   f0 for unvoiced steps should be 0
-        output sine_tensor: tensor(batchsize=1, length, dim)
+        phase_ini: (batchsize, dim), initial phase of the harmonics (in
+                  periods), to continue a sequence (see frame_phase)
+        noise_offset: position of the first sample in the noise table
+        harmonic_num: only generate the first overtones (None: all)
+        output sine_tensor: tensor(batchsize=1, length, n_sines)
         output uv: tensor(batchsize=1, length, 1)
         """
+        if self.flag_continuous:
+            if self.phase_state is None:
+                self.reset_phase()
+            return self.forward_step(f0, self.phase_state, harmonic_num)
         with torch.no_grad():
-            f0_buf = torch.zeros(f0.shape[0], f0.shape[1], self.dim, \
-                                    device=f0.device)
-            # fundamental component
-            f0_buf[:, :, 0] = f0[:, :, 0]
-            for idx in np.arange(self.harmonic_num):
-                # idx + 2: the (idx+1)-th overtone, (idx+2)-th harmonic
-                f0_buf[:, :, idx+1] = f0_buf[:, :, 0] * (idx+2)
-                
             # generate sine waveforms
-            sine_waves = self._f02sine(f0_buf) * self.sine_amp
-            
-            # generate uv signal
-            #uv = torch.ones(f0.shape)
-            #uv = uv * (f0 > self.voiced_threshold)
-            uv = self._f02uv(f0)
-            
-            # noise: for unvoiced should be similar to sine_amp
-            #        std = self.sine_amp/3 -> max value ~ self.sine_amp
-            #.       for voiced regions is self.noise_std
-            noise_amp = uv * self.noise_std + (1-uv) * self.sine_amp / 3
-            noise = noise_amp * torch.randn_like(sine_waves)
-            
-            # first: set the unvoiced part to 0 by uv
-            # then: additive noise
-            sine_waves = sine_waves * uv + noise
-        return sine_waves, uv, noise
+            sine_waves = self._f02sine(self._f0_harmonics(f0, harmonic_num),
+                                       phase_ini) * self.sine_amp
+            return self._add_noise(sine_waves, f0, noise_offset)
+
+    def frame_phase(self, f0, up_sample):
+        """ phase = frame_phase(self, f0, up_sample)
+        Phase (in periods, modulo 1) of the harmonics after the frames
+        f0 (batchsize, length, 1), each up-sampled to up_sample steps
+        without smoothing. phase (batchsize, dim) is the phase_ini that
+        continues the sines after these frames
+        """
+        # same float32 values as in _f02sine, accumulated in float64
+        rad_values = (self._f0_harmonics(f0) / self.sampling_rate) % 1
+        return (torch.sum(rad_values.double() * up_sample, dim=1) % 1).float()
+
+    def reset_phase(self):
+        """ reset_phase(self)
+        Restart the phase of the continuous mode (see flag_continuous)
+        """
+        self.phase_state = self.init_state()
+
+    def init_state(self, noise_offset = None, phase_ini = None):
+        """ state = init_state(self, noise_offset = None, phase_ini = None)
+        rad_cumsum: accumulated phase including the wrap-around
+        phase:      accumulated phase with the -1 shifts
+        over_one:   last value of rad_cumsum % 1
+        (None before the first step, see stream_cumsum)
+        pos:        position of the next sample in the noise table
+                    (batchsize,), starts at noise_offset (int or tensor
+                    (batchsize,), None: 0)
+        phase_ini:  initial phase of the first step (batchsize, dim),
+                    to continue a sequence (see frame_phase), None: as
+                    in forward()
+        """
+        return {'rad_cumsum': None, 'phase': None, 'over_one': None,
+                'pos': noise_offset, 'phase_ini': phase_ini}
+
+    def _step_pos(self, f0, state):
+        """ position of the samples f0 in the stream (batchsize,)
+        """
+        pos = state.get('pos')
+        if pos is None:
+            pos = 0
+        if not torch.is_tensor(pos):
+            return torch.full([f0.shape[0]], pos, dtype=torch.long, \
+                              device=f0.device)
+        return pos.to(f0.device)
+
+    def forward_step(self, f0, state, harmonic_num=None):
+        """ sine_tensor, uv, noise = forward_step(f0, state,
+                                                  harmonic_num=None)
+        Same as forward() on the next samples of f0, the phase of the
+        sines continues from the previous step
+        """
+        if self.flag_for_pulse:
+            print("SineGen.forward_step does not support flag_for_pulse")
+            sys.exit(1)
+        with torch.no_grad():
+            if f0.shape[1] == 0:
+                empty = f0.new_zeros([f0.shape[0], 0, \
+                                      self.n_sines(harmonic_num)])
+                return empty, torch.zeros_like(f0), empty
+            sine_waves = self._f02sine_step(
+                self._f0_harmonics(f0, harmonic_num), state) * self.sine_amp
+            pos = self._step_pos(f0, state)
+            state['pos'] = pos + f0.shape[1]
+            return self._add_noise(sine_waves, f0, pos)
 
 #####
 ## Model definition
@@ -636,6 +1340,21 @@ class CondModuleHnSincNSF(torch_nn.Module):
         return hidden_feat * 0.2 + uv * 0.4 + 0.3
         
     
+    def build_fused_upsampling(self):
+        """ build_fused_upsampling(self)
+        Replace the up-sampling and moving averages of forward() by the
+        closed-form FusedUpSampling (for inference, same output)
+        """
+        device = self.l_conv1ds[0].weight.device
+        self.l_fused_upsamp = FusedUpSampling(self).to(device)
+
+    def remove_fused_upsampling(self):
+        """ remove_fused_upsampling(self)
+        Go back to the up-sampling and moving average layers
+        """
+        if 'l_fused_upsamp' in self._modules:
+            del self.l_fused_upsamp
+
     def forward(self, feature, f0):
         """ spec, f0 = forward(self, feature, f0)
         feature: (batchsize, length, dim)
@@ -647,6 +1366,8 @@ class CondModuleHnSincNSF(torch_nn.Module):
         tmp = feature
         for l_conv in self.l_conv1ds:
             tmp = l_conv(tmp)
+        if 'l_fused_upsamp' in self._modules:
+            return self.l_fused_upsamp(tmp, feature[:, :, -1:], f0)
         tmp = self.l_upsamp(tmp)
         
         # concatenat normed F0 with hidden spectral features
@@ -668,6 +1389,197 @@ class CondModuleHnSincNSF(torch_nn.Module):
         # return
         return context, f0_upsamp, cut_f_smoothed, hidden_cut_f
 
+    def init_state(self):
+        """ state = init_state(self)
+        states of the convolution, up-sampling and smoothing layers,
+        and samples waiting for the slowest branch (pending_*). With the
+        closed-form up-sampling (build_fused_upsampling), the state of
+        FusedUpSampling: a stream keeps the up-sampling it started with
+        """
+        state = {'conv1ds': [l_conv.init_state() \
+                             for l_conv in self.l_conv1ds]}
+        if 'l_fused_upsamp' in self._modules:
+            state['fused_upsamp'] = self.l_fused_upsamp.init_state()
+            return state
+        state.update({'upsamp': self.l_upsamp.init_state(),
+                      'upsamp_f0_hi': self.l_upsamp_f0_hi.init_state(),
+                      'upsamp_F0': self.l_upsamp_F0.init_state(),
+                      'cut_f_smooth': self.l_cut_f_smooth.init_state(),
+                      'pending_cut_f': [None] * 3,
+                      'pending_out': [None] * 4})
+        return state
+
+    def forward_step(self, feature, f0, state, flush=False):
+        """ spec, f0, cut_f, hidden_cut_f = forward_step(self, feature, f0,
+                                                         state, flush)
+        Same as forward() on the next frames of feature and f0.
+        The outputs are released with a latency (non-causal convolutions
+        and smoothing), flush=True on the last frames releases the rest
+        """
+        tmp = feature
+        for l_conv, l_state in zip(self.l_conv1ds, state['conv1ds']):
+            tmp = l_conv.forward_step(tmp, l_state, flush)
+        if 'fused_upsamp' in state:
+            return self.l_fused_upsamp.forward_step(
+                tmp, feature[:, :, -1:], f0, state['fused_upsamp'], flush)
+        tmp = self.l_upsamp.forward_step(tmp, state['upsamp'], flush)
+        f0_hi = self.l_upsamp_f0_hi.forward_step(feature[:, :, -1:], \
+                                                 state['upsamp_f0_hi'], flush)
+        f0_upsamp = self.l_upsamp_F0.forward_step(f0, state['upsamp_F0'], \
+                                                  flush)
+
+        # align the three branches before combining them
+        tmp, f0_hi, f0_upsamp = stream_align(state['pending_cut_f'], \
+                                             [tmp, f0_hi, f0_upsamp])
+        context = torch.cat((tmp[:, :, 0:self.output_dim-1], f0_hi), dim=2)
+        hidden_cut_f = tmp[:, :, self.output_dim-1:]
+        cut_f = self.get_cut_f(hidden_cut_f, f0_upsamp)
+        cut_f_smoothed = self.l_cut_f_smooth.forward_step(
+            cut_f, state['cut_f_smooth'], flush)
+
+        # align with the smoothed cut-off frequency
+        return stream_align(state['pending_out'], [context, f0_upsamp, \
+                                                   cut_f_smoothed, \
+                                                   hidden_cut_f])
+
+class FusedUpSampling(torch_nn.Module):
+    """ Closed-form up-sampling of CondModuleHnSincNSF (scriptable)
+    FusedUpSampling(m_cond)
+
+    The nearest up-sampling, the two moving averages of l_upsamp and
+    l_upsamp_f0_hi and the cut-off frequency smoothing l_cut_f_smooth
+    computed directly from the frames with FrameInterpolation layers:
+    no pass over the (batchsize, length * up_sample, dim) intermediate
+    tensors, same output as CondModuleHnSincNSF.forward
+
+    context, f0_upsamp, cut_f, hidden_cut_f = FusedUpSampling(hidden,
+                                                  f0_norm, f0)
+    hidden: output of the convolutions (batchsize, length, output_dim)
+    f0_norm: normalized F0 (batchsize, length, 1)
+    f0: F0 (batchsize, length, 1)
+
+    forward_step: same output on the next frames (streaming inference of
+    CondModuleHnSincNSF)
+    """
+    def __init__(self, m_cond):
+        super(FusedUpSampling, self).__init__()
+        self.output_dim = int(m_cond.output_dim)
+        self.up_sample = int(m_cond.up_sample)
+        self.voiced_threshold = float(m_cond.voiced_threshold)
+        smooth = [(int(l_ave.kernel_size[0]), int(l_ave.pad_le)) \
+                  for l_ave in (m_cond.l_upsamp.l_ave2, m_cond.l_upsamp.l_ave1)]
+        l_cut_f_smooth = m_cond.l_cut_f_smooth
+        self.cut_f_window = int(l_cut_f_smooth.kernel_size[0])
+        self.cut_f_pads = [int(l_cut_f_smooth.pad_le), \
+                           int(l_cut_f_smooth.pad_ri)]
+        cut_f = [(self.cut_f_window, self.cut_f_pads[0])]
+        # hidden features and normalized F0 (same smoothing)
+        self.l_upsamp = FrameInterpolation(self.up_sample, smooth)
+        # smoothed cut-off frequency: hidden feature and U/V parts
+        self.l_cut_f = FrameInterpolation(self.up_sample, smooth + cut_f)
+        self.l_uv = FrameInterpolation(self.up_sample, cut_f)
+
+    def forward(self, hidden, f0_norm, f0):
+        dim = self.output_dim
+        tmp = self.l_upsamp(torch.cat((hidden, f0_norm), dim=2))
+        context = torch.cat((tmp[:, :, 0:dim-1], tmp[:, :, dim:]), dim=2)
+        hidden_cut_f = tmp[:, :, dim-1:dim]
+        f0_upsamp = torch.repeat_interleave(f0, self.up_sample, 1)
+
+        # get_cut_f is affine: smooth the hidden feature and U/V parts
+        uv = (f0 > self.voiced_threshold).to(f0.dtype)
+        cut_f = self.l_cut_f(hidden[:, :, dim-1:]) * 0.2 \
+                + self.l_uv(uv) * 0.4 + 0.3
+
+        # l_cut_f_smooth pads with the first / last sample of hidden_cut_f,
+        # l_cut_f with the first / last frame: add the difference times
+        # the number of padded samples in the window of each output sample
+        pad_le, pad_ri = self.cut_f_pads[0], self.cut_f_pads[1]
+        length = cut_f.shape[1]
+        n_le, n_ri = min(pad_le, length), min(pad_ri, length)
+        edge_le = (hidden_cut_f[:, 0:1] - hidden[:, 0:1, dim-1:]) * 0.2
+        edge_ri = (hidden_cut_f[:, -1:] - hidden[:, -1:, dim-1:]) * 0.2
+        ramp_le = (pad_le - torch.arange(n_le, device=f0.device)) \
+                  .to(f0.dtype) / self.cut_f_window
+        ramp_ri = (pad_ri - n_ri + 1 \
+                   + torch.arange(n_ri, device=f0.device)) \
+                  .to(f0.dtype) / self.cut_f_window
+        cut_f[:, 0:n_le] += edge_le * ramp_le.unsqueeze(-1)
+        cut_f[:, length-n_ri:] += edge_ri * ramp_ri.unsqueeze(-1)
+        return context, f0_upsamp, cut_f, hidden_cut_f
+
+    def init_state(self):
+        """ state = init_state(self)
+        states of the interpolations, the first / last values of the
+        hidden feature of the cut-off frequency (edges, see forward),
+        the number of samples of cut_f released (up to pad_le) and the
+        frames and samples waiting for the slowest input (pending_*)
+        """
+        return {'upsamp': self.l_upsamp.init_state(),
+                'cut_f': self.l_cut_f.init_state(),
+                'uv': self.l_uv.init_state(),
+                'hidden_first': None, 'hidden_last': None,
+                'upsamp_first': None, 'upsamp_last': None,
+                'cut_f_pos': 0,
+                'pending_in': [None] * 2,
+                'pending_cut_f': [None] * 2,
+                'pending_out': [None] * 4}
+
+    def forward_step(self, hidden, f0_norm, f0, state, flush=False):
+        """ context, f0_upsamp, cut_f, hidden_cut_f = forward_step(
+                self, hidden, f0_norm, f0, state, flush=False)
+        Same as forward() on the next frames of hidden, f0_norm and f0
+        (hidden may lag behind, the convolutions look ahead). The outputs
+        are released with a latency, flush=True on the last frames
+        releases the rest
+        """
+        dim = self.output_dim
+        hidden, f0_norm = stream_align(state['pending_in'], [hidden, f0_norm])
+        if hidden.shape[1] > 0:
+            if state['hidden_first'] is None:
+                state['hidden_first'] = hidden[:, 0:1, dim-1:]
+            state['hidden_last'] = hidden[:, -1:, dim-1:]
+        tmp = self.l_upsamp.forward_step(torch.cat((hidden, f0_norm), dim=2),
+                                         state['upsamp'], flush)
+        context = torch.cat((tmp[:, :, 0:dim-1], tmp[:, :, dim:]), dim=2)
+        hidden_cut_f = tmp[:, :, dim-1:dim]
+        if hidden_cut_f.shape[1] > 0:
+            if state['upsamp_first'] is None:
+                state['upsamp_first'] = hidden_cut_f[:, 0:1]
+            state['upsamp_last'] = hidden_cut_f[:, -1:]
+        f0_upsamp = torch.repeat_interleave(f0, self.up_sample, 1)
+
+        uv = (f0 > self.voiced_threshold).to(f0.dtype)
+        cut_f_hid, cut_f_uv = stream_align(
+            state['pending_cut_f'],
+            [self.l_cut_f.forward_step(hidden[:, :, dim-1:], \
+                                       state['cut_f'], flush),
+             self.l_uv.forward_step(uv, state['uv'], flush)])
+        cut_f = cut_f_hid * 0.2 + cut_f_uv * 0.4 + 0.3
+
+        # edges of the cut-off frequency, as in forward: the first pad_le
+        # samples of the sequence and the last pad_ri ones (flush)
+        pad_le, pad_ri = self.cut_f_pads[0], self.cut_f_pads[1]
+        length = cut_f.shape[1]
+        pos = state['cut_f_pos']
+        if pos < pad_le and length > 0:
+            n_le = min(pad_le - pos, length)
+            edge_le = (state['upsamp_first'] - state['hidden_first']) * 0.2
+            ramp_le = (pad_le - pos - torch.arange(n_le, device=f0.device)) \
+                      .to(f0.dtype) / self.cut_f_window
+            cut_f[:, 0:n_le] += edge_le * ramp_le.unsqueeze(-1)
+            state['cut_f_pos'] = min(pad_le, pos + length)
+        if flush and length > 0:
+            n_ri = min(pad_ri, length)
+            edge_ri = (state['upsamp_last'] - state['hidden_last']) * 0.2
+            ramp_ri = (pad_ri - n_ri + 1 \
+                       + torch.arange(n_ri, device=f0.device)) \
+                      .to(f0.dtype) / self.cut_f_window
+            cut_f[:, length-n_ri:] += edge_ri * ramp_ri.unsqueeze(-1)
+        return stream_align(state['pending_out'], [context, f0_upsamp, \
+                                                   cut_f, hidden_cut_f])
+
+
 # For source module
 class SourceModuleHnNSF(torch_nn.Module):
     """ SourceModule for hn-nsf 
@@ -702,19 +1614,55 @@ class SourceModuleHnNSF(torch_nn.Module):
         self.l_linear = torch_nn.Linear(harmonic_num+1, 1)
         self.l_tanh = torch_nn.Tanh()
 
-    def forward(self, x):
+    def forward(self, x, phase_ini=None, noise_offset=0, harmonic_num=None):
         """
         Sine_source, noise_source = SourceModuleHnNSF(F0_sampled)
         F0_sampled (batchsize, length, 1)
+        phase_ini (batchsize, harmonic_num+1), see SineGen.forward
+        noise_offset: position of the first sample in the noise table
+        harmonic_num: only merge the first overtones (None: all of them)
         Sine_source (batchsize, length, 1)
         noise_source (batchsize, length 1)
         """
         # source for harmonic branch
-        sine_wavs, uv, _ = self.l_sin_gen(x)
-        sine_merge = self.l_tanh(self.l_linear(sine_wavs))
+        sine_wavs, uv, _ = self.l_sin_gen(x, phase_ini, noise_offset,
+                                          harmonic_num)
+        sine_merge = self.l_tanh(self._merge(sine_wavs))
 
         # source for noise branch, in the same shape as uv
-        noise = torch.randn_like(uv) * self.sine_amp / 3
+        noise = self.l_sin_gen.noise_like(uv, noise_offset, \
+                                          self.l_sin_gen.dim) \
+                * self.sine_amp / 3
+        return sine_merge, noise, uv
+
+    def _merge(self, sine_wavs):
+        """ linear merge of the harmonics, restricted to the first ones
+        when only some of them are generated (harmonic_num)
+        """
+        dim = sine_wavs.shape[-1]
+        if dim == self.l_linear.in_features:
+            return self.l_linear(sine_wavs)
+        return torch_nn_func.linear(sine_wavs, \
+                                    self.l_linear.weight[:, 0:dim], \
+                                    self.l_linear.bias)
+
+    def init_state(self, noise_offset=None, phase_ini=None):
+        """ state = init_state(self, noise_offset=None, phase_ini=None)
+        """
+        return {'sin_gen': self.l_sin_gen.init_state(noise_offset, \
+                                                     phase_ini)}
+
+    def forward_step(self, x, state, harmonic_num=None):
+        """ Sine_source, noise_source, uv = forward_step(self, x, state,
+                                                         harmonic_num=None)
+        Same as forward() on the next samples of F0_sampled
+        """
+        pos = self.l_sin_gen._step_pos(x, state['sin_gen'])
+        sine_wavs, uv, _ = self.l_sin_gen.forward_step(x, state['sin_gen'],
+                                                       harmonic_num)
+        sine_merge = self.l_tanh(self._merge(sine_wavs))
+        noise = self.l_sin_gen.noise_like(uv, pos, self.l_sin_gen.dim) \
+                * self.sine_amp / 3
         return sine_merge, noise, uv
         
         
@@ -730,18 +1678,33 @@ class FilterModuleHnSincNSF(torch_nn.Module):
     block_num: number of neural filter blocks in harmonic branch
     kernel_size: kernel size in dilated CNN
     conv_num_in_block: number of d-conv1d in one neural filter block
+    fir_engine: engine of the time-variant FIR filter ('roll' or 'unfold')
+
+    The harmonic and noise branches are independent until the final sum:
+    set_concurrent_branches(True) runs the harmonic blocks in a worker
+    thread while the noise branch runs in the calling thread
+
+    quality (see Quality): cheaper approximation with shorter sinc
+    filters and / or only the first filter blocks of the harmonic branch
+    (the blocks are residual, a skipped block is the identity)
 
     Usage:
-    output = FilterModuleHnSincNSF(har_source, noi_source, cut_f, context)
+    output = FilterModuleHnSincNSF(har_source, noi_source, cut_f, context,
+                                   quality = None)
     har_source: source for harmonic branch (batchsize, length, dim=1)
     noi_source: source for noise branch (batchsize, length, dim=1)
     cut_f: cut-off-frequency of sinc filters (batchsize, length, dim=1)
     context: hidden features to be added (batchsize, length, dim)
     output: (batchsize, length, dim=1)    
     """
+    # run the two branches concurrently (class default: checkpoints
+    # pickled before this option load with the serial execution)
+    concurrent_branches = False
+
     def __init__(self, signal_size, hidden_size, sinc_order = 31, \
-                 block_num = 5, kernel_size = 3, conv_num_in_block = 10):
-        super(FilterModuleHnSincNSF, self).__init__()        
+                 block_num = 5, kernel_size = 3, conv_num_in_block = 10, \
+                 fir_engine = 'unfold'):
+        super(FilterModuleHnSincNSF, self).__init__()
         self.signal_size = signal_size
         self.hidden_size = hidden_size
         self.kernel_size = kernel_size
@@ -763,32 +1726,198 @@ class FilterModuleHnSincNSF(torch_nn.Module):
 
         # sinc filter generators and time-variant filtering layer
         self.l_sinc_coef = SincFilter(self.sinc_order)
-        self.l_tv_filtering = TimeVarFIRFilter()
+        self.l_tv_filtering = TimeVarFIRFilter(fir_engine)
         # done
-        
 
-    def forward(self, har_component, noi_component, cond_feat, cut_f):
+    def build_sinc_table(self, table_size = 1024, interpolate = True):
+        """ build_sinc_table(self, table_size = 1024, interpolate = True)
+        Replace the sinc filter generator by a SincFilterBank lookup
+        table (built once, on the device of the module)
         """
+        device = self.l_har_blocks[0].scale.device
+        self.l_sinc_table = SincFilterBank(self.sinc_order, table_size,
+                                           interpolate = interpolate)
+        self.l_sinc_table = self.l_sinc_table.to(device)
+
+    def remove_sinc_table(self):
+        """ remove_sinc_table(self)
+        Go back to computing the exact sinc filters
         """
-        # harmonic component
-        for l_har_block in self.l_har_blocks:
-            har_component = l_har_block(har_component, cond_feat)
+        if 'l_sinc_table' in self._modules:
+            del self.l_sinc_table
+
+    def set_concurrent_branches(self, flag = True):
+        """ set_concurrent_branches(self, flag = True)
+        Run the harmonic branch in a worker thread, concurrently with the
+        noise branch (same output)
+        """
+        self.concurrent_branches = flag
+
+    def _har_branch(self, har_component, cond_feat, states = None, \
+                    n_blocks = None):
+        """ harmonic filter blocks (forward_step if states is given), the
+        first n_blocks only if given
+        """
+        n_blocks = len(self.l_har_blocks) if n_blocks is None else n_blocks
+        for idx, l_har_block in enumerate(self.l_har_blocks[0:n_blocks]):
+            if states is None:
+                har_component = l_har_block(har_component, cond_feat)
+            else:
+                har_component = l_har_block.forward_step(
+                    har_component, cond_feat, states[idx])
+        return har_component
+
+    def _noi_branch(self, noi_component, cond_feat, states = None):
+        """ noise filter blocks (forward_step if states is given)
+        """
+        for idx, l_noi_block in enumerate(self.l_noi_blocks):
+            if states is None:
+                noi_component = l_noi_block(noi_component, cond_feat)
+            else:
+                noi_component = l_noi_block.forward_step(
+                    noi_component, cond_feat, states[idx])
+        return noi_component
+
+    def _start_har_branch(self, har_component, cond_feat, states = None, \
+                          n_blocks = None):
+        """ future = _start_har_branch(self, har_component, cond_feat,
+                                          states = None, n_blocks = None)
+        Harmonic blocks in the worker thread, with the grad mode of the
+        calling thread (grad mode is thread-local)
+        """
+        grad_enabled = torch.is_grad_enabled()
+        def _run():
+            with torch.set_grad_enabled(grad_enabled):
+                return self._har_branch(har_component, cond_feat, states, \
+                                        n_blocks)
+        return _branch_executor().submit(_run)
+
+    def _sinc_coefs(self, cut_f, quality = None):
+        """ sinc filter coefficients (from the lookup table if built, or
+        from the filters of the quality)
+        """
+        if quality is not None and quality.l_sinc is not None:
+            return quality.l_sinc(cut_f)
+        if 'l_sinc_table' in self._modules:
+            return self.l_sinc_table(cut_f)
+        return self.l_sinc_coef(cut_f)
+
+    def forward(self, har_component, noi_component, cond_feat, cut_f, \
+                quality = None):
+        """
+        """
+        n_blocks = None if quality is None else quality.har_blocks
+        if self.concurrent_branches:
+            har_future = self._start_har_branch(har_component, cond_feat, \
+                                                None, n_blocks)
+        else:
+            # harmonic component
+            har_component = self._har_branch(har_component, cond_feat, \
+                                             None, n_blocks)
         # noise componebt
-        for l_noi_block in self.l_noi_blocks:
-            noi_component = l_noi_block(noi_component, cond_feat)
+        noi_component = self._noi_branch(noi_component, cond_feat)
         
-        # get sinc filter coefficients
-        lp_coef, hp_coef = self.l_sinc_coef(cut_f)
+        # get sinc filter coefficients (from the lookup table if built)
+        lp_coef, hp_coef = self._sinc_coefs(cut_f, quality)
 
         # time-variant filtering
-        har_signal = self.l_tv_filtering(har_component, lp_coef)
         noi_signal = self.l_tv_filtering(noi_component, hp_coef)
+        if self.concurrent_branches:
+            har_component = har_future.result()
+        har_signal = self.l_tv_filtering(har_component, lp_coef)
 
         # get output 
         return har_signal + noi_signal
+
+    def init_state(self):
+        """ state = init_state(self)
+        """
+        return {'har_blocks': [l_blk.init_state() \
+                               for l_blk in self.l_har_blocks],
+                'noi_blocks': [l_blk.init_state() \
+                               for l_blk in self.l_noi_blocks],
+                'har_filtering': self.l_tv_filtering.init_state(),
+                'noi_filtering': self.l_tv_filtering.init_state()}
+
+    def forward_step(self, har_component, noi_component, cond_feat, cut_f,
+                     state, quality = None):
+        """ output = forward_step(self, har_component, noi_component,
+                                  cond_feat, cut_f, state, quality = None)
+        Same as forward() on the next samples of the inputs, all the
+        layers are causal: output has the same length as the inputs
+        """
+        n_blocks = None if quality is None else quality.har_blocks
+        if self.concurrent_branches:
+            har_future = self._start_har_branch(har_component, cond_feat,
+                                                state['har_blocks'], n_blocks)
+        else:
+            har_component = self._har_branch(har_component, cond_feat,
+                                             state['har_blocks'], n_blocks)
+        noi_component = self._noi_branch(noi_component, cond_feat,
+                                         state['noi_blocks'])
+        lp_coef, hp_coef = self._sinc_coefs(cut_f, quality)
+        noi_signal = self.l_tv_filtering.forward_step(
+            noi_component, hp_coef, state['noi_filtering'])
+        if self.concurrent_branches:
+            har_component = har_future.result()
+        har_signal = self.l_tv_filtering.forward_step(
+            har_component, lp_coef, state['har_filtering'])
+        return har_signal + noi_signal
         
         
 
+_branch_pool = None
+_branch_pool_lock = threading.Lock()
+
+def _branch_executor():
+    """ worker thread of the concurrent filter branches (created on
+    first use, shared by all the FilterModuleHnSincNSF instances, under
+    a lock so that concurrent first callers share a single pool)
+    """
+    global _branch_pool
+    with _branch_pool_lock:
+        if _branch_pool is None:
+            _branch_pool = concurrent.futures.ThreadPoolExecutor(
+                max_workers=1)
+        return _branch_pool
+
+
+class Quality():
+    """ Cheaper approximation of a Model, without retraining
+    Quality(model, harmonic_num = None, sinc_order = None,
+            har_blocks = None)
+
+    harmonic_num: number of overtones of the sine source
+    sinc_order: order of the sinc filters (a lookup table if the model
+                has one, see build_sinc_table)
+    har_blocks: number of filter blocks of the harmonic branch
+    None: as in the model
+
+    Given to Model.forward / Model.forward_step: the model itself is not
+    modified, so that renders of different qualities can share it (also
+    from different threads). The shorter sinc filters are built here,
+    outside of the model. The streaming state depends on the quality: a
+    stream started with one quality must be continued with it
+    """
+    def __init__(self, model, harmonic_num = None, sinc_order = None, \
+                 har_blocks = None):
+        m_filter = model.m_filter
+        self.harmonic_num = harmonic_num
+        self.har_blocks = har_blocks
+        self.sinc_order = sinc_order
+        # sinc filters of the quality, None: those of the model
+        self.l_sinc = None
+        if sinc_order is not None and sinc_order < m_filter.sinc_order:
+            if 'l_sinc_table' in m_filter._modules:
+                self.l_sinc = SincFilterBank(sinc_order, \
+                                             m_filter.l_sinc_table.table_size,
+                                             interpolate = \
+                                             m_filter.l_sinc_table.interpolate)
+            else:
+                self.l_sinc = SincFilter(sinc_order)
+            self.l_sinc = self.l_sinc.to(model.input_mean.device)
+
+
 ## FOR MODEL
 class Model(torch_nn.Module):
     """ Model definition
@@ -893,11 +2022,13 @@ class Model(torch_nn.Module):
         """
         return y * self.output_std + self.output_mean
     
-    def forward(self, x):
+    def forward(self, x, quality=None):
         """ definition of forward method 
         Assume x (batchsize=1, length, dim)
         Return output(batchsize=1, length)
+        quality: cheaper approximation (see Quality), None: full model
         """
+        harmonic_num = None if quality is None else quality.harmonic_num
         # assume x[:, :, -1] is F0, denormalize F0
         f0 = x[:, :, -1:]
         # normalize the input features data
@@ -910,11 +2041,13 @@ class Model(torch_nn.Module):
 
         # source module
         # harmonic-source, noise-source (for noise branch), uv
-        har_source, noi_source, uv = self.m_source(f0_upsamped)
+        har_source, noi_source, uv = self.m_source(f0_upsamped, \
+                                                   harmonic_num=harmonic_num)
         
         # neural filter module (including sinc-based FIR filtering)
         # output
-        output = self.m_filter(har_source, noi_source, cond_feat, cut_f)
+        output = self.m_filter(har_source, noi_source, cond_feat, cut_f, \
+                               quality)
         
         #if self.training:
             # just in case we need to penalize the hidden feauture for 
@@ -922,6 +2055,70 @@ class Model(torch_nn.Module):
         #    return [output.squeeze(-1), hid_cut_f]
         #else:
         return output.squeeze(-1)
+
+    def set_source_noise(self, flag_noise):
+        """ set_source_noise(self, flag_noise)
+        flag_noise: False to generate without initial phase noise nor
+                    additive noise in the source module (deterministic)
+        """
+        self.m_source.l_sin_gen.flag_noise = flag_noise
+
+    def get_source_noise(self):
+        """ flag_noise = get_source_noise(self)
+        current setting of set_source_noise, to restore it
+        """
+        return self.m_source.l_sin_gen.flag_noise
+
+    def set_noise_table(self, seed=0, size=2 ** 17):
+        """ set_noise_table(self, seed=0, size=2 ** 17)
+        Seeded source noise: the same input gives the same output (see
+        SineGen.set_noise_table), seed=None for random noise
+        """
+        if seed is None:
+            self.m_source.l_sin_gen.remove_noise_table()
+        else:
+            self.m_source.l_sin_gen.set_noise_table(
+                size, seed, self.input_mean.device)
+
+    def init_state(self, noise_offset=None, phase_ini=None):
+        """ state = init_state(self, noise_offset=None, phase_ini=None)
+        State of the streaming inference, see forward_step
+        noise_offset: position of the first sample in the noise table
+                      (int or tensor (batchsize,), see set_noise_table)
+        phase_ini: initial phase of the sines (batchsize, harmonic_num+1)
+                   to start the stream in the middle of a sequence (see
+                   receptive.start_phase), None: as in forward()
+        """
+        return {'cond': self.m_cond.init_state(),
+                'source': self.m_source.init_state(noise_offset, phase_ini),
+                'filter': self.m_filter.init_state()}
+
+    def forward_step(self, x, state, flush=False, quality=None):
+        """ output = forward_step(self, x, state, flush=False, quality=None)
+        Streaming inference
+        x: next frames (batchsize, length, dim), can be empty
+        state: from init_state(), updated in place
+        flush: x contains the last frames of the sequence
+        quality: cheaper approximation (see Quality), the same for all
+                 the steps of a stream, None: full model
+        output: (batchsize, length_out), next samples of the waveform
+
+        Successive calls return, once concatenated, the same waveform as
+        forward() on the concatenation of the frames. The condition
+        module looks ahead of the current frame, so that the samples of
+        the last frames are only released by flush=True.
+        """
+        f0 = x[:, :, -1:]
+        feat = self.normalize_input(x)
+        cond_feat, f0_upsamped, cut_f, _ = self.m_cond.forward_step(
+            feat, f0, state['cond'], flush)
+        harmonic_num = None if quality is None else quality.harmonic_num
+        har_source, noi_source, _ = self.m_source.forward_step(
+            f0_upsamped, state['source'], harmonic_num)
+        output = self.m_filter.forward_step(har_source, noi_source, \
+                                            cond_feat, cut_f, state['filter'],
+                                            quality)
+        return output.squeeze(-1)
     
     
 class Loss():
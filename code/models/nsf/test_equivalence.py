@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+"""
+test_equivalence.py for the hn-sinc-NSF model in sinc_nsf.py
+
+Equivalence tests of the inference engines against the reference
+forward pass: FIR engines, continuous sines, streaming, chunked
+generation, long-form rendering, closed-form up-sampling, seeded noise
+and TorchScript export. Each test is independent and compares with a tolerance
+relative to the magnitude of the reference.
+
+The tests use the pickled model given by the NSF_MODEL environment
+variable, or an untrained model with the default configuration.
+
+Usage: $: python -m pytest models/nsf/test_equivalence.py
+       $: python -m models.nsf.test_equivalence  (from the code/ directory)
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+
+import os
+import sys
+import traceback
+import torch
+
+from models.nsf import benchmark
+from models.nsf import export
+from models.nsf import longform
+from models.nsf import receptive
+from models.nsf import sinc_nsf
+
+# relative tolerance of the float32 engines (different summation orders)
+RTOL = 1e-4
+# chunks restart from the phase of the sines accumulated in float64, the
+# forward pass accumulates it in float32 over the whole sequence
+CHUNK_RTOL = 1e-3
+
+_models = {}
+
+
+def _model():
+    """ model of the tests, loaded once
+    """
+    if 'model' not in _models:
+        _models['model'] = benchmark.load_model(os.environ.get('NSF_MODEL'))
+    return _models['model']
+
+
+def _stream(model, x, step, state):
+    """ concatenated output of forward_step on steps of step frames
+    """
+    return torch.cat([model.forward_step(x[:, st:st + step], state,
+                                         flush=st + step >= x.shape[1])
+                      for st in range(0, x.shape[1], step)], dim=1)
+
+
+def _assert_close(output, ref, name, rtol=RTOL):
+    assert output.shape == ref.shape, "{:s}: shape {} != {}".format(
+        name, tuple(output.shape), tuple(ref.shape))
+    err = benchmark.max_rel_err(output, ref)
+    assert err < rtol, "{:s}: max_rel_err {:.2e} >= {:.0e}".format(
+        name, err, rtol)
+
+
+def test_fir_engines():
+    # longer than two chunks of the unfold engine, last chunk partial
+    length = 2 * sinc_nsf.TimeVarFIRFilter.chunk_size + 1000
+    signal = torch.randn(1, length, 1)
+    f_coef = torch.randn(1, length, 31) / 31
+    with torch.no_grad():
+        ref = sinc_nsf.TimeVarFIRFilter('roll')(signal, f_coef)
+        output = sinc_nsf.TimeVarFIRFilter('unfold')(signal, f_coef)
+    _assert_close(output, ref, "unfold engine", 1e-5)
+
+
+def test_sine_continuity():
+    l_sin_gen = sinc_nsf.SineGen(22050, 16)
+    l_sin_gen.flag_noise = False
+    f0 = torch.repeat_interleave(torch.rand(1, 60, 1) * 400 + 50, 512,
+                                 dim=1)
+    with torch.no_grad():
+        ref = l_sin_gen(f0)[0]
+        l_sin_gen.flag_continuous = True
+        l_sin_gen.reset_phase()
+        output = torch.cat([l_sin_gen(f0[:, st:st + 7680])[0]
+                            for st in range(0, f0.shape[1], 7680)], dim=1)
+    _assert_close(output, ref, "continuous sines")
+
+
+def test_streaming():
+    model = _model()
+    x = benchmark.random_features(40)
+    flag_noise = model.get_source_noise()
+    model.set_source_noise(False)
+    try:
+        with torch.no_grad():
+            ref = model(x)
+            for step in (1, 3, 15):
+                _assert_close(_stream(model, x, step, model.init_state()),
+                              ref, "{:d} frames per step".format(step))
+    finally:
+        model.set_source_noise(flag_noise)
+
+
+def test_chunked():
+    model = _model()
+    x = benchmark.random_features(64)
+    rf = receptive.receptive_field(model)
+    flag_noise = model.get_source_noise()
+    model.set_source_noise(False)
+    try:
+        with torch.no_grad():
+            ref = model(x)
+            for chunk in (1, 7, 15):
+                _assert_close(receptive.generate_chunked(model, x, chunk, rf),
+                              ref, "chunks of {:d} frames".format(chunk),
+                              CHUNK_RTOL)
+    finally:
+        model.set_source_noise(flag_noise)
+
+
+def test_render_long():
+    model = _model()
+    x = benchmark.random_features(40)
+    flag_noise = model.get_source_noise()
+    model.set_source_noise(False)
+    try:
+        with torch.no_grad():
+            ref = model(x)
+        output, report = longform.render_long(model, x, max_frames=7)
+    finally:
+        model.set_source_noise(flag_noise)
+    assert report['frames per step'] <= 7
+    _assert_close(torch.from_numpy(output), ref, "long-form rendering")
+
+
+def test_stream_start_phase():
+    # a stream started in the middle of the sequence, with the receptive
+    # field as warm-up (re-render after a CV change)
+    model = _model()
+    x = benchmark.random_features(80)
+    left = receptive.receptive_field(model)['left_frames']
+    up_sample = int(model.m_cond.up_sample)
+    model.set_noise_table(0)
+    try:
+        with torch.no_grad():
+            ref = _stream(model, x, 15, model.init_state())
+            start = x.shape[1] - 20
+            warmup = max(0, start - left)
+            state = model.init_state(warmup * up_sample,
+                                     receptive.start_phase(model, x, warmup))
+            output = _stream(model, x[:, warmup:], 15, state)
+        _assert_close(output[:, (start - warmup) * up_sample:],
+                      ref[:, start * up_sample:], "stream from the middle",
+                      CHUNK_RTOL)
+    finally:
+        model.set_noise_table(None)
+
+
+def test_fused_upsampling():
+    model = _model()
+    features = benchmark.random_features(30)
+    x = model.normalize_input(features)
+    f0 = features[:, :, -1:]
+    m_cond = model.m_cond
+    fused = 'l_fused_upsamp' in m_cond._modules
+    try:
+        with torch.no_grad():
+            m_cond.remove_fused_upsampling()
+            ref = m_cond(x, f0)
+            m_cond.build_fused_upsampling()
+            output = m_cond(x, f0)
+            # streaming version of the fused up-sampling
+            streams = {}
+            for step in (1, 3, 15):
+                state = m_cond.init_state()
+                steps = [m_cond.forward_step(x[:, st:st + step],
+                                             f0[:, st:st + step], state,
+                                             flush=st + step >= x.shape[1])
+                         for st in range(0, x.shape[1], step)]
+                streams[step] = [torch.cat(out, dim=1) for out in zip(*steps)]
+    finally:
+        if not fused:
+            m_cond.remove_fused_upsampling()
+    for idx, (out, out_ref) in enumerate(zip(output, ref)):
+        _assert_close(out, out_ref,
+                      "fused up-sampling output {:d}".format(idx))
+    for step, stream in streams.items():
+        for idx, (out, out_ref) in enumerate(zip(stream, ref)):
+            _assert_close(out, out_ref, "fused up-sampling output {:d}, "
+                          "{:d} frames per step".format(idx, step))
+
+
+def test_seeded_noise():
+    model = _model()
+    x = benchmark.random_features(40, 2)
+    offset = torch.tensor([12345, 987654321])
+    model.set_noise_table(0)
+    try:
+        with torch.no_grad():
+            ref = model(x)
+            assert torch.equal(ref, model(x)), "seeded renders differ"
+            _assert_close(_stream(model, x, 7, model.init_state()), ref,
+                          "seeded streaming")
+            _assert_close(receptive.generate_chunked(model, x), ref,
+                          "seeded chunked generation", CHUNK_RTOL)
+            script_model = torch.jit.freeze(torch.jit.script(
+                export.ScriptNSF(model).eval()))
+            _assert_close(script_model(x), ref, "seeded torchscript")
+            # streams at different positions of the noise table
+            output = _stream(model, x, 7, model.init_state(offset))
+            _assert_close(output, script_model(x, None, offset),
+                          "streaming at noise offsets")
+    finally:
+        model.set_noise_table(None)
+
+
+def test_export():
+    model = _model()
+    x = benchmark.random_features(16)
+    script_model = torch.jit.freeze(torch.jit.script(
+        export.ScriptNSF(model, flag_noise=False).eval()))
+    flag_noise = model.get_source_noise()
+    model.set_source_noise(False)
+    try:
+        with torch.no_grad():
+            _assert_close(script_model(x), model(x), "torchscript")
+    finally:
+        model.set_source_noise(flag_noise)
+
+
+if __name__ == "__main__":
+    failures = []
+    for name, test in sorted(globals().items()):
+        if not (name.startswith('test_') and callable(test)):
+            continue
+        try:
+            test()
+            print("{:s}: ok".format(name))
+        except Exception:
+            failures.append(name)
+            print("{:s}: FAILED".format(name))
+            traceback.print_exc()
+    if len(failures) > 0:
+        print("{:d} failed: {:s}".format(len(failures), ", ".join(failures)))
+        sys.exit(1)
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+"""
+test_tiers.py for the quality / latency tiers in tiers.py
+
+Tests of the tiers: streaming inference of each tier against its
+forward pass, tiers leaving the model unchanged, and the automatic
+choice of the tier from the real-time factor.
+
+The tests use the pickled model given by the NSF_MODEL environment
+variable, or an untrained model with the default configuration.
+
+Usage: $: python -m pytest models/nsf/test_tiers.py
+       $: python -m models.nsf.test_tiers  (from the code/ directory)
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+
+import os
+import sys
+import traceback
+
+from models.nsf import benchmark
+from models.nsf import tiers
+
+# relative tolerance of the float32 engines (different summation orders)
+RTOL = 1e-4
+
+
+def test_tier_streaming():
+    model = benchmark.load_model(os.environ.get('NSF_MODEL'))
+    keys = list(model.state_dict())
+    tier_set = tiers.TierSet(model)
+    # the qualities live outside the model (nothing added to its pickle)
+    assert list(model.state_dict()) == keys
+    for name in tier_set.names:
+        tier_model, quality = tier_set.get(name)
+        report = benchmark.check_streaming(tier_model, 40, (1, 15), RTOL,
+                                           quality)
+        assert report['match'], "{:s}: {}".format(name, report)
+
+
+def test_tier_monitor():
+    monitor = tiers.TierMonitor([1.0, 0.5, 0.25], max_rtf=0.9,
+                                target_rtf=0.6, hold=8)
+    # too slow: the cheapest tier expected below target_rtf
+    assert monitor.update(0.95, 1.0) == 1
+    # back to the best tier after hold steps where it is expected to fit
+    for _ in range(7):
+        assert monitor.update(0.3, 1.0) == 1
+    assert monitor.update(0.3, 1.0) == 0
+    assert monitor.n_switches == 2
+    # far too slow for any tier: the fastest one
+    assert monitor.update(5.0, 1.0) == 2
+
+
+if __name__ == "__main__":
+    failures = []
+    for name, test in sorted(globals().items()):
+        if not (name.startswith('test_') and callable(test)):
+            continue
+        try:
+            test()
+            print("{:s}: ok".format(name))
+        except Exception:
+            failures.append(name)
+            print("{:s}: FAILED".format(name))
+            traceback.print_exc()
+    if len(failures) > 0:
+        print("{:d} failed: {:s}".format(len(failures), ", ".join(failures)))
+        sys.exit(1)
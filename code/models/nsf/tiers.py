@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+"""
+tiers.py for the hn-sinc-NSF model in sinc_nsf.py
+
+Quality / latency tiers of the streaming inference
+
+A tier is a cheaper approximation of the trained model, without
+retraining (sinc_nsf.Quality): fewer overtones in the sine source,
+shorter sinc filters and fewer filter blocks in the harmonic branch
+(the blocks are residual, a skipped block is the identity). The tiers
+share the model, the quality is given with each call. A smaller
+distilled checkpoint can be added as the last tier. TierMonitor follows
+the real-time factor of the rendering (processing time / duration of
+the audio) and moves to a cheaper tier when it gets close to 1, back to
+a better one when the better tier is expected to fit again.
+
+Usage: $: python -m models.nsf.tiers model.th [distilled.th]
+       (from the code/ directory)
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+
+import sys
+import time
+from collections import OrderedDict
+import torch
+
+from models.nsf import quantize
+from models.nsf import sinc_nsf
+
+# name: arguments of sinc_nsf.Quality, from the best to the fastest
+TIERS = OrderedDict([
+    ('full', {}),
+    ('reduced', {'harmonic_num': 8, 'sinc_order': 21, 'har_blocks': 4}),
+    ('fast', {'harmonic_num': 4, 'sinc_order': 15, 'har_blocks': 3}),
+    ('preview', {'harmonic_num': 2, 'sinc_order': 9, 'har_blocks': 1}),
+])
+
+
+class TierSet():
+    """ Models and qualities of the tiers
+    TierSet(model, tiers=TIERS, distilled=None)
+
+    model: sinc_nsf.Model
+    tiers: name -> arguments of sinc_nsf.Quality, best tier first
+    distilled: optional smaller sinc_nsf.Model, added as the last tier
+               ('distilled', full quality of that model)
+
+    names: names of the tiers, from the best to the fastest
+    model, quality = get(name): model of the tier and the quality to
+        give to its forward / forward_step (the model is not modified)
+    """
+    def __init__(self, model, tiers=TIERS, distilled=None):
+        self.models = OrderedDict()
+        self.qualities = OrderedDict()
+        for name, quality in tiers.items():
+            self.models[name] = model
+            self.qualities[name] = sinc_nsf.Quality(model, **quality)
+        if distilled is not None:
+            self.models['distilled'] = distilled
+            self.qualities['distilled'] = sinc_nsf.Quality(distilled)
+        self.names = list(self.models)
+
+    def get(self, name):
+        return self.models[name], self.qualities[name]
+
+
+def _random_features(model, length, batch=1):
+    """ random impact features (batchsize, length, 7) on the device of
+        the model
+    """
+    device = model.input_mean.device
+    scale = torch.tensor([0.1, 0.05, 1700, 0.1, 1000, 900, 300],
+                         device=device)
+    return torch.rand(batch, length, 7, device=device) * scale
+
+
+def step_cost(model, step=15, n_steps=4, batch=1, quality=None):
+    """ duration = step_cost(model, step, n_steps, batch, quality)
+    Average duration (s) of one Model.forward_step of step frames in
+    steady state, with the given quality (sinc_nsf.Quality)
+    """
+    x = _random_features(model, step * (n_steps + 2), batch)
+    state = model.init_state()
+    with torch.no_grad():
+        # first steps: filling of the look-ahead of the condition module
+        model.forward_step(x[:, :step], state, quality=quality)
+        model.forward_step(x[:, step:2 * step], state, quality=quality)
+        tic = time.perf_counter()
+        for idx in range(2, n_steps + 2):
+            model.forward_step(x[:, idx * step:(idx + 1) * step], state,
+                               quality=quality)
+    return (time.perf_counter() - tic) / n_steps
+
+
+def measure_costs(tier_set, step=15, n_steps=4):
+    """ costs = measure_costs(tier_set, step, n_steps)
+    Duration of a streaming step of each tier, relative to the first one
+    """
+    durations = []
+    for name in tier_set.names:
+        model, quality = tier_set.get(name)
+        durations.append(step_cost(model, step, n_steps, quality=quality))
+    return [d / durations[0] for d in durations]
+
+
+class TierMonitor():
+    """ Automatic choice of the tier from the real-time factor (RTF)
+    TierMonitor(costs, max_rtf=0.9, target_rtf=0.6, smoothing=0.7,
+                hold=8)
+
+    costs: relative duration of a step of each tier (measure_costs)
+    max_rtf: go to a cheaper tier when the smoothed RTF is above
+    target_rtf: go back to the best tier whose expected RTF (scaled by
+                the costs) is below target_rtf, after hold steps
+    smoothing: exponential smoothing of the measured RTF
+    hold: steps measured on a tier before moving to a better one
+
+    tier = update(elapsed, duration): a render step took elapsed seconds
+    for duration seconds of audio, returns the index of the tier to use
+    """
+    def __init__(self, costs, max_rtf=0.9, target_rtf=0.6, smoothing=0.7,
+                 hold=8):
+        self.costs = list(costs)
+        self.max_rtf = max_rtf
+        self.target_rtf = target_rtf
+        self.smoothing = smoothing
+        self.hold = hold
+        self.tier = 0
+        self.rtf = None
+        self.n_steps = 0
+        self.n_switches = 0
+
+    def _best_tier(self):
+        """ best tier whose expected RTF is below target_rtf
+        """
+        for tier, cost in enumerate(self.costs):
+            if self.rtf * cost / self.costs[self.tier] <= self.target_rtf:
+                return tier
+        return len(self.costs) - 1
+
+    def _switch(self, tier):
+        if tier != self.tier:
+            self.tier = tier
+            self.rtf = None
+            self.n_steps = 0
+            self.n_switches += 1
+
+    def update(self, elapsed, duration):
+        rtf = elapsed / duration
+        if self.rtf is None:
+            self.rtf = rtf
+        else:
+            self.rtf = self.smoothing * self.rtf + (1 - self.smoothing) * rtf
+        self.n_steps += 1
+        best = self._best_tier()
+        if self.rtf > self.max_rtf:
+            self._switch(max(best, min(self.tier + 1, len(self.costs) - 1)))
+        elif best < self.tier and self.n_steps >= self.hold:
+            self._switch(best)
+        return self.tier
+
+
+def report_tiers(tier_set, length=60, step=15, n_steps=4):
+    """ report = report_tiers(tier_set, length, step, n_steps)
+    For each tier: duration and RTF of a streaming step of step frames,
+    signal-to-error ratio and log-spectral distance (dB) of model(x)
+    against the first tier on random features (source noise disabled)
+    """
+    x = _random_features(tier_set.models[tier_set.names[0]], length)
+    report = OrderedDict()
+    ref = None
+    for name in tier_set.names:
+        model, quality = tier_set.get(name)
+        duration = step_cost(model, step, n_steps, quality=quality)
+        audio = step * int(model.m_cond.up_sample) / model.sampling_rate
+        flag_noise = model.get_source_noise()
+        model.set_source_noise(False)
+        try:
+            with torch.no_grad():
+                output = model(x, quality)
+        finally:
+            model.set_source_noise(flag_noise)
+        if ref is None:
+            ref = output
+        if output.shape == ref.shape:
+            err = torch.sum((output - ref) ** 2).item()
+            ser = 10 * torch.log10(torch.sum(ref ** 2) / err).item() \
+                  if err > 0 else float('inf')
+            scores = "SER {:.1f} dB, LSD {:.2f} dB".format(
+                ser, quantize._spectral_distance(ref, output).item())
+        else:
+            scores = "SER n/a"
+        report[name] = "{:.2e}s per step, RTF {:.2f}, {:s}".format(
+            duration, duration / audio, scores)
+    return report
+
+
+if __name__ == "__main__":
+    nsf_model = torch.load(sys.argv[1], map_location="cpu")
+    nsf_model.eval()
+    distilled_model = None
+    if len(sys.argv) > 2:
+        distilled_model = torch.load(sys.argv[2], map_location="cpu")
+        distilled_model.eval()
+    for k, v in report_tiers(TierSet(nsf_model,
+                                     distilled=distilled_model)).items():
+        print("{:s}: {}".format(k, v))
@@ -9,75 +9,449 @@ import tqdm
 # import torchaudio
 import soundfile as sf
 import threading
+import zlib
+from collections import OrderedDict, deque
 from multiprocessing import Event, Process
-from torch2trt import torch2trt
-from torch2trt import TRTModule
-
-def spectral_features(y, sr):
-    features = [None] * 7
-    features[0] = librosa.feature.rms(y)
-    features[1] = librosa.feature.zero_crossing_rate(y)
-    # Spectral features
-    S, phase = librosa.magphase(librosa.stft(y=y))
-    # Compute all descriptors
-    features[2] = librosa.feature.spectral_rolloff(S=S)
-    features[3] = librosa.feature.spectral_flatness(S=S)
-    features[4] = librosa.feature.spectral_bandwidth(S=S)
-    features[5] = librosa.feature.spectral_centroid(S=S)
-    features[6] = librosa.yin(y, 50, 5000, sr=sr)[np.newaxis, :]
-    features = np.concatenate(features).transpose()
-    features[np.isnan(features)] = 1
-    features = features[:-1, :]
-    return features
+from models.features import SampleLibrary, freeze, spectral_features, stretch, transpose
+from models.nsf import quantize
+from models.nsf import receptive
+from models.nsf import sinc_nsf
+from models.nsf import tiers
+try:
+    from torch2trt import torch2trt
+    from torch2trt import TRTModule
+except ImportError:
+    torch2trt = None
+    TRTModule = None
+
+class BlockQueue:
+    """
+        Single-producer / single-consumer queue of 512-sample blocks on a
+        preallocated float32 buffer, between the generation thread (write) and
+        the audio callback (read).
+        Each block has a sequence number (seqlock): odd while the producer writes
+        it, even once it is complete, 0 if it was never written. The consumer
+        checks the sequence number before and after copying a block, so that it
+        never plays a block that is not ready or was rewritten during the copy.
+    """
+
+    def __init__(self, n_blocks):
+        self.audio = np.zeros(n_blocks * 512, dtype=np.float32)
+        self.seq = np.zeros(n_blocks, dtype=np.int64)
+        self.write_idx = 0
+        self.n_ready = 0
+
+    def write(self, audio):
+        """
+            Append samples (producer), publishing the blocks they complete
+        """
+        length = min(len(audio), len(self.audio) - self.write_idx)
+        if length <= 0:
+            return
+        first = self.write_idx // 512
+        last = (self.write_idx + length - 1) // 512
+        for b in range(first, last + 1):
+            if self.seq[b] % 2 == 0:
+                self.seq[b] += 1
+        self.audio[self.write_idx:(self.write_idx + length)] = audio[:length]
+        self.write_idx += length
+        for b in range(first, (self.write_idx // 512)):
+            self.seq[b] += 1
+        self.n_ready = self.write_idx // 512
+
+    def seek(self, sample_idx):
+        """
+            Move the write position to sample_idx (producer), to rewrite or skip
+            the next blocks. Written blocks stay playable with their old content
+            until rewritten.
+        """
+        self.write_idx = sample_idx
+        self.n_ready = self.write_idx // 512
+
+    def truncate(self):
+        """
+            Drop the blocks after the write position (producer): their content, left
+            from a previous render, is no longer playable
+        """
+        self.seq[((self.write_idx + 511) // 512):] = 0
+
+    def read(self, block_idx, out):
+        """
+            Copy the block block_idx in out (consumer).
+            Returns False if the block is not ready (out is then undefined).
+        """
+        if block_idx >= len(self.seq):
+            return False
+        seq = self.seq[block_idx]
+        if seq == 0 or seq % 2 == 1:
+            return False
+        np.copyto(out, self.audio[(block_idx * 512):((block_idx+1) * 512)])
+        return self.seq[block_idx] == seq
+
+
+class RenderCache:
+    """
+        LRU cache of rendered morphs under a byte budget. The audio is stored in a
+        preallocated arena of fixed-size slots (float16 or float32), allocated at the
+        first insertion (and again, emptied, if a longer render comes).
+    """
+
+    def __init__(self, budget, dtype=np.float16):
+        self.budget = budget
+        self.dtype = np.dtype(dtype)
+        self.arena = None
+        self.slots = OrderedDict()
+        self.free = []
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """
+            Rendered audio (float32) of key, None if not cached
+        """
+        if key is None:
+            return None
+        if key not in self.slots:
+            self.misses += 1
+            return None
+        self.slots.move_to_end(key)
+        self.hits += 1
+        slot, length = self.slots[key]
+        return self.arena[slot, :length].astype(np.float32)
+
+    def put(self, key, audio):
+        if key is None:
+            return
+        self.reserve(len(audio))
+        if key in self.slots:
+            slot = self.slots.pop(key)[0]
+        elif len(self.free) > 0:
+            slot = self.free.pop()
+        elif len(self.slots) > 0:
+            # Evict the least recently used render
+            slot = self.slots.popitem(last=False)[1][0]
+            self.evictions += 1
+        else:
+            # Budget below one render
+            return
+        self.arena[slot, :len(audio)] = audio
+        self.slots[key] = (slot, len(audio))
+
+    def reserve(self, length):
+        """
+            Size the slots for renders of up to length samples (empties the cache
+            if the slots were shorter), so that renders of varying lengths share
+            the arena without reallocation
+        """
+        if self.arena is not None and self.arena.shape[1] >= length:
+            return
+        self.evictions += len(self.slots)
+        n_slots = self.budget // (length * self.dtype.itemsize)
+        self.arena = np.zeros((n_slots, length), dtype=self.dtype)
+        self.slots.clear()
+        self.free = list(range(n_slots))
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'entries': len(self.slots), 'bytes': 0 if self.arena is None else self.arena.nbytes}
+
+
+class RenderJob:
+    """
+        Streamed rendering of one feature set (batchsize=1, length, 7), shared by
+        all the voices triggered on it. The audio is written in a BlockQueue.
+    """
+
+    def __init__(self, features, key=None, capacity=None):
+        self.features = features
+        # Render cache key (None: not cached)
+        self.key = key
+        self.gen_frame = 0
+        # Queue long enough for the longest features the job may be retargeted to
+        self.queue = BlockQueue(max(features.shape[1], capacity or 0))
+        self.last_val = None
+        # Position of the next output sample, samples before splice are warm-up
+        self.out_idx = 0
+        self.splice = 0
+        # New audio not spliced yet (re-render, or render over an approximation): the
+        # splice follows the playhead, the new audio from the splice on waits in
+        # pending_audio, the previous audio of the queue ends at prev_end
+        self.pending_splice = False
+        self.pending_audio = None
+        self.prev_end = 0
+        self.restart = False
+        # Armed: the next gate plays it, triggered: a voice plays it
+        self.armed = True
+        self.triggered = False
+        self.done = False
+        # Background: pre-render of the grid point grid_cv (lowest priority)
+        self.background = False
+        self.grid_cv = None
+        # Phase of the sines at the frame phase_frame (exact windows of exported models)
+        self.phase = None
+        self.phase_frame = 0
+        # Quality tier of the render (chosen when the render starts, kept until its end)
+        self.tier = None
+        self.noise_offset = self.noise_position(features)
+
+    def active(self):
+        return (not self.done) and (self.armed or self.triggered or self.background)
+
+    @staticmethod
+    def noise_position(features):
+        """
+            Position of features in the source noise table (seeded noise): voices playing
+            different features at the same time do not add the same noise coherently
+        """
+        return zlib.crc32(features.detach().cpu().numpy().tobytes())
 
 
 class NSF:
     m_path = "/home/martin/Desktop/Impact-Synth-Hardware/code/models/model_nsf_sinc_ema_impacts_waveform_5.0.th"
     # m_path = "/home/hime/Work/Neurorack/Impact-Synth-Hardware/code/models/model_nsf_sinc_ema_impacts_waveform_5.0.th"
     trt_path = "/home/martin/Desktop/Impact-Synth-Hardware/code/models/model_trt_5.0.th"
+    # TorchScript artifact for CPU-only hosts (see models/nsf/export.py)
+    ts_path = "/home/martin/Desktop/Impact-Synth-Hardware/code/models/model_nsf_sinc_ema_impacts_waveform_5.0.ts"
     f_pass = 1
+    # Sinc filter lookup table (None to compute the exact filters)
+    sinc_table_size = 1024
+    sinc_table_interp = True
+    # Closed-form up-sampling and smoothing of the condition features (same output)
+    fused_upsampling = True
+    # Int8 quantized profile (CPU only, calibrated on the feature store models/features/)
+    quantized = False
+    # Run the harmonic and noise filter branches concurrently (only helps with spare
+    # cores, see report_concurrent_branches in models/nsf/benchmark.py). Exported
+    # TorchScript models choose at export time (export.py --concurrent)
+    concurrent_branches = False
+    # Seed of the source noise table: the same features always give the same audio
+    # (re-renders are bit-identical and cheaper than drawing noise). None for fresh
+    # random noise at every render (live play). Exported TorchScript models keep the
+    # table chosen at export time (export.py --noise_seed)
+    noise_seed = 0
+    # Quality / latency tiers of the pickled model (see models/nsf/tiers.py): 'auto' starts the new renders
+    # on a cheaper tier while the real-time factor (render time / audio time) is above tier_max_rtf, and
+    # goes back once the better tier is expected below tier_target_rtf. Or the name of a fixed tier.
+    quality_tier = 'auto'
+    tier_max_rtf = 0.9
+    tier_target_rtf = 0.6
+    # Smaller distilled checkpoint, the fastest tier if the file exists
+    distilled_path = None
+    # Polyphony: maximum number of voices mixed together
+    max_voices = 4
+    # Re-render after a CV change: frames of context before the new audio (None: the
+    # left receptive field of the model, the new audio is then the same as a full render)
+    rerender_warmup = None
+    # Blocks between the playhead and the splice of new audio (re-render or approximation).
+    # The splice is placed when the new audio is one render step ahead of it
+    block_lookahead = 1
+    # CV resolution (None: no quantization, no render cache)
+    cv_quantization = 0.05
+    # Render cache of finished morphs: byte budget and storage type
+    cache_budget = 64 * 1024 * 1024
+    cache_dtype = np.float16
+    # Background pre-render at idle: number of grid points over the interp_final
+    # alpha axis (cv3..cv5 = 1), and byte budget of the grid
+    prerender_points = 9
+    prerender_budget = 16 * 1024 * 1024
+    # Sample library (sound folder indexed in models/features/library.json) and
+    # the sounds that the CVs morph between (names relative to library_root)
+    library_root = 'data'
+    morph_sounds = ['dce_synth_one_shot_bumper_G#min.wav', 'SH_FFX_123BPM_IMPACT_01.wav',
+                    'FF_ET_whoosh_hit_little.wav']
+    # Number of morph sounds the interp modes handle: interp_duo and interp_final morph
+    # the first two sounds, interp_trio weights each sound by one of its 4 CVs
+    min_morph_sounds = 2
+    max_morph_sounds = 4
+    # Time alignment of sounds of different lengths: 'decay' (hold the last frame
+    # with the rms fading by 60 dB over align_decay frames) or 'resample' (stretch
+    # all sounds to the longest one). Morphs last the weighted mean of the lengths.
+    align_mode = 'decay'
+    align_decay = 16
+    # Feature-domain variations of the morphs (see vary): longest stretch factor
+    # and transpose range (semitones) at the ends of the CV range
+    max_stretch = 2.0
+    transpose_range = 12
+    # Exported models: generate each window with the exact context of the model
+    # (receptive field) instead of one frame of overlap and a crossfade
+    exact_windows = True
+    # Voice whose next block is not ready: 'hold' (wait for it) or 'silence' (skip it)
+    underrun_mode = 'hold'
 
     def __init__(self):
         # Testing NSF
         print('Creating empty NSF')
         self._model = None
+        self._tiers = None
+        self._tier_monitor = None
+        # Left receptive field of the pickled model (frames), see rerender_warmup
+        self._warmup_frames = 0
+        self._device = 'cuda' if torch.cuda.is_available() else 'cpu'
         self._wav_file = 'reference_impact.wav'
         self._n_blocks = 15
         self._n_batch = 1
         self._thread = None
-        self._last_gen_block = 0
         self._last_request_block = -1
-        self._block_lookahead = 1
-        self._last_val = None
-        self._current_chunk = None
+        self._direct_job = None
+        self._direct_state = None
         self._next_chunk = None
-        self._generated_queue = []
+        self._armed_job = None
+        self._new_jobs = []
+        self._render_groups = []
+        # Voice slots, owned by the audio callback
+        self._voice_jobs = [None] * self.max_voices
+        self._voice_pos = [0] * self.max_voices
+        # Trigger order of the voices (the oldest voice is stolen when all slots are busy)
+        self._voice_start = [0] * self.max_voices
+        self._n_triggers = 0
+        self._voice_triggers = deque()
+        # Mix gain (1/sqrt(voices)), ramped over a block when the number of voices changes
+        self._mix_gain = 1.0
+        self._gain_ramp = np.zeros(512, dtype=np.float32)
+        self._mix_block = np.zeros(512, dtype=np.float32)
+        self._voice_block = np.zeros(512, dtype=np.float32)
+        self._request_block = np.zeros(512, dtype=np.float32)
+        self._underruns = 0
+        self._cache = RenderCache(self.cache_budget, self.cache_dtype)
+        self._source_key = None
+        self._grid = {}
+        # Crossfade windows of the overlapping windows (exported models)
+        self._fade_in = np.linspace(0, 1, 512, dtype=np.float32)
+        self._fade_out = np.linspace(1, 0, 512, dtype=np.float32)
         self._generate_end = False
         self._generate_signal = Event()
-        self._features = None
+        # Features of the current morph and their render cache key, published as one
+        # tuple (see _publish_morph): the generation thread never sees the features of
+        # one morph with the key of another
+        self._target = (None, None)
         self._features_list = None
+        self._library = None
+        self._pending_sounds = None
+        # Time-aligned sources (n_sounds, frames, 7) and their lengths, per source set
+        self._sources = None
+        self._source_lengths = None
+        self._aligned = OrderedDict()
+        # Morph before the variations (stretch, transpose, freeze position): features,
+        # kind and CVs
+        self._morph_base = None
+        self._variation = (1.0, 0.0, None)
 
     def dummy_features(self, wav):
         y, sr = librosa.load(wav)
         features = spectral_features(y, sr)
         return features
 
-    def preload(self):
-        torch.backends.cudnn.benchmark = True
+    def load_model(self):
+        """
+            Load the pickled model on the GPU. On CPU-only hosts, load the
+            exported TorchScript artifact instead if it exists (faster to start,
+            and optimized for CPU inference).
+        """
+        if self._device == 'cpu' and os.path.exists(self.ts_path):
+            self._model = torch.jit.load(self.ts_path, map_location='cpu')
+            self._model.eval()
+            print("NSF TorchScript model loaded")
+            return
         #if (not os.path.exists(self.trt_path)):
-        self._model = torch.load(self.m_path, map_location="cuda")
-        self._model = self._model.cuda()
+        self._model = torch.load(self.m_path, map_location=self._device)
+        self._model = self._model.to(self._device)
         #else:
         #    self._model = TRTModule()
         #    self._model.load_state_dict(torch.load(self.trt_path))
         #    self._model = self._model.cuda()
-        self._model.eval()
+        self._prepare_model(self._model)
+        self._warmup_frames = receptive.receptive_field(self._model)['left_frames']
+        if self.quantized:
+            self.quantize_model()
+        self.load_tiers()
         print("NSF model loaded")
+
+    def _prepare_model(self, model):
+        model.eval()
+        if self.sinc_table_size is not None:
+            model.m_filter.build_sinc_table(self.sinc_table_size, self.sinc_table_interp)
+        if self.fused_upsampling:
+            model.m_cond.build_fused_upsampling()
+        model.m_filter.set_concurrent_branches(self.concurrent_branches)
+        model.set_noise_table(self.noise_seed)
+
+    def load_tiers(self):
+        """
+            Quality tiers of the pickled model (and of the distilled checkpoint). For
+            the automatic choice, the cost of a render step of each tier is measured
+            once here.
+        """
+        distilled = None
+        if self.distilled_path is not None and os.path.exists(self.distilled_path):
+            distilled = torch.load(self.distilled_path, map_location=self._device)
+            self._prepare_model(distilled)
+        self._tiers = tiers.TierSet(self._model, distilled=distilled)
+        self._tier_monitor = None
+        if self.quality_tier == 'auto':
+            costs = tiers.measure_costs(self._tiers, self._n_blocks)
+            self._tier_monitor = tiers.TierMonitor(costs, self.tier_max_rtf, self.tier_target_rtf)
+
+    def tier(self):
+        """
+            Name of the quality tier of the renders that start now ('full' for the
+            exported models, which have a single tier)
+        """
+        if self._tiers is None:
+            return 'full'
+        if self._tier_monitor is None:
+            return self.quality_tier
+        return self._tiers.names[self._tier_monitor.tier]
+
+    def tier_stats(self):
+        stats = {'tier': self.tier()}
+        if self._tier_monitor is not None:
+            stats['real-time factor'] = self._tier_monitor.rtf
+            stats['switches'] = self._tier_monitor.n_switches
+        return stats
+
+    def _update_tier(self, elapsed):
+        """
+            Feed the duration of a render step to the automatic tier choice
+        """
+        if self._tier_monitor is None:
+            return
+        previous = self._tier_monitor.tier
+        self._tier_monitor.update(elapsed, self._n_blocks * 512 / self._model.sampling_rate)
+        if self._tier_monitor.tier != previous:
+            print('NSF tier: ' + self.tier())
+
+    def _tier_model(self, tier):
+        """
+            Model of a tier and its quality (None: the model as loaded). The tiers share
+            the model without modifying it, the quality is given to each forward_step.
+        """
+        if self._tiers is None or tier is None:
+            return self._model, None
+        return self._tiers.get(tier)
+
+    def quantize_model(self):
+        if self._device != 'cpu':
+            print('Int8 profile only runs on CPU, keeping float model')
+            return
+        calib_features = quantize.load_calibration_features()
+        if len(calib_features) == 0:
+            print('No calibration features, keeping float model')
+            return
+        self._model = quantize.quantize_model(self._model, calib_features)
+        print("NSF model quantized")
+
+    def preload(self):
+        torch.backends.cudnn.benchmark = True
+        # Features first: they are the calibration data of the quantized profile
         self.features_loading()
-        self._features = self._features_list[0]
+        self.load_model()
+        self._publish_morph(self._features_list[0], 'sound', 0)
+        self.start_prerender()
+        features = self._target[0]
         tmp_features = []
         for b in range(self._n_batch):
-            tmp_features.append(self._features[:, (b*self._n_blocks):((b+1)*self._n_blocks)+1, :])
+            tmp_features.append(features[:, (b*self._n_blocks):((b+1)*self._n_blocks)+1, :])
         tmp_features = torch.cat(tmp_features)
         print(tmp_features.shape)
         for p in range(self.f_pass):
@@ -99,7 +473,7 @@ class NSF:
 
     def generate_random(self, length=200):
         print('Generating random length ' + str(length))
-        features = [torch.randn(1, length, 1).cuda()] * 7
+        features = [torch.randn(1, length, 1).to(self._device)] * 7
         with torch.no_grad():
             audio = self._model(features)
         return audio.squeeze().detach().cpu().numpy()
@@ -119,168 +493,778 @@ class NSF:
         # Signal the generation thread
         # self._generate_signal.set()
         
-    def generate_block(self, block_id):
-        cur_feats = self._features[:, block_id:(block_id + self._n_blocks + 1), :]
-        # print(cur_feats.shape)
-        with torch.no_grad():
-            cur_audio = self._model(cur_feats).squeeze().detach().cpu().numpy()
-        if self._last_val is not None:
-            cur_audio[:512] = (self._last_val * np.linspace(1, 0, 512)) + (cur_audio[:512] * np.linspace(0, 1, 512))
-        self._last_val = cur_audio[-512:]
-        cur_audio = cur_audio[:-512]
-        block_audio = []
-        # print('CV ' + str(cv_id) + ' going active')
-        for b in range(self._n_blocks):
-            block_audio.append(cur_audio[(b * 512):((b+1)*512)])
-        return block_audio
-    
     def generate_thread_full(self, args):
-        # First do a full generation
-        while True:
-            # We have generated the full queue
-            if (self._last_gen_block + self._n_blocks + 1) > self._features.shape[1]:
-                self.generate_end = True
-                # print('Generated full')
-                break
-            # Generate a new block
-            cur_audio = self.generate_block(self._last_gen_block)
-            # Append blocks to queue
-            for b in range(self._n_blocks):
-                self._generated_queue.append(cur_audio[b])
-            self._last_gen_block += self._n_blocks
-        # Then switch to block-wise mode
+        # Render the current features, then wait for new ones
+        features, key = self._target
+        self.arm_job(features, key, self._cache.get(key))
         self.generate_thread_block(args)
     
     def generate_thread_block(self, args):
         self._generate_signal.clear()
         while True:
-            # We have generated the full queue
-            if (self._last_gen_block + self._n_blocks + 1) > self._features.shape[1]:
+            # Waking up to generate new features
+            if self._generate_signal.is_set():
+                self._generate_signal.clear()
+                if self._pending_sounds is not None:
+                    names, self._pending_sounds = self._pending_sounds, None
+                    self._swap_sounds(names)
+                self.schedule_morph(*self._target)
+            # We have rendered all the jobs
+            if not self.render_step():
                 self._generate_end = True
                 # print('Generate thread going to sleep')
                 self._generate_signal.wait()
-            # Waking up to generate
-            if self._generate_signal.is_set():
-                self._generate_signal.clear()
-                self._last_gen_block = 0
-            # Infer which block to generate
-            # gen_block = (self.last_request_block // self._n_blocks) * self.n_blocks
-            # gen_block += (self.block_lookahead * self._n_blocks)
-            gen_block = self._last_gen_block
-            if gen_block == 0:
-                self._last_val = None
+
+    def arm_job(self, features, key=None, cached=None):
+        """
+            Start rendering the features that the next gate will play (or take their
+            cached audio). The previous job is dropped unless a voice is playing it.
+            Until the render is ahead of the playback, the gate plays an approximation
+            from the pre-rendered grid when there is one.
+        """
+        if self._armed_job is not None:
+            self._armed_job.armed = False
+        self._armed_job = RenderJob(features, key, self._max_frames())
+        if cached is not None:
+            self._armed_job.queue.write(cached)
+            self._armed_job.done = True
+            return
+        approx = self._grid_approx(key)
+        if approx is not None:
+            # Replaced by the render once it is ahead of the playhead (see _write_job_audio)
+            self._armed_job.queue.write(approx)
+            self._armed_job.queue.seek(0)
+            self._armed_job.pending_splice = True
+            self._armed_job.prev_end = len(approx)
+        self._new_jobs.append(self._armed_job)
+
+    def _job_done(self, job):
+        job.done = True
+        if job.grid_cv is not None:
+            self._grid[job.grid_cv] = job.queue.audio[:job.queue.write_idx].astype(self.cache_dtype)
+        # Only complete full-quality renders of a single morph go to the cache
+        if job.key is not None and job.tier in (None, 'full'):
+            self._cache.put(job.key, job.queue.audio[:job.queue.write_idx])
+
+    def start_prerender(self):
+        """
+            Queue the background renders of the grid over the interp_final alpha axis
+            (cv3..cv5 = 1), as many points as prerender_budget allows. They only run
+            when no other render needs the model.
+        """
+        if self.prerender_points < 2 or self.cv_quantization is None:
+            return
+        length = self._sources.shape[1] * 512
+        n_points = min(self.prerender_points, self.prerender_budget // (length * np.dtype(self.cache_dtype).itemsize))
+        if n_points < 2:
+            return
+        for cv in np.linspace(-4, 4, n_points):
+            cv = self._quantize_cv(cv)
+            if cv in self._grid:
+                continue
+            job = RenderJob(self._final_features(cv, 1.0, 1.0, 1.0), capacity=self._sources.shape[1])
+            job.armed = False
+            job.background = True
+            job.grid_cv = cv
+            self._new_jobs.append(job)
+
+    def _grid_lookup(self, key):
+        """
+            Rendered audio of a grid point with exactly this morph key (or None)
+        """
+        if key is None or key[1] != 'final' or len(self._grid) == 0:
+            return None
+        if any(v != 1.0 for cvs in key[3:] for v in cvs):
+            return None
+        grid = self._grid.get(key[2][0])
+        return None if grid is None else grid.astype(np.float32)
+
+    def _grid_approx(self, key):
+        """
+            Approximation of an interp_final morph from the pre-rendered grid: the
+            crossfade of the two nearest points on the alpha axis (or the nearest)
+        """
+        if key is None or key[1] != 'final' or len(self._grid) == 0:
+            return None
+        cv = key[2][0]
+        points = sorted(self._grid)
+        lower = [p for p in points if p <= cv]
+        upper = [p for p in points if p >= cv]
+        if len(lower) == 0 or len(upper) == 0:
+            return self._grid[points[0] if len(lower) == 0 else points[-1]].astype(np.float32)
+        lower, upper = lower[-1], upper[0]
+        if upper == lower:
+            return self._grid[lower].astype(np.float32)
+        alpha = (cv - lower) / (upper - lower)
+        # Points of different lengths: the shorter one is silent after its end
+        approx = np.zeros(max(len(self._grid[lower]), len(self._grid[upper])), dtype=np.float32)
+        approx[:len(self._grid[lower])] += (1 - alpha) * self._grid[lower].astype(np.float32)
+        approx[:len(self._grid[upper])] += alpha * self._grid[upper].astype(np.float32)
+        return approx
+
+    def cache_stats(self):
+        return self._cache.stats()
+
+    def schedule_morph(self, features, key=None):
+        """
+            New morph (CV change): the jobs that voices are playing are re-rendered
+            with it from their playhead plus block_lookahead (the audio already played
+            or about to be is kept), and a new job is armed for the next gates.
+        """
+        cached = self._cache.get(key)
+        if cached is None:
+            cached = self._grid_lookup(key)
+        for job in set(self._voice_jobs):
+            if job is None:
+                continue
+            playhead = self._job_playhead(job)
+            if playhead is not None:
+                self.retarget_job(job, features, playhead + self.block_lookahead, cached)
+        self.arm_job(features, key, cached)
+
+    def retarget_job(self, job, features, start_frame, cached=None):
+        """
+            Re-render job with new features from start_frame on, cancelling its
+            current render. The model restarts rerender_warmup frames before. The
+            previous audio stays in the queue and keeps playing until the new audio
+            is spliced (at least start_frame, see _write_job_audio).
+            With the cached audio of the new features, it is spliced directly.
+        """
+        # Previous audio: the one of the last splice still pending, or the whole queue
+        prev_end = job.prev_end if job.pending_splice else job.queue.write_idx
+        # Restart at the end of the previous render if it is behind
+        start_frame = min(start_frame, features.shape[1], prev_end // 512)
+        if start_frame >= len(job.queue.seq):
+            return
+        warmup_frame = max(0, start_frame - self._rerender_warmup())
+        job.pending_splice = True
+        job.pending_audio = None
+        job.prev_end = prev_end
+        job.features = features
+        # Noise of the new features: after the warm-up, the same audio as their full render
+        job.noise_offset = RenderJob.noise_position(features)
+        job.key = None
+        job.gen_frame = warmup_frame
+        job.out_idx = warmup_frame * 512
+        job.splice = start_frame * 512
+        job.last_val = None
+        job.phase = None
+        job.done = False
+        job.queue.seek(job.splice)
+        if cached is not None:
+            job.out_idx = job.splice
+            self._write_job_audio(job, cached[job.splice:], True)
+            job.done = True
+            return
+        if not job.restart:
+            job.restart = True
+            self._new_jobs.append(job)
+
+    def _rerender_warmup(self):
+        """
+            Frames of context re-rendered before the new audio of a retargeted job
+        """
+        if self.rerender_warmup is not None:
+            return self.rerender_warmup
+        if hasattr(self._model, 'context_frames'):
+            return self._model.context_frames[0]
+        return self._warmup_frames
+
+    def _job_playhead(self, job):
+        """
+            First block that a voice playing job will read (None if not playing)
+        """
+        playhead = None
+        for v in range(self.max_voices):
+            if self._voice_jobs[v] is job:
+                pos = self._voice_pos[v]
+                playhead = pos if playhead is None else min(playhead, pos)
+        return playhead
+
+    def _job_slack(self, job):
+        """
+            Number of rendered blocks ahead of the playhead of job
+        """
+        playhead = self._job_playhead(job)
+        if playhead is None:
+            return np.inf
+        return (job.queue.write_idx // 512) - playhead
+
+    def render_step(self):
+        """
+            Generate the next n_blocks frames of the active jobs, with one batched
+            forward_step per group of jobs (batch = jobs) sharing the same state
+            structure. Returns False if there was nothing to render.
+            Steps run by priority (fewest blocks ahead of a playhead first). While a
+            playing job is less than one step ahead, the other steps wait.
+        """
+        if not hasattr(self._model, 'init_state'):
+            return self._render_window_step()
+        groups = self._render_groups
+        new_jobs = self._new_jobs
+        self._render_groups = []
+        self._new_jobs = []
+        steps = []
+        for jobs, state in groups:
+            # Restarted jobs leave their group
+            self._plan_group(jobs, state, [not job.restart for job in jobs], steps)
+        for job in new_jobs:
+            job.restart = False
+            # Background renders only run when the model is idle: always full quality
+            job.tier = 'full' if job.background or self._tiers is None else self.tier()
+        if len(new_jobs) > 0:
+            self._plan_group(new_jobs, None, [True] * len(new_jobs), steps)
+        if len(steps) == 0:
+            return False
+        steps.sort(key=lambda step: step[3])
+        urgent = self._n_blocks + self.block_lookahead
+        foreground = any([not step[0][0].background for step in steps])
+        tic = time.perf_counter()
+        for jobs, state, flush, slack in steps:
+            if (slack >= urgent and steps[0][3] < urgent) or (jobs[0].background and foreground):
+                # Postponed (background renders pause while others need the model)
+                self._render_groups.append([jobs, state])
+                continue
+            state = self._render_group(jobs, state, flush)
+            if not flush:
+                self._merge_group(jobs, state)
+        if foreground:
+            self._update_tier(time.perf_counter() - tic)
+        return True
+
+    def _plan_group(self, jobs, state, keep, steps):
+        """
+            Split a group into its steps: (jobs, state, flush, slack)
+        """
+        for job in jobs:
+            if not job.active():
+                job.done = True
+        # Jobs reaching the end of their features are flushed on their own,
+        # background jobs are stepped apart from the others
+        for background in [False, True]:
+            steady = [j for j, job in enumerate(jobs) if keep[j] and not job.done and not self._job_last_step(job)
+                      and job.background == background]
+            if len(steady) > 0:
+                steps.append(([jobs[j] for j in steady], self._select_state(state, steady, len(jobs)), False,
+                              min([self._job_slack(jobs[j]) for j in steady])))
+        last = [j for j, job in enumerate(jobs) if keep[j] and not job.done and self._job_last_step(job)]
+        for j in last:
+            steps.append(([jobs[j]], self._select_state(state, [j], len(jobs)), True, self._job_slack(jobs[j])))
+
+    def _job_last_step(self, job):
+        return (job.gen_frame + self._n_blocks) >= job.features.shape[1]
+
+    def _select_state(self, state, index, n_jobs):
+        if state is None or len(index) == n_jobs:
+            return state
+        return sinc_nsf.state_select(state, index)
+
+    def _render_group(self, jobs, state, flush):
+        model, quality = self._tier_model(jobs[0].tier)
+        if state is None:
+            state = model.init_state(torch.tensor([job.noise_offset + job.gen_frame * 512 for job in jobs]),
+                                     self._start_phase(model, jobs))
+        cur_feats = torch.cat([job.features[:, job.gen_frame:(job.gen_frame + self._n_blocks), :] for job in jobs])
+        with torch.no_grad():
+            cur_audio = model.forward_step(cur_feats, state, flush, quality).detach().cpu().numpy()
+        for job, job_audio in zip(jobs, cur_audio):
+            job.gen_frame += self._n_blocks
+            self._write_job_audio(job, job_audio, flush)
+            if flush:
+                self._job_done(job)
+        return state
+
+    def _start_phase(self, model, jobs):
+        """
+            Phase of the sines at the first frame rendered by the jobs (re-renders start
+            in the middle of the features), None when they all start at the beginning
+        """
+        if all([job.gen_frame == 0 for job in jobs]):
+            return None
+        return torch.cat([receptive.start_phase(model, job.features, job.gen_frame) for job in jobs])
+
+    def _write_job_audio(self, job, job_audio, last=False):
+        """
+            Write the next output samples of a job in its queue (last: end of the render).
+            New audio over previous audio (re-render, approximation) is spliced at the live
+            playhead plus block_lookahead, once it is one render step ahead of it (or at
+            the end of the render): the samples before the splice (warm-up, or audio
+            rendered while the playhead moved on) are dropped, the first block is
+            crossfaded with the previous audio and the previous audio after the new one
+            is no longer playable
+        """
+        start = job.out_idx
+        job.out_idx += len(job_audio)
+        if not job.pending_splice:
+            job.queue.write(job_audio)
+            return
+        playhead = self._job_playhead(job)
+        if playhead is not None:
+            # Never splice behind the playhead (the warm-up took time), nor after the
+            # last block of the previous audio
+            job.splice = max(job.splice, min((playhead + self.block_lookahead) * 512,
+                                             (job.prev_end // 512) * 512))
+            # The previous audio was played: the queue is no longer a single morph
+            job.key = None
+        if job.pending_audio is not None:
+            start -= len(job.pending_audio)
+            job_audio = np.concatenate([job.pending_audio, job_audio])
+        job_audio = job_audio[max(0, job.splice - start):]
+        if playhead is not None and job.out_idx < job.splice + self._n_blocks * 512 and not last:
+            job.pending_audio = job_audio
+            # The write position follows the render, for the priorities (_job_slack)
+            job.queue.seek(min(job.out_idx, len(job.queue.audio)))
+            return
+        job.pending_splice = False
+        job.pending_audio = None
+        job.queue.seek(job.splice)
+        # Nothing to crossfade if no voice played the previous audio
+        n_fade = 0 if playhead is None else min(512, len(job_audio), job.prev_end - job.splice)
+        if n_fade > 0:
+            job_audio[:n_fade] = (job.queue.audio[job.splice:(job.splice + n_fade)] * self._fade_out[:n_fade]) \
+                                 + (job_audio[:n_fade] * self._fade_in[:n_fade])
+        job.queue.write(job_audio)
+        job.queue.truncate()
+
+    def _merge_group(self, jobs, state):
+        signature = sinc_nsf.state_signature(state)
+        for group in self._render_groups:
+            if group[0][0].background == jobs[0].background and group[0][0].tier == jobs[0].tier \
+                    and sinc_nsf.state_signature(group[1]) == signature:
+                group[0] = group[0] + jobs
+                group[1] = sinc_nsf.state_cat([group[1], state])
+                return
+        self._render_groups.append([jobs, state])
+
+    def _render_window_step(self):
+        """
+            render_step for exported models (full forward pass only): the windows
+            [gen_frame, gen_frame + n_blocks] of the jobs are batched by length
+        """
+        jobs = [job for group in self._render_groups for job in group[0]]
+        jobs = jobs + [job for job in self._new_jobs if job not in jobs]
+        self._new_jobs = []
+        for job in jobs:
+            job.restart = False
+            if not job.active():
+                job.done = True
+        jobs = [job for job in jobs if not job.done]
+        self._render_groups = [[jobs, None]]
+        # Priority to the playing jobs that are less than one step ahead, background
+        # renders pause while others need the model
+        urgent = [job for job in jobs if self._job_slack(job) < self._n_blocks + self.block_lookahead]
+        foreground = [job for job in jobs if not job.background]
+        windows = {}
+        for job in (urgent if len(urgent) > 0 else (foreground if len(foreground) > 0 else jobs)):
+            ctx_st, ctx_ed, end = self._window_bounds(job)
+            windows.setdefault((ctx_ed - ctx_st, job.gen_frame - ctx_st, end - job.gen_frame), []).append(job)
+        for w_jobs in windows.values():
+            self._render_window(w_jobs)
+        return len(jobs) > 0
+
+    def _exact_windows(self):
+        return self.exact_windows and hasattr(self._model, 'context_frames')
+
+    def _seeded_windows(self):
+        return getattr(self._model, 'noise_table_size', 0) > 0
+
+    def _window_bounds(self, job):
+        """
+            Frames [ctx_st, ctx_ed) given to the model to generate the frames
+            [gen_frame, end) of a job
+        """
+        n_frames = job.features.shape[1]
+        if not self._exact_windows():
+            end = min(job.gen_frame + self._n_blocks + 1, n_frames)
+            return job.gen_frame, end, end
+        left, right = self._model.context_frames
+        end = min(job.gen_frame + self._n_blocks, n_frames)
+        return max(0, job.gen_frame - left), min(n_frames, end + right), end
+
+    def _window_phase(self, job, ctx_st):
+        """
+            Phase of the sines at the frame ctx_st of a job, carried from window
+            to window
+        """
+        if job.phase is None or job.phase_frame > ctx_st:
+            # phase at the first frame (0 for all the harmonics, or the start of the noise table)
+            if self._seeded_windows():
+                job.phase = self._model.initial_phase(job.features[:, :0, -1:])
             else:
-                self._last_val = self._generated_queue[gen_block]
-            if gen_block + self._n_blocks > len(self._generated_queue):
+                job.phase = self._model.frame_phase(job.features[:, :0, -1:])
+            job.phase_frame = 0
+        job.phase = (job.phase + self._model.frame_phase(job.features[:, job.phase_frame:ctx_st, -1:])) % 1
+        job.phase_frame = ctx_st
+        return job.phase
+
+    def _render_window(self, jobs):
+        """
+            Generate the windows [gen_frame, gen_frame + n_blocks] (same length) of
+            the jobs. With exact windows, each window is surrounded by the context
+            of the model and continues the phase of the previous one. Otherwise,
+            the first block is crossfaded with the extra block of the previous window.
+        """
+        ctx_st, ctx_ed, end = self._window_bounds(jobs[0])
+        offset, length = jobs[0].gen_frame - ctx_st, end - jobs[0].gen_frame
+        exact = self._exact_windows()
+        cur_feats = []
+        phases = []
+        for job in jobs:
+            ctx_st, ctx_ed, _ = self._window_bounds(job)
+            cur_feats.append(job.features[:, ctx_st:ctx_ed, :])
+            if exact:
+                phases.append(self._window_phase(job, ctx_st))
+        cur_feats = torch.cat(cur_feats)
+        with torch.no_grad():
+            if exact and self._seeded_windows():
+                # noise of the window read at its position in the sound
+                noise_offset = torch.tensor([job.noise_offset + self._window_bounds(job)[0] * 512 for job in jobs])
+                cur_audio = self._model(cur_feats, torch.cat(phases), noise_offset).detach().cpu().numpy()
+            elif exact:
+                cur_audio = self._model(cur_feats, torch.cat(phases)).detach().cpu().numpy()
+            else:
+                cur_audio = self._model(cur_feats).detach().cpu().numpy()
+        for job, job_audio in zip(jobs, cur_audio):
+            if exact:
+                job.gen_frame += length
+                last = job.gen_frame >= job.features.shape[1]
+                self._write_job_audio(job, job_audio[(offset * 512):((offset + length) * 512)], last)
+            else:
+                if job.last_val is not None:
+                    job_audio[:512] = (job.last_val * self._fade_out) + (job_audio[:512] * self._fade_in)
+                job.last_val = job_audio[-512:]
+                job.gen_frame += self._n_blocks
+                last = job.gen_frame >= job.features.shape[1]
+                job_audio = job_audio if last else job_audio[:-512]
+                self._write_job_audio(job, job_audio, last)
+            if last:
+                self._job_done(job)
+
+    def trigger_voice(self):
+        """
+            Start a new voice on the armed job (gate), layered over the voices
+            already playing. Voices are handed to the audio callback, which owns
+            the voice list.
+        """
+        job = self._armed_job
+        if job is None:
+            return
+        job.triggered = True
+        self._voice_triggers.append(job)
+
+    def request_mix_block(self):
+        """
+            Next 512 samples of the mix of all the voices (audio callback).
+            A voice whose next block is not ready counts as an underrun, it either
+            waits for the block or skips it (underrun_mode).
+            A new voice takes a free slot, or replaces the oldest voice when all the
+            slots are busy. The mix is scaled by 1/sqrt(number of voices), for
+            headroom as voices pile up.
+            The returned array is a scratch buffer reused by the next call: consume or
+            copy it before calling again.
+        """
+        while self._voice_triggers:
+            v = min(range(self.max_voices), key=lambda v: (self._voice_jobs[v] is not None, self._voice_start[v]))
+            self._voice_jobs[v] = self._voice_triggers.popleft()
+            self._voice_pos[v] = 0
+            self._voice_start[v] = self._n_triggers
+            self._n_triggers += 1
+        self._mix_block.fill(0)
+        for v in range(self.max_voices):
+            job = self._voice_jobs[v]
+            if job is None:
                 continue
-            cur_audio = self.generate_block(self._last_gen_block)
-            # Change blocks to queue
-            for b in range(self._n_blocks):
-                self._generated_queue[gen_block+b] = cur_audio[b]
-            if gen_block + self._n_blocks < len(self._generated_queue):
-                n_block = self._generated_queue[gen_block + self._n_blocks]
-                self._generated_queue[gen_block + self._n_blocks] = (self._last_val * np.linspace(1, 0, 512)) + (n_block * np.linspace(0, 1, 512))
-            #print('Finished update from ' + str(gen_block) + ' to ' + str(gen_block + self._n_blocks))
-            self._last_gen_block += self._n_blocks
+            block_idx = self._voice_pos[v]
+            if job.done and block_idx >= job.queue.n_ready:
+                # End of the voice (blocks after it are left from a longer render)
+                self._voice_jobs[v] = None
+            elif job.queue.read(block_idx, self._voice_block):
+                np.add(self._mix_block, self._voice_block, out=self._mix_block)
+                self._voice_pos[v] = block_idx + 1
+            else:
+                self._underruns += 1
+                if self.underrun_mode == 'silence':
+                    self._voice_pos[v] = block_idx + 1
+        n_voices = sum([job is not None for job in self._voice_jobs])
+        gain = 1.0 / np.sqrt(max(n_voices, 1))
+        np.multiply(self._fade_in, gain - self._mix_gain, out=self._gain_ramp)
+        np.add(self._gain_ramp, self._mix_gain, out=self._gain_ramp)
+        np.multiply(self._mix_block, self._gain_ramp, out=self._mix_block)
+        self._mix_gain = gain
+        return self._mix_block
+
+    def get_underruns(self):
+        return self._underruns
                           
     def request_block_direct(self, block_idx):
+        """
+            Block block_idx of the current features, rendered in the calling thread
+            (None past the end). The returned array is a scratch buffer reused by the
+            next call (request_block_direct or request_block_threaded): consume or copy
+            it before calling again.
+        """
         print('Request block : ' + str(block_idx))
-        print(len(self._features))
+        features = self._target[0]
+        print(len(features))
         self._last_request_block = block_idx
-        if block_idx + self._n_blocks > self._features.shape[1]:
-            return None
-        if block_idx % self._n_blocks == 0:
+        if block_idx == 0:
+            self._direct_job = RenderJob(features)
+            self._direct_state = None
+        job = self._direct_job
+        while job.queue.n_ready <= block_idx and not job.done:
             print('Need next block')
-            self._current_chunk = self.generate_block(block_idx)
+            if hasattr(self._model, 'init_state'):
+                self._direct_state = self._render_group([job], self._direct_state, self._job_last_step(job))
+            else:
+                self._render_window([job])
             print('Block generated')
-        return self._current_chunk[block_idx % self._n_blocks]
+        if not job.queue.read(block_idx, self._request_block):
+            return None
+        return self._request_block
     
     def request_block_threaded(self, block_idx):
+        """
+            Block block_idx of the armed job, rendered by the generation thread (None
+            if it is not ready). Same scratch buffer as request_block_direct: consume or
+            copy it before calling again.
+        """
         # print('Request block : ' + str(block_idx))
         # Update requested block
         self._last_request_block = block_idx
         # Signal the generation thread
         # self._generate_signal.set()
         # Check if we have ended
-        if len(self._generated_queue) <= block_idx:
+        job = self._armed_job
+        if job is None or not job.queue.read(block_idx, self._request_block):
             return None
-        return self._generated_queue[block_idx]
+        return self._request_block
 
     def features_loading(self):
-        wav_list = ['dce_synth_one_shot_bumper_G#min.wav', 'SH_FFX_123BPM_IMPACT_01.wav',
-                    'FF_ET_whoosh_hit_little.wav', 'Afro_FX_Oneshot_Impact_3.wav']
-        for wav in wav_list:
-            if not os.path.exists("models/features_interp" + str(wav) + ".th"):
-                y, sr = librosa.load("data/" + wav)
-                features = spectral_features(y, sr)
-                features = torch.tensor(features).unsqueeze(0).cuda().float()
-                torch.save(features, "models/features_interp" + str(wav) + ".th")
-        feats = []
-        for wav in wav_list:
-            ft = torch.load("models/features_interp" + str(wav) + ".th")
-            feats.append(ft)
-        # Create sounds list
-        snd_list = [] * 4
-        # print('CV ' + str(cv_id) + ' going active')
-        min_size = np.inf
-        for i in range(3):
-            snd_list.append(feats[i])
-            if feats[i].shape[1] < min_size:
-                min_size = feats[i].shape[1]
-                # Crop to the min size
-        for i in range(len(snd_list)):
-            snd_list[i] = snd_list[i][:, :min_size, :]
-        self._features_list = snd_list
+        self._library = SampleLibrary(self.library_root)
+        self._library.open()
+        self._apply_sounds(self.morph_sounds)
+
+    def select_sounds(self, names):
+        """
+            Change the sounds that the CVs morph between (names of the library).
+            The features come from the library index (mmap + LRU), the swap itself
+            is applied by the generation thread, which then renders the first sound.
+        """
+        if not (self.min_morph_sounds <= len(names) <= self.max_morph_sounds):
+            print('Select {:d} to {:d} sounds, got {:d}'.format(self.min_morph_sounds, self.max_morph_sounds,
+                                                                 len(names)))
+            return
+        missing = [name for name in names if name not in self._library]
+        if len(missing) > 0:
+            print('Unknown sounds: ' + ', '.join(missing))
+            return
+        self._pending_sounds = list(names)
+        self._generate_signal.set()
+
+    def _apply_sounds(self, names):
+        self._features_list = [self._library.features(name, self._device) for name in names]
+        # Content keys: renamed files share their renders in the cache
+        self._source_key = tuple(self._library.entry(name)['key'] for name in names)
+        self.morph_sounds = list(names)
+        aligned_key = (self._source_key, self.align_mode, self.align_decay)
+        if aligned_key not in self._aligned:
+            self._aligned[aligned_key] = self._align_sources(self._features_list)
+            while len(self._aligned) > 4:
+                self._aligned.popitem(last=False)
+        self._aligned.move_to_end(aligned_key)
+        self._sources, self._source_lengths = self._aligned[aligned_key]
+        self._cache.reserve(self._max_frames() * 512)
+
+    def _align_sources(self, snd_list):
+        """
+            Stack the sounds (1, length_i, 7) on a common frame axis (n_sounds,
+            max_length, 7), with one gather over all the sounds (align_mode)
+        """
+        lengths = torch.tensor([snd.shape[1] for snd in snd_list], device=self._device)
+        n_frames = int(lengths.max())
+        feats = torch.cat([snd[0] for snd in snd_list], dim=0)
+        offsets = (torch.cumsum(lengths, 0) - lengths).unsqueeze(1)
+        last = (lengths - 1).unsqueeze(1)
+        frames = torch.arange(n_frames, device=self._device).unsqueeze(0)
+        if self.align_mode == 'resample':
+            pos = frames * (last / max(n_frames - 1, 1))
+            low = torch.floor(pos).long()
+            frac = (pos - low).unsqueeze(2)
+            high = torch.minimum(low + 1, last)
+            sources = (1 - frac) * feats[offsets + low] + frac * feats[offsets + high]
+        else:
+            sources = feats[offsets + torch.minimum(frames, last)]
+            tail = torch.clamp(frames - last, min=0)
+            sources[:, :, 0] *= 10 ** (-3 * tail / self.align_decay)
+        return sources, lengths.float()
+
+    def _morph(self, weights, length_weights):
+        """
+            Weighted sum of the aligned sources, weights (n_sounds,) or (n_sounds, 7),
+            lasting the mean of the source lengths under length_weights (n_sounds,)
+        """
+        weights = torch.as_tensor(weights, dtype=torch.float32, device=self._device)
+        weights = weights.reshape(len(self._sources), 1, -1)
+        interp = torch.sum(weights * self._sources, dim=0, keepdim=True)
+        length_weights = torch.as_tensor(length_weights, dtype=torch.float32, device=self._device)
+        length_weights = length_weights / torch.clamp(torch.sum(length_weights), min=1e-8)
+        length = max(1, int(torch.round(torch.sum(length_weights * self._source_lengths))))
+        if self.align_mode == 'resample':
+            return torch.nn.functional.interpolate(interp.transpose(1, 2), size=length, mode='linear',
+                                                   align_corners=True).transpose(1, 2)
+        return interp[:, :length, :].contiguous()
+
+    def _max_frames(self):
+        """
+            Longest features of a morph: the longest source, stretched
+        """
+        return int(np.ceil(self._sources.shape[1] * self.max_stretch))
+
+    def vary(self, stretch_factor=None, semitones=None, freeze_pos=None):
+        """
+            Variations of the current morph in the feature domain, at inference
+            cost only: time-stretch factor (1/max_stretch to max_stretch), F0
+            transpose in semitones, and freeze (hold the frame at freeze_pos, in
+            fractions of the length, None to release). None keeps the current value
+            of stretch_factor and semitones.
+        """
+        cur_stretch, cur_semitones, _ = self._variation
+        stretch_factor = cur_stretch if stretch_factor is None else stretch_factor
+        semitones = cur_semitones if semitones is None else semitones
+        stretch_factor = float(np.clip(stretch_factor, 1 / self.max_stretch, self.max_stretch))
+        self._variation = (stretch_factor, float(semitones), None if freeze_pos is None else float(freeze_pos))
+        morph_features, kind, cvs = self._morph_base
+        self._publish_morph(morph_features, kind, *cvs)
+        self._generate_signal.set()
+
+    def vary_cv(self, cv_stretch=0.0, cv_transpose=0.0, cv_freeze=-4.0):
+        """
+            vary from CVs in [-4, 4]: stretch 1/max_stretch..max_stretch (0: none),
+            transpose -transpose_range..transpose_range semitones (0: none), freeze
+            position from the start to the end of the sound (-4: no freeze)
+        """
+        cv_stretch, cv_transpose, cv_freeze = [self._quantize_cv(cv) for cv in [cv_stretch, cv_transpose, cv_freeze]]
+        freeze_pos = None if cv_freeze <= -4 else (cv_freeze + 4) / 8
+        self.vary(self.max_stretch ** (cv_stretch / 4), cv_transpose / 4 * self.transpose_range, freeze_pos)
+
+    def _vary(self, features, variation):
+        stretch_factor, semitones, freeze_pos = variation
+        if stretch_factor != 1.0:
+            features = stretch(features, stretch_factor)
+        if semitones != 0.0:
+            features = transpose(features, semitones)
+        if freeze_pos is not None:
+            features = freeze(features, freeze_pos * (features.shape[1] - 1))
+        return features
+
+    def _cv_curve(self, cv, length):
+        """
+            CV value or buffer as a (1, length) tensor (buffers are resampled)
+        """
+        cv = np.ravel(np.asarray(cv, dtype=np.float32))
+        if len(cv) > 1:
+            cv = np.interp(np.linspace(0, len(cv) - 1, length), np.arange(len(cv)), cv)
+        return torch.tensor(np.broadcast_to(cv, (length,)), dtype=torch.float32, device=self._device).unsqueeze(0)
+
+    def _swap_sounds(self, names):
+        # Grid renders of the previous sounds are dropped
+        for job in self._new_jobs + [job for jobs, _ in self._render_groups for job in jobs]:
+            if job.background:
+                job.done = True
+        self._grid = {}
+        self._apply_sounds(names)
+        self._publish_morph(self._features_list[0], 'sound', 0)
+        self.start_prerender()
+
+    def _quantize_cv(self, cv):
+        """
+            CV value (or buffer) rounded to cv_quantization, so that revisited CV
+            positions give exactly the same morph (and hit the render cache)
+        """
+        if self.cv_quantization is None:
+            return cv
+        return (np.round(np.asarray(cv, dtype=np.float64) / self.cv_quantization) * self.cv_quantization).tolist()
+
+    def _publish_morph(self, morph_features, kind, *cvs):
+        """
+            Make morph_features (a morph of the kind with the quantized CVs) the current
+            morph: its varied features and render cache key are computed from the same
+            variation and published together
+        """
+        variation = self._variation
+        self._morph_base = (morph_features, kind, cvs)
+        self._target = (self._vary(morph_features, variation), self._morph_key(kind, cvs, variation))
+
+    def _morph_key(self, kind, cvs, variation):
+        """
+            Render cache key of a morph (None without CV quantization)
+        """
+        if self.cv_quantization is None:
+            return None
+        if variation != (1.0, 0.0, None):
+            # Varied morphs are neither grid points nor plain morphs
+            kind = (kind,) + variation
+        return (self._source_key, kind) + tuple(tuple(np.ravel(cv).tolist()) for cv in cvs)
 
     def interp_duo(self, cv_list):
         # Simulate CVs
         # cv_list = [random.sample(range(-4, 4), 1)[0]] * 4
+        cv_list = self._quantize_cv(cv_list)
+        morph_cvs = ('duo', cv_list)
         cv_list = [(x + 4) / 8 for x in cv_list]
         print(cv_list)
-        snd_1 = self._features_list[0]
-        snd_2 = self._features_list[1]
         # Run through CV values
         # TODO: cv1 = rms [0], cv2 = flatness [3], cv3 = centroid [5], ccv4 = pitch [6]
         feats_list = [0, 3, 5, 6]
-        x_interp = snd_1.clone()
+        weights = np.zeros((len(self._sources), 7), dtype=np.float32)
+        weights[0] = 1
         for i, alpha in zip(feats_list, cv_list):
-            x_interp[:, :, i] = (1 - alpha) * snd_2[:, :, i] + alpha * snd_1[:, :, i]
-        self._features = x_interp
-        print(torch.mean(self._features, dim=(0, 1)))
+            weights[0, i], weights[1, i] = alpha, 1 - alpha
+        # The rms CV sets the length
+        length_weights = np.zeros(len(self._sources), dtype=np.float32)
+        length_weights[:2] = [cv_list[0], 1 - cv_list[0]]
+        self._publish_morph(self._morph(weights, length_weights), *morph_cvs)
+        print(torch.mean(self._target[0], dim=(0, 1)))
         print('End of interpolate')
         self._generate_signal.set()
 
     def interp_trio(self, cv_list):
         # Simulate CVs
         # cv_list = [random.sample(range(-4, 4), 1)[0]] * 4
+        cv_list = self._quantize_cv(cv_list)
+        morph_cvs = ('trio', cv_list)
         cv_list = [(x + 4) / 8 for x in cv_list]
         cv_sum = sum(cv_list)
         if abs(2 - cv_sum) < 0.1:
             cv_list = [1, 0, 0, 0]
         print(cv_list)
         # Run through CV values
-        interp = torch.zeros_like(self._features_list[0])
-        for i, snd in enumerate(self._features_list):
-            interp += snd * cv_list[i] / cv_sum
-        self._features = interp
+        weights = [cv_list[i] / cv_sum for i in range(len(self._sources))]
+        self._publish_morph(self._morph(weights, weights), *morph_cvs)
         print('End of interpolate')
         self._generate_signal.set()
         
     def interp_final(self, cv_control, cv3, cv4, cv5):
+        cv_control, cv3, cv4, cv5 = [self._quantize_cv(cv) for cv in [cv_control, cv3, cv4, cv5]]
         print('Interpolating sounds')
         print(cv_control)
         print(cv3)
         print(cv4)
         print(cv5)
-        alpha = (cv_control + 4) / 8
-        # Run through CV values
-        interp = (1 - alpha) * self._features_list[0] + (alpha * self._features_list[1])
-        interp[:, :, 2] = interp[:, :, 2] * torch.tensor(cv3).unsqueeze(0).cuda()
-        interp[:, :, 3] = interp[:, :, 3] * torch.tensor(cv4).unsqueeze(0).cuda()
-        interp[:, :, 4] = interp[:, :, 4] * torch.tensor(cv5).unsqueeze(0).cuda()
-        self._features = interp
+        self._publish_morph(self._final_features(cv_control, cv3, cv4, cv5), 'final', cv_control, cv3, cv4, cv5)
         print('End of interpolate')
         self._generate_signal.set()
+
+    def _final_features(self, cv_control, cv3, cv4, cv5):
+        alpha = (cv_control + 4) / 8
+        # Run through CV values
+        weights = np.zeros(len(self._sources), dtype=np.float32)
+        weights[:2] = [1 - alpha, alpha]
+        interp = self._morph(weights, weights)
+        interp[:, :, 2] = interp[:, :, 2] * self._cv_curve(cv3, interp.shape[1])
+        interp[:, :, 3] = interp[:, :, 3] * self._cv_curve(cv4, interp.shape[1])
+        interp[:, :, 4] = interp[:, :, 4] * self._cv_curve(cv5, interp.shape[1])
+        return interp
         
 
 
@@ -294,7 +1278,7 @@ if __name__ == '__main__':
         y, sr = librosa.load(root_dir + '/' + wav)
         features = spectral_features(y, sr)
         print(features.shape)
-        features = torch.tensor(features).unsqueeze(0).cuda().float()
+        features = torch.tensor(features).unsqueeze(0).to(model._device).float()
         audio = model.generate(features)
         sf.write("generate" + str(wav) + ".wav", audio, sr)
 
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+"""
+test_features.py for the feature store of models/features.py
+
+Tests of the content-hashed feature store, of the batch extraction and
+of the sample library. The sound files of the tests are not decoded:
+their features are saved in the store beforehand.
+
+Usage: $: python -m pytest models/test_features.py
+       $: python -m models.test_features  (from the code/ directory)
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+
+import os
+import sys
+import tempfile
+import traceback
+import numpy as np
+import torch
+
+from models.features import FeatureStore, SampleLibrary, extract_library
+
+
+def _sound(folder, name, content):
+    """ path of a sound file of the given content (bytes)
+    """
+    path = os.path.join(folder, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(content)
+    return path
+
+
+def _stored_sound(store, folder, name, content, n_frames):
+    """ path and features of a sound file whose features are in store
+    """
+    path = _sound(folder, name, content)
+    features = np.random.rand(n_frames, 7).astype(np.float32)
+    store.save(store.file_key(path), features)
+    return path, features
+
+
+def test_feature_store():
+    with tempfile.TemporaryDirectory() as tmp:
+        store = FeatureStore(os.path.join(tmp, 'store'))
+        path_a = _sound(tmp, 'a.wav', b'impact')
+        path_b = _sound(tmp, 'b.wav', b'impact')
+        path_c = _sound(tmp, 'c.wav', b'whoosh')
+        # keys of the content: renamed files share their features
+        key = store.file_key(path_a)
+        assert store.file_key(path_b) == key
+        assert store.file_key(path_c) != key
+        # other descriptor parameters, other keys
+        assert FeatureStore(store.root, 44100).file_key(path_a) != key
+        assert store.audio_key(np.zeros(10)).startswith('a')
+        features = np.random.rand(20, 7).astype(np.float32)
+        assert not store.contains(key)
+        store.save(key, features)
+        assert store.contains(key)
+        assert np.array_equal(store.load(key), features)
+        assert os.listdir(store.root) == [key + '.npy']
+        # features in the store are not computed again
+        tensor = store.features(path_b)
+        assert tensor.shape == (1, 20, 7)
+        assert torch.equal(tensor[0], torch.from_numpy(features))
+
+
+def test_extract_library():
+    with tempfile.TemporaryDirectory() as tmp:
+        store = FeatureStore(os.path.join(tmp, 'store'))
+        path, _ = _stored_sound(store, tmp, 'a.wav', b'impact', 10)
+        missing = os.path.join(tmp, 'missing.wav')
+        results = extract_library([path, missing], store, n_workers=1,
+                                  progress=False)
+        assert results[path] == (store.file_key(path), 'skipped', None)
+        # a broken file is reported, the batch goes on
+        key, status, error = results[missing]
+        assert key is None and status == 'failed' and error is not None
+
+
+def test_sample_library():
+    with tempfile.TemporaryDirectory() as tmp:
+        store = FeatureStore(os.path.join(tmp, 'store'))
+        folder = os.path.join(tmp, 'sounds')
+        name_b = os.path.join('kit', 'b.wav')
+        _, feats_a = _stored_sound(store, folder, 'a.wav', b'impact', 10)
+        _, feats_b = _stored_sound(store, folder, name_b, b'hit', 12)
+        library = SampleLibrary(folder, store, cache_size=1)
+        library.open(n_workers=1)
+        assert library.names() == ['a.wav', name_b]
+        entry = library.entry(name_b)
+        assert entry['frames'] == 12
+        assert np.allclose(entry['mean'], feats_b.mean(axis=0))
+        assert torch.equal(library.features('a.wav')[0],
+                           torch.from_numpy(feats_a))
+        # LRU of cache_size feature matrices
+        library.features(name_b)
+        assert len(library._cache) == 1
+        # the manifest is reused, and rebuilt when a sound is added
+        assert os.path.exists(library.manifest_path)
+        library = SampleLibrary(folder, store)
+        library.open(n_workers=1)
+        assert len(library) == 2
+        _stored_sound(store, folder, 'c.wav', b'whoosh', 5)
+        library = SampleLibrary(folder, store)
+        library.open(n_workers=1)
+        assert 'c.wav' in library and library.entry('c.wav')['frames'] == 5
+
+
+if __name__ == "__main__":
+    failures = []
+    for name, test in sorted(globals().items()):
+        if not (name.startswith('test_') and callable(test)):
+            continue
+        try:
+            test()
+            print("{:s}: ok".format(name))
+        except Exception:
+            failures.append(name)
+            print("{:s}: FAILED".format(name))
+            traceback.print_exc()
+    if len(failures) > 0:
+        print("{:d} failed: {:s}".format(len(failures), ", ".join(failures)))
+        sys.exit(1)
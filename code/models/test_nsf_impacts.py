@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+"""
+test_nsf_impacts.py for the render engine of models/nsf_impacts.py
+
+Tests of the render engine, with the audio callback simulated in the
+same thread: the generation thread runs one render_step every few
+blocks read by the callback (faster than real time).
+
+The tests use the pickled model given by the NSF_MODEL environment
+variable, or an untrained model with the default configuration.
+
+Usage: $: python -m pytest models/test_nsf_impacts.py
+       $: python -m models.test_nsf_impacts  (from the code/ directory)
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+
+import os
+import sys
+import traceback
+import numpy as np
+import torch
+
+from models.nsf import benchmark
+from models.nsf import receptive
+from models.nsf_impacts import NSF, BlockQueue, RenderCache, RenderJob
+
+# re-renders restart from the phase of the sines accumulated in float64
+RTOL = 1e-3
+
+
+def _engine(n_frames=80, noise=False):
+    """ engine on its own model (prepared as in NSF.load_model), for
+        features of up to n_frames frames, with or without source noise
+        (seeded noise table)
+    """
+    nsf = NSF()
+    nsf._model = benchmark.load_model(os.environ.get('NSF_MODEL'))
+    nsf._prepare_model(nsf._model)
+    nsf._warmup_frames = receptive.receptive_field(nsf._model)['left_frames']
+    nsf._model.set_source_noise(noise)
+    nsf._sources = torch.zeros(1, n_frames, 7)
+    return nsf
+
+
+def _render(nsf, features):
+    """ audio of a whole render of features, step by step
+    """
+    job = RenderJob(features)
+    state = None
+    while not job.done:
+        state = nsf._render_group([job], state, nsf._job_last_step(job))
+    return job.queue.audio[:job.queue.write_idx].copy()
+
+
+def _play(nsf, n_blocks, events=None, render_every=4):
+    """ mix of n_blocks blocks read by the audio callback, with a
+        render_step every render_every blocks, and events[block]() called
+        before reading block
+    """
+    output = []
+    nsf.render_step()
+    for block in range(n_blocks):
+        if events is not None and block in events:
+            events[block]()
+        output.append(nsf.request_mix_block().copy())
+        if (block + 1) % render_every == 0:
+            nsf.render_step()
+    return np.concatenate(output)
+
+
+def _rel_err(output, ref):
+    return np.max(np.abs(output - ref)) / max(np.max(np.abs(ref)), 1e-8)
+
+
+def _retarget(nsf, key=None):
+    """ output of a voice with a CV change at block 40 (re-render with
+        the receptive field as warm-up, or the render cached under key),
+        the job of the voice and the full renders of the features before
+        and after the change
+    """
+    feats_a = benchmark.random_features(80)
+    feats_b = benchmark.random_features(80)
+    ref_a, ref_b = _render(nsf, feats_a), _render(nsf, feats_b)
+    if key is not None:
+        nsf._cache.put(key, ref_b)
+    nsf.arm_job(feats_a)
+    nsf.trigger_voice()
+    job = nsf._armed_job
+    output = _play(nsf, 80, {40: lambda: nsf.schedule_morph(feats_b, key)})
+    return output, job, ref_a, ref_b
+
+
+def test_block_queue():
+    queue = BlockQueue(4)
+    out = np.zeros(512, dtype=np.float32)
+    assert not queue.read(0, out)
+    # only complete blocks are published
+    queue.write(np.full(700, 1.0, dtype=np.float32))
+    assert queue.n_ready == 1
+    assert queue.read(0, out) and np.all(out == 1.0)
+    assert not queue.read(1, out)
+    queue.write(np.full(324, 2.0, dtype=np.float32))
+    assert queue.read(1, out) and out[187] == 1.0 and out[188] == 2.0
+    # a rewritten block is not playable until it is complete again
+    queue.seek(512)
+    queue.write(np.full(100, 3.0, dtype=np.float32))
+    assert queue.read(0, out) and not queue.read(1, out)
+    queue.write(np.full(412, 3.0, dtype=np.float32))
+    assert queue.read(1, out) and np.all(out == 3.0)
+    # the blocks after the write position stay playable until truncated
+    queue.write(np.full(1024, 4.0, dtype=np.float32))
+    queue.seek(1024)
+    assert queue.read(3, out)
+    queue.truncate()
+    assert queue.read(1, out) and not queue.read(2, out)
+    # writes past the end of the buffer are dropped
+    queue.write(np.full(4096, 5.0, dtype=np.float32))
+    assert queue.write_idx == 2048 and queue.read(3, out)
+    assert not queue.read(4, out)
+
+
+def test_retarget_splice():
+    nsf = _engine()
+    output, job, ref_a, ref_b = _retarget(nsf)
+    assert nsf.get_underruns() == 0
+    assert not job.pending_splice
+    # spliced after the playhead at the CV change, and after the block
+    # played when the new audio was ready
+    assert job.splice >= (40 + nsf.block_lookahead) * 512
+    assert _rel_err(output[:job.splice], ref_a[:job.splice]) == 0
+    assert _rel_err(output[job.splice + 512:],
+                    ref_b[job.splice + 512:]) < RTOL
+
+
+def test_retarget_noise():
+    # seeded noise of the new features, as in their full render
+    output, job, ref_a, ref_b = _retarget(_engine(noise=True))
+    assert _rel_err(output[job.splice + 512:],
+                    ref_b[job.splice + 512:]) < RTOL
+
+
+def test_cached_retarget():
+    nsf = _engine()
+    nsf._cache = RenderCache(16 * 1024 * 1024, np.float32)
+    output, job, ref_a, ref_b = _retarget(nsf, ('sounds', 'final', (1.0,)))
+    assert nsf.get_underruns() == 0
+    assert job.splice >= (40 + nsf.block_lookahead) * 512
+    assert _rel_err(output[:job.splice], ref_a[:job.splice]) == 0
+    # the cached audio is crossfaded with the previous audio
+    fade = slice(job.splice, job.splice + 512)
+    assert _rel_err(output[fade], ref_a[fade] * nsf._fade_out
+                    + ref_b[fade] * nsf._fade_in) < 1e-6
+    assert _rel_err(output[job.splice + 512:],
+                    ref_b[job.splice + 512:]) == 0
+
+
+def test_publish_morph():
+    nsf = _engine()
+    nsf._source_key = ('sounds',)
+    features = benchmark.random_features(40)
+    nsf._publish_morph(features, 'final', 1.0, 0.0, 0.0, 0.0)
+    assert nsf._target[0] is features
+    assert nsf._target[1] == (('sounds',), 'final', (1.0,), (0.0,), (0.0,),
+                              (0.0,))
+    # a variation publishes the varied features with their own key
+    nsf.vary(stretch_factor=2.0)
+    varied, key = nsf._target
+    assert varied.shape[1] == 80
+    assert key[1] == ('final', 2.0, 0.0, None)
+
+
+def _voice(nsf, n_blocks):
+    """ trigger a voice on a rendered job of n_blocks blocks of ones
+    """
+    job = RenderJob(torch.zeros(1, n_blocks, 7))
+    job.queue.write(np.ones(n_blocks * 512, dtype=np.float32))
+    job.done = True
+    nsf._armed_job = job
+    nsf.trigger_voice()
+    return job
+
+
+def test_align_sources():
+    nsf = NSF()
+    short = torch.rand(1, 3, 7)
+    long = torch.rand(1, 5, 7)
+    sources, lengths = nsf._align_sources([short, long])
+    assert sources.shape == (2, 5, 7) and lengths.tolist() == [3.0, 5.0]
+    assert torch.equal(sources[1], long[0])
+    # decay: last frame held, its rms fading by 60 dB over align_decay
+    assert torch.equal(sources[0, 0:3], short[0])
+    assert torch.equal(sources[0, 4, 1:], short[0, 2, 1:])
+    assert torch.allclose(sources[0, 4, 0], short[0, 2, 0]
+                          * 10 ** (-3 * 2 / nsf.align_decay))
+    # the morphs last the weighted mean of the lengths
+    nsf._sources, nsf._source_lengths = sources, lengths
+    assert nsf._morph([0.5, 0.5], [0.5, 0.5]).shape == (1, 4, 7)
+    assert nsf._morph([0.5, 0.5], [1.0, 0.0]).shape == (1, 3, 7)
+    # resample: all the sounds stretched to the longest one
+    nsf.align_mode = 'resample'
+    sources, _ = nsf._align_sources([short, long])
+    assert torch.allclose(sources[0, 0], short[0, 0])
+    assert torch.allclose(sources[0, 4], short[0, 2])
+    assert torch.allclose(sources[0, 1], (short[0, 0] + short[0, 1]) / 2)
+
+
+class _TwoVoices(NSF):
+    max_voices = 2
+
+
+def test_voice_allocation():
+    nsf = _TwoVoices()
+    job_a = _voice(nsf, 10)
+    job_b = _voice(nsf, 2)
+    output = [nsf.request_mix_block().copy() for _ in range(3)]
+    # two voices: 1/sqrt(2) each, ramped from the gain of a single voice
+    assert np.allclose(output[0], 2 * np.linspace(1, 1 / np.sqrt(2), 512))
+    assert np.allclose(output[1], np.sqrt(2))
+    # the end of the short voice frees its slot, the new voice takes it
+    assert job_b not in nsf._voice_jobs
+    job_c = _voice(nsf, 10)
+    nsf.request_mix_block()
+    assert nsf._voice_jobs == [job_a, job_c]
+    # all the slots busy: the oldest voice is replaced
+    job_d = _voice(nsf, 10)
+    nsf.request_mix_block()
+    assert nsf._voice_jobs == [job_d, job_c]
+
+
+if __name__ == "__main__":
+    failures = []
+    for name, test in sorted(globals().items()):
+        if not (name.startswith('test_') and callable(test)):
+            continue
+        try:
+            test()
+            print("{:s}: ok".format(name))
+        except Exception:
+            failures.append(name)
+            print("{:s}: FAILED".format(name))
+            traceback.print_exc()
+    if len(failures) > 0:
+        print("{:d} failed: {:s}".format(len(failures), ", ".join(failures)))
+        sys.exit(1)
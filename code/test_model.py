@@ -1,30 +1,12 @@
 import sklearn
 import torch
 import librosa
-import numpy as np
 import time
 import os
 import tqdm
 import soundfile as sf
 import matplotlib.pyplot as plt
-
-
-def spectral_features(y, sr):
-    features = [None] * 7
-    features[0] = librosa.feature.rms(y)
-    features[1] = librosa.feature.zero_crossing_rate(y)
-    # Spectral features
-    S, phase = librosa.magphase(librosa.stft(y=y))
-    # Compute all descriptors
-    features[2] = librosa.feature.spectral_rolloff(S=S)
-    features[3] = librosa.feature.spectral_flatness(S=S)
-    features[4] = librosa.feature.spectral_bandwidth(S=S)
-    features[5] = librosa.feature.spectral_centroid(S=S)
-    features[6] = librosa.yin(y, 50, 5000, sr=sr)[np.newaxis, :]
-    features = np.concatenate(features).transpose()
-    features[np.isnan(features)] = 1
-    features = features[:-1, :]
-    return features
+from models.features import FeatureStore, spectral_features
 
 
 class NSF:
@@ -100,11 +82,10 @@ if __name__ == '__main__':
                 'SH_FFX_123BPM_IMPACT_01.wav']
     feats = []
     cur_imp = 0
+    store = FeatureStore()
     for wav in wav_list:
-        y, sr = librosa.load('data/' + wav)
-        features = spectral_features(y, sr)
-        features = torch.tensor(features).unsqueeze(0).float().cuda()  # .cuda().float()
-        torch.save(features, "models/features_interp" + str(wav) + ".th")
+        features = store.features('data/' + wav, 'cuda')
+        sr = store.sr
         print('Generate ' + wav)
         audio = model.generate(features)
         sf.write("generation_testing/" + str(cur_imp) + ".wav", audio, sr)